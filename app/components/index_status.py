@@ -0,0 +1,52 @@
+"""
+知识库索引状态UI组件
+展示后台索引服务记录的各知识库新鲜度与滞后时间，定时局部刷新
+"""
+import time
+import streamlit as st
+from core.services.indexing_service import get_indexing_service
+
+
+KNOWLEDGE_BASE_NAMES = {
+    "project_documents": "项目知识库",
+    "context_documents": "上下文知识库",
+    "knowledge_documents": "背景知识库",
+}
+
+
+def request_knowledge_base_update(project):
+    """安排后台增量更新；未启用索引服务时返回 False，由调用方同步更新"""
+    service = get_indexing_service()
+    if service is None:
+        return False
+    service.request_update(project)
+    return True
+
+
+@st.fragment(run_every=2)
+def display_index_status(project):
+    """显示项目各知识库的索引状态，并确保项目目录处于监听中"""
+    service = get_indexing_service()
+    if service is None or not project:
+        return
+    try:
+        service.watch_project(project)
+    except Exception as e:
+        st.caption(f"知识库监听启动失败: {e}")
+        return
+    items = []
+    for name, status in service.status(project).items():
+        label = KNOWLEDGE_BASE_NAMES.get(name, name)
+        if status["indexing"]:
+            items.append(f"🔄 {label}：索引中（滞后 {status['lag']:.0f} 秒）")
+        elif status["last_error"]:
+            items.append(f"⚠️ {label}：索引失败 {status['last_error']}")
+        elif not status["fresh"]:
+            items.append(f"⏳ {label}：等待索引（滞后 {status['lag']:.0f} 秒）")
+        elif status["last_indexed"]:
+            updated = time.strftime("%H:%M:%S", time.localtime(status["last_indexed"]))
+            items.append(f"✅ {label}：已是最新（{updated}，耗时 {status['last_duration']:.1f} 秒）")
+        else:
+            items.append(f"✅ {label}：已是最新")
+    if items:
+        st.caption("　".join(items))
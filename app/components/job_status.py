@@ -0,0 +1,113 @@
+"""
+后台任务UI组件
+提交任务并定时局部刷新任务进度；任务结束后暂存结果并整页重跑，由页面在创建输入控件之前写回
+"""
+import streamlit as st
+from core.services.job_queue import get_job_queue
+from core.workflows.checkpoints import get_checkpoint_store
+
+
+JOB_NAMES = {
+    "update": "知识库更新",
+    "outlines": "大纲生成",
+    "detailed_outlines": "细纲生成",
+    "novels": "章节生成",
+}
+
+
+def submit_job(kind, project, params):
+    """提交后台任务并在会话中跟踪；同类任务仍在运行时返回 None"""
+    jobs = st.session_state.setdefault("jobs", {})
+    queue = get_job_queue()
+    if kind in jobs:
+        job = queue.get(jobs[kind])
+        if job is not None and not job["finished"]:
+            st.toast(f"{JOB_NAMES[kind]}任务进行中，请等待完成或取消后再提交")
+            return None
+    job_id = queue.submit(kind, {**params, "project": project}, project)
+    jobs[kind] = job_id
+    return job_id
+
+
+def attach_jobs(project):
+    """刷新页面后重新跟踪项目中仍在运行的任务"""
+    jobs = st.session_state.setdefault("jobs", {})
+    for job in get_job_queue().active_jobs(project):
+        jobs.setdefault(job["kind"], job["id"])
+
+
+def resumable_novel_run(project):
+    """项目最近一次生成运行已完成部分章节但未全部完成时返回该运行；有章节生成任务运行中时返回 None"""
+    if any(job["kind"] == "novels" for job in get_job_queue().active_jobs(project)):
+        return None
+    run = get_checkpoint_store(project).latest_resumable_run()
+    return run if run and run["completed"] else None
+
+
+def completed_novel_chapters(project, run_id, count):
+    """读取生成运行中前 count 个已完成章节的正文，运行已被清理时返回空列表"""
+    return [checkpoint["content"] for checkpoint in get_checkpoint_store(project).chapters(run_id)][:count]
+
+
+def discard_novel_run(project, run_id):
+    """放弃未完成的生成运行，删除其检查点"""
+    get_checkpoint_store(project).delete_run(run_id)
+    st.toast("已放弃上次未完成的章节生成")
+
+
+def pop_finished_jobs(kinds=None):
+    """取出已结束且尚未写回页面的任务，需在创建输入控件之前调用；kinds 限定只取当前页面处理的任务类型"""
+    finished = st.session_state.setdefault("finished_jobs", {})
+    return {kind: finished.pop(kind) for kind in list(finished) if kinds is None or kind in kinds}
+
+
+@st.fragment(run_every=1)
+def display_jobs(kinds=None):
+    """显示会话中各后台任务的进度，任务结束后整页重跑以写回结果；kinds 限定当前页面跟踪的任务类型"""
+    jobs = st.session_state.get("jobs", {})
+    queue = get_job_queue()
+    finished = st.session_state.setdefault("finished_jobs", {})
+    rerun = False
+    for kind, job_id in list(jobs.items()):
+        if kinds is not None and kind not in kinds:
+            continue
+        job = queue.get(job_id)
+        if job is None:
+            jobs.pop(kind)
+            continue
+        if job["finished"]:
+            jobs.pop(kind)
+            finished[kind] = job
+            rerun = True
+            continue
+        label = JOB_NAMES.get(kind, kind)
+        message = job["message"] or ("排队中..." if job["status"] == "queued" else "运行中...")
+        chapters = (job["result"] or {}).get("chapters")
+        if chapters:
+            message += f"（已完成 {len(chapters)} 章）"
+        col_bar, col_cancel = st.columns([9, 1], vertical_alignment="bottom")
+        with col_bar:
+            st.progress(min(max(job["progress"], 0.0), 1.0), text=f"{label}：{message}")
+        with col_cancel:
+            if st.button("取消", key=f"cancel_job_{job_id}", use_container_width=True):
+                queue.cancel(job_id)
+    if rerun:
+        st.rerun()
+
+
+@st.fragment(run_every=1)
+def display_stream_preview(kind="novels", height=400):
+    """显示运行中的生成任务正在流式输出的章节正文"""
+    job_id = st.session_state.get("jobs", {}).get(kind)
+    if not job_id:
+        return
+    job = get_job_queue().get(job_id)
+    if job is None or job["finished"]:
+        return
+    result = job["result"] or {}
+    text = result.get("streaming")
+    if not text:
+        return
+    with st.container(height=height):
+        st.markdown(f"**章节{result.get('start', 1) + len(result.get('chapters', []))}（生成中，{len(text)} 字）**")
+        st.text(text)
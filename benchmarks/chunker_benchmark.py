@@ -0,0 +1,135 @@
+"""
+文本切分基准测试
+对比不同切分器的知识块数量、切分耗时、索引耗时与检索命中率
+
+评测方法：从原始文档中随机截取一段文字作为查询，检索 top-k 知识块，
+若任一知识块包含该段文字则记为命中。检索方式可选 BM25（离线）或向量检索（使用项目配置的嵌入模型，
+写入临时的内存向量库，不影响项目数据）。
+
+用法：
+    python -m benchmarks.chunker_benchmark <项目名> [--kb project_documents] [--queries 100] [--retrieval bm25,vector]
+"""
+from dotenv import load_dotenv
+from config.project_config import get_config
+from langchain_chroma import Chroma
+from rag.lexical import BM25Index
+from rag.loaders import load_document
+from rag.processors import get_document_processor
+from rag.splitters import build_text_splitter
+from utils.token_utils import estimate_tokens
+import argparse
+import os
+import random
+import re
+import statistics
+import time
+import uuid
+
+
+SPECS = {
+    "character": {"kind": "character", "chunk_size": 200, "chunk_overlap": 20},
+    "chinese": {"kind": "chinese", "chunk_tokens": 256, "chunk_overlap_tokens": 32},
+}
+
+
+def _compact(text):
+    return re.sub(r"\s+", "", text)
+
+
+def load_sources(path):
+    """加载知识库目录下的全部原始文档"""
+    documents = []
+    for file in sorted(os.listdir(path)):
+        if file.startswith("."):
+            continue
+        try:
+            documents.extend(load_document(os.path.join(path, file)))
+        except Exception as e:
+            print(f"跳过 {file}: {e}")
+    return documents
+
+
+def build_queries(documents, count=100, seed=42):
+    """从原始文本中随机截取 8~16 个字符作为查询，与切分方式无关"""
+    rng = random.Random(seed)
+    texts = [_compact(document.page_content) for document in documents]
+    texts = [text for text in texts if len(text) >= 32]
+    if not texts:
+        raise ValueError("知识库中的文本不足，无法评测")
+    queries = []
+    for _ in range(count):
+        text = rng.choice(texts)
+        length = rng.randint(8, 16)
+        start = rng.randint(0, len(text) - length)
+        queries.append(text[start:start + length])
+    return queries
+
+
+def evaluate(spec, documents, queries, retrievals, embeddings=None, k=4):
+    """返回切分与索引统计，以及各检索方式的 Hit@k"""
+    start = time.perf_counter()
+    chunks = build_text_splitter(spec).split_documents(documents)
+    split_seconds = time.perf_counter() - start
+    tokens = [estimate_tokens(chunk.page_content) for chunk in chunks]
+    result = {
+        "chunks": len(chunks),
+        "avg_tokens": statistics.mean(tokens) if tokens else 0.0,
+        "max_tokens": max(tokens) if tokens else 0,
+        "split_s": split_seconds,
+    }
+    compacted = [_compact(chunk.page_content) for chunk in chunks]
+    # 查询恰好跨越知识块边界时任何检索都无法命中，给出上限以便比较
+    result["coverable"] = sum(any(query in text for text in compacted) for query in queries) / len(queries)
+    for retrieval in retrievals:
+        start = time.perf_counter()
+        if retrieval == "bm25":
+            index = BM25Index(chunks)
+            search = lambda query: [document for document, _ in index.search(query, k)]
+        elif retrieval == "vector":
+            store = Chroma(collection_name=f"bench-{uuid.uuid4().hex[:8]}", embedding_function=embeddings)
+            store.add_documents(chunks)
+            search = lambda query: store.similarity_search(query, k=k)
+        else:
+            raise ValueError(f"Invalid retrieval: {retrieval}, please use bm25 or vector")
+        result[f"{retrieval}_index_s"] = time.perf_counter() - start
+        hits = 0
+        for query in queries:
+            hits += any(query in _compact(document.page_content) for document in search(query))
+        result[f"{retrieval}_hit@{k}"] = hits / len(queries)
+    return result
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="文本切分基准测试")
+    parser.add_argument("project", help="项目名")
+    parser.add_argument("--kb", default="project_documents", choices=["project_documents", "context_documents", "knowledge_documents"])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--chunkers", default="character,chinese")
+    parser.add_argument("--retrieval", default="bm25", help="bm25、vector 或 bm25,vector")
+    parser.add_argument("--chunk-tokens", type=int, default=256, help="chinese 切分器的 token 预算")
+    args = parser.parse_args()
+    SPECS["chinese"]["chunk_tokens"] = args.chunk_tokens
+
+    config = get_config(args.project)
+    path = getattr(config, args.kb)
+    documents = load_sources(path)
+    queries = build_queries(documents, args.queries)
+    retrievals = [retrieval.strip() for retrieval in args.retrieval.split(",")]
+    embeddings = get_document_processor(path, getattr(config, "vector_store", None)).embeddings if "vector" in retrievals else None
+    print(f"原始文档：{len(documents)}个，查询：{len(queries)}个")
+    for name in args.chunkers.split(","):
+        name = name.strip()
+        try:
+            result = evaluate(SPECS[name], documents, queries, retrievals, embeddings, args.k)
+        except Exception as e:
+            print(f"{name:<10}评测失败: {e}")
+            continue
+        print(f"[{name}] 知识块 {result['chunks']} 个，平均 {result['avg_tokens']:.0f} tokens，最大 {result['max_tokens']} tokens，切分 {result['split_s']:.2f} 秒，可命中上限 {result['coverable']:.2f}")
+        for retrieval in retrievals:
+            print(f"    {retrieval:<7}索引 {result[f'{retrieval}_index_s']:.2f} 秒，Hit@{args.k} {result[f'{retrieval}_hit@{args.k}']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
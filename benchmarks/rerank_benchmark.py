@@ -0,0 +1,149 @@
+"""
+重排序基准测试
+对比本地重排序器与远程重排序器的延迟与排序质量
+
+评测方法：
+- 默认（遮蔽模式）：从知识库中随机抽取知识块，取其中一句作为查询，并从目标知识块中删去这句，
+  查询文本不会原样出现在目标中；以向量检索结果（不可用时退化为随机抽样）作为干扰候选，统计目标在重排结果中的位置。
+- --queries：使用人工编写的问题集（JSONL，每行 {"query": 问题, "target": 答案所在知识块中的一段原文}），
+  以包含 target 的知识块为目标，查询与目标之间没有复制关系，结果最可信。
+
+用法：
+    python -m benchmarks.rerank_benchmark <项目名> [--kb project_documents] [--samples 50] [--rerankers local,remote] [--queries questions.jsonl]
+"""
+from dotenv import load_dotenv
+from config.project_config import get_config
+from rag.processors import get_document_processor
+from rag.rerankers import get_reranker
+from langchain_core.documents import Document
+import argparse
+import json
+import random
+import re
+import statistics
+import time
+
+
+_SENTENCE_PATTERN = re.compile(r"[^。！？!?\n]+[。！？!?]?")
+BIAS_NOTE = ("注意：遮蔽模式的查询句取自目标知识块的上下文，与目标仍可能共享人名、地名等专有词，"
+             "基于字符 n-gram 的本地重排序器可能因此偏高；使用 --queries 提供人工编写的问题可消除这一偏差。")
+
+
+def _load_documents(processor):
+    data = processor.get_vector_store().get(include=["documents", "metadatas"])
+    documents = [
+        Document(page_content=text, metadata=metadata or {})
+        for text, metadata in zip(data["documents"], data["metadatas"]) if text and len(text.strip()) >= 20
+    ]
+    if len(documents) < 2:
+        raise ValueError("知识库中的知识块数量不足，无法评测")
+    return documents
+
+
+def _candidate_pool(processor, documents, query, target, candidates, rng, source=None):
+    """干扰候选：排除原知识块以及原样包含查询的知识块（如切分重叠的相邻块），再随机插入目标"""
+    try:
+        pool = processor.get_vector_store().similarity_search(query, k=candidates + 5)
+    except Exception:
+        pool = rng.sample(documents, min(candidates + 5, len(documents)))
+    pool = [
+        document for document in pool
+        if document.page_content not in (target.page_content, source) and query not in document.page_content
+    ][:candidates - 1]
+    pool.insert(rng.randint(0, len(pool)), target)
+    return pool
+
+
+def build_cases(processor, samples=50, candidates=20, seed=42):
+    """构建遮蔽模式的评测用例：(查询, 候选文档列表, 目标文本)，查询句已从目标中删去"""
+    rng = random.Random(seed)
+    documents = _load_documents(processor)
+
+    cases = []
+    eligible = []
+    for document in documents:
+        sentences = [sentence.strip() for sentence in _SENTENCE_PATTERN.findall(document.page_content) if sentence.strip()]
+        if len(sentences) >= 3 and any(len(sentence) >= 8 for sentence in sentences):
+            eligible.append((document, sentences))
+    for document, sentences in rng.sample(eligible, min(samples, len(eligible))):
+        query = rng.choice([sentence for sentence in sentences if len(sentence) >= 8])
+        masked = "".join(sentence for sentence in sentences if sentence != query)
+        target = Document(page_content=masked, metadata=document.metadata)
+        pool = _candidate_pool(processor, documents, query, target, candidates, rng, document.page_content)
+        cases.append((query, pool, target.page_content))
+    return cases
+
+
+def load_cases(processor, path, candidates=20, seed=42):
+    """从人工编写的问题集构建评测用例，target 未匹配到任何知识块的问题会被跳过"""
+    rng = random.Random(seed)
+    documents = _load_documents(processor)
+    cases = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            target = next((document for document in documents if item["target"] in document.page_content), None)
+            if target is None:
+                print(f"跳过未找到目标知识块的问题: {item['query']}")
+                continue
+            pool = _candidate_pool(processor, documents, item["query"], target, candidates, rng)
+            cases.append((item["query"], pool, target.page_content))
+    return cases
+
+
+def evaluate(reranker, cases):
+    """返回平均延迟、P95 延迟、MRR 与 Hit@1/Hit@3"""
+    latencies = []
+    reciprocal_ranks = []
+    for query, pool, target in cases:
+        start = time.perf_counter()
+        ranked = list(reranker.compress_documents(pool, query))
+        latencies.append((time.perf_counter() - start) * 1000)
+        texts = [document.page_content for document in ranked]
+        reciprocal_ranks.append(1.0 / (texts.index(target) + 1) if target in texts else 0.0)
+    latencies.sort()
+    return {
+        "latency_ms": statistics.mean(latencies),
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0],
+        "mrr": statistics.mean(reciprocal_ranks),
+        "hit@1": sum(rr == 1.0 for rr in reciprocal_ranks) / len(reciprocal_ranks),
+        "hit@3": sum(rr >= 1 / 3 for rr in reciprocal_ranks) / len(reciprocal_ranks),
+    }
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="重排序基准测试")
+    parser.add_argument("project", help="项目名")
+    parser.add_argument("--kb", default="project_documents", choices=["project_documents", "context_documents", "knowledge_documents"])
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--rerankers", default="local,remote")
+    parser.add_argument("--queries", default=None, help="人工编写的问题集 JSONL，每行 {\"query\": ..., \"target\": ...}")
+    args = parser.parse_args()
+
+    config = get_config(args.project)
+    processor = get_document_processor(getattr(config, args.kb), getattr(config, "vector_store", None))
+    if args.queries:
+        cases = load_cases(processor, args.queries, args.candidates)
+    else:
+        cases = build_cases(processor, args.samples, args.candidates)
+    if not cases:
+        raise ValueError("没有可用的评测用例")
+    print(f"评测用例：{len(cases)}个（{'问题集' if args.queries else '遮蔽模式'}），每个用例最多{args.candidates}个候选")
+    if not args.queries:
+        print(BIAS_NOTE)
+    print(f"{'reranker':<10}{'avg(ms)':>10}{'p95(ms)':>10}{'MRR':>8}{'Hit@1':>8}{'Hit@3':>8}")
+    for kind in args.rerankers.split(","):
+        try:
+            result = evaluate(get_reranker(kind.strip()), cases)
+        except Exception as e:
+            print(f"{kind:<10}评测失败: {e}")
+            continue
+        print(f"{kind:<10}{result['latency_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['mrr']:>8.3f}{result['hit@1']:>8.2f}{result['hit@3']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
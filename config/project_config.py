@@ -73,7 +73,8 @@ def create_new_project(project, pd="", cd="", kd=""):
             data = {
                     "project_documents": pd,
                     "context_documents": cd,
-                    "knowledge_documents": kd
+                    "knowledge_documents": kd,
+                    "vector_store": "chroma"
                 }
             yaml.dump(data, f, allow_unicode=True)
     except Exception as e:
@@ -140,4 +141,13 @@ def delete_project(project):
     except Exception as e:
         print(f"[ERROR] Encounter error {e} while delete file .db/{project}_record_manager_cache.db")
         return False
+
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(f".db/{project}_checkpoints.db{suffix}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[ERROR] Encounter error {e} while delete file .db/{project}_checkpoints.db{suffix}")
+            return False
     return True
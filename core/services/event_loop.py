@@ -0,0 +1,37 @@
+"""
+进程级后台事件循环
+所有异步工作流在同一个事件循环上运行，使共享的异步 HTTP 连接池与并发信号量在多次点击之间保持有效
+"""
+from concurrent.futures import Future
+from threading import Lock, Thread
+import asyncio
+
+
+_loop = None
+_lock = Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """获取（必要时启动）后台事件循环"""
+    global _loop
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            Thread(target=_loop.run_forever, name="novel-event-loop", daemon=True).start()
+        return _loop
+
+
+def submit(coro) -> Future:
+    """将协程提交到后台事件循环，返回线程安全的 Future"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+def run_coroutine(coro, poll=None, interval=0.1):
+    """在后台事件循环上运行协程并阻塞等待结果，等待期间可周期性调用 poll 刷新界面"""
+    future = submit(coro)
+    while True:
+        try:
+            return future.result(timeout=interval)
+        except TimeoutError:
+            if poll:
+                poll()
@@ -0,0 +1,201 @@
+"""
+知识库后台索引服务
+监听项目的三个知识库目录，合并短时间内的连续变更后在后台线程中增量更新索引，
+并记录各知识库的新鲜度与滞后时间，界面只读取状态而不阻塞在索引上
+"""
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from rag.processors import get_document_processor
+from config.project_config import get_config
+from threading import Condition, Lock, Thread
+import os
+import time
+
+
+KNOWLEDGE_BASES = ("project_documents", "context_documents", "knowledge_documents")
+
+
+class _KnowledgeBaseHandler(FileSystemEventHandler):
+    """将目录内的文件变更转发给索引服务"""
+
+    def __init__(self, service, path):
+        self.service = service
+        self.path = path
+
+    def on_any_event(self, event):
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        if event.is_directory and event.event_type == "modified":
+            return
+        names = [os.path.basename(str(event.src_path))]
+        if getattr(event, "dest_path", ""):
+            names.append(os.path.basename(str(event.dest_path)))
+        # 隐藏文件与临时文件不会被索引
+        if all(name.startswith(".") or name.endswith("~") for name in names):
+            return
+        self.service.mark_dirty(self.path)
+
+
+class IndexingService():
+    """后台增量索引服务"""
+
+    def __init__(self, debounce=2.0):
+        self.debounce = debounce  # 秒，最后一次变更后静默该时长才开始索引
+        self._observer = None
+        self._watches = {}  # 知识库路径 -> watchdog 监听句柄
+        self._projects = {}  # 项目 -> 知识库路径列表
+        self._status = {}  # 知识库路径 -> 状态
+        self._vector_stores = {}  # 知识库路径 -> 向量库后端
+        self._lock = Lock()
+        self._condition = Condition(self._lock)
+        self._worker = None
+
+    def _ensure_started(self):
+        if self._observer is None:
+            self._observer = Observer()
+            self._observer.daemon = True
+            self._observer.start()
+        if self._worker is None:
+            self._worker = Thread(target=self._run, name="novel-indexing", daemon=True)
+            self._worker.start()
+
+    def watch_project(self, project):
+        """监听项目的全部知识库目录，重复调用无副作用；首次监听时补做一次增量索引"""
+        with self._lock:
+            if project in self._projects:
+                return
+        args = get_config(project)
+        paths = [getattr(args, name) for name in KNOWLEDGE_BASES]
+        with self._condition:
+            if project in self._projects:
+                return
+            self._ensure_started()
+            self._projects[project] = paths
+            for path in paths:
+                self._vector_stores[path] = getattr(args, "vector_store", None)
+            for path in paths:
+                if path in self._watches or not os.path.isdir(path):
+                    continue
+                self._watches[path] = self._observer.schedule(_KnowledgeBaseHandler(self, path), path, recursive=False) # type: ignore
+                self._status.setdefault(path, {
+                    "stale_since": None,  # 最早一次尚未索引完成的变更时间
+                    "pending_since": None,  # 最早一次尚未开始索引的变更时间
+                    "last_event": None,
+                    "last_indexed": None,
+                    "last_duration": None,
+                    "last_error": None,
+                    "indexing": False,
+                })
+            # 应用未运行期间的文件变更，依靠文件清单只解析变更文件
+            for path in paths:
+                if path in self._watches:
+                    self._mark_dirty_locked(path, delay=False)
+
+    def unwatch_project(self, project):
+        """停止监听项目，删除项目前调用"""
+        with self._condition:
+            paths = self._projects.pop(project, [])
+            in_use = {path for others in self._projects.values() for path in others}
+            for path in paths:
+                if path in in_use or path not in self._watches:
+                    continue
+                self._observer.unschedule(self._watches.pop(path)) # type: ignore
+                self._status.pop(path, None)
+
+    def mark_dirty(self, path):
+        """记录知识库发生变更，连续变更在防抖时间内合并为一次索引"""
+        with self._condition:
+            self._mark_dirty_locked(path)
+
+    def request_update(self, project):
+        """立即安排项目全部知识库的增量更新，不等待完成"""
+        self.watch_project(project)
+        with self._condition:
+            for path in self._projects.get(project, []):
+                if path in self._status:
+                    self._mark_dirty_locked(path, delay=False)
+
+    def _mark_dirty_locked(self, path, delay=True):
+        status = self._status.get(path)
+        if status is None:
+            return
+        now = time.time()
+        status["last_event"] = now if delay else now - self.debounce
+        if status["pending_since"] is None:
+            status["pending_since"] = now
+        if status["stale_since"] is None:
+            status["stale_since"] = now
+        self._condition.notify()
+
+    def _next_ready(self):
+        """返回已过防抖时间的知识库路径，以及距离下一个到期的等待时长"""
+        now = time.time()
+        wait = None
+        for path, status in self._status.items():
+            if status["pending_since"] is None or status["indexing"]:
+                continue
+            remaining = status["last_event"] + self.debounce - now
+            if remaining <= 0:
+                return path, None
+            wait = remaining if wait is None else min(wait, remaining)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._condition:
+                path, wait = self._next_ready()
+                while path is None:
+                    self._condition.wait(wait)
+                    path, wait = self._next_ready()
+                status = self._status[path]
+                status["indexing"] = True
+                status["pending_since"] = None
+            start = time.time()
+            error = None
+            try:
+                get_document_processor(path, self._vector_stores.get(path)).update()
+            except Exception as e:
+                error = str(e)
+                print(f"后台索引 {path} 失败: {e}")
+            with self._condition:
+                status["indexing"] = False
+                status["last_duration"] = time.time() - start
+                status["last_error"] = error
+                if error is None:
+                    status["last_indexed"] = start
+                    # 索引期间又有新的变更时，仍视为滞后
+                    status["stale_since"] = status["pending_since"]
+
+    def status(self, project):
+        """返回项目各知识库的索引状态：是否最新、滞后秒数、上次索引时间与错误"""
+        now = time.time()
+        with self._lock:
+            paths = self._projects.get(project, [])
+            results = {}
+            for name, path in zip(KNOWLEDGE_BASES, paths):
+                status = self._status.get(path)
+                if status is None:
+                    continue
+                stale_since = status["stale_since"]
+                results[name] = {
+                    **status,
+                    "path": path,
+                    "fresh": stale_since is None and not status["indexing"],
+                    "lag": now - stale_since if stale_since is not None else 0.0,
+                }
+            return results
+
+
+_service = None
+_service_lock = Lock()
+
+
+def get_indexing_service():
+    """获取进程内共享的索引服务，INDEX_WATCH_ENABLED=false 时返回 None"""
+    global _service
+    if os.getenv("INDEX_WATCH_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    with _service_lock:
+        if _service is None:
+            _service = IndexingService(debounce=float(os.getenv("INDEX_DEBOUNCE_SECONDS", 2)))
+        return _service
@@ -0,0 +1,263 @@
+"""
+后台任务队列
+知识库更新、大纲、细纲与章节生成作为任务提交到进程内的工作线程池执行，任务状态、进度与结果持久化到 SQLite，
+页面只负责提交任务与轮询状态：脚本重跑或刷新浏览器不会中断任务，并发数由 JOB_WORKERS 全局控制
+"""
+from concurrent.futures import ThreadPoolExecutor
+from core.services.event_loop import run_coroutine
+from threading import Lock
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled", "interrupted")
+STREAM_WRITE_INTERVAL = 0.5  # 秒
+
+
+class JobCancelled(BaseException):
+    """任务被取消
+
+    继承 BaseException 而非 Exception：取消会在流式回调等模型调用内部抛出，
+    生成器与工作流中按 Exception 捕获的重试逻辑不会把它当作普通失败吞掉后继续请求模型。
+    """
+
+
+class JobContext():
+    """任务执行上下文：向处理函数提供进度、状态与中间结果的上报，并在上报时检查取消"""
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+
+    def check(self):
+        if self.queue.is_cancelled(self.job_id):
+            raise JobCancelled(self.job_id)
+
+    def progress(self, value):
+        self.check()
+        self.queue._update(self.job_id, progress=float(value))
+
+    def status(self, message):
+        self.check()
+        self.queue._update(self.job_id, message=message)
+
+    def partial(self, result):
+        """写入中间结果，页面轮询时即可展示已完成的部分"""
+        self.check()
+        self.queue._update(self.job_id, result=json.dumps(result, ensure_ascii=False))
+
+
+def _workflow(params):
+    from core.workflows.novel_workflow import get_workflow
+    return get_workflow(params["project"], **params.get("models", {}))
+
+
+def _run_update(params, context):
+    context.status("正在更新知识库...")
+    _workflow(params).update()
+    return None
+
+
+def _run_outlines(params, context):
+    outline_str, outline_list = run_coroutine(_workflow(params).agenerate_outlines(params["inputs"], context.progress))
+    return {"text": outline_str, "list": outline_list}
+
+
+def _run_detailed_outlines(params, context):
+    detailed_outline_str, detailed_outline_list = run_coroutine(_workflow(params).agenerate_detailed_outlines(params["inputs"], context.progress))
+    return {"text": detailed_outline_str, "list": detailed_outline_list}
+
+
+def _run_novels(params, context):
+    """生成章节；params 带 resume_run_id 时从该运行的检查点继续，新运行以任务 id 作为检查点运行 id"""
+    from core.workflows.checkpoints import get_checkpoint_store
+    chapters = []
+    last_write = 0.0
+    run_id = params.get("resume_run_id")
+    # start 为本次第一个新章节的序号；此前完成的章节留在检查点中，由页面写回时按 run_id 读取，不随进度反复写入任务
+    run = get_checkpoint_store(params["project"]).get_run(run_id) if run_id else None
+    state = {"run_id": run_id or context.job_id, "start": (run["completed"] if run else 0) + 1}
+
+    def stream(i, text):
+        # 流式文本更新频繁，限制写库频率
+        nonlocal last_write
+        now = time.monotonic()
+        if now - last_write >= STREAM_WRITE_INTERVAL:
+            last_write = now
+            context.partial({**state, "chapters": chapters, "streaming": text})
+
+    workflow = _workflow(params)
+    stream_callback = stream if params.get("stream", True) else None
+    pipelined = params.get("pipelined", False)
+    if run_id:
+        novels = workflow.resume_novels(run_id, context.progress, context.status, pipelined=pipelined, stream_callback=stream_callback)
+    else:
+        novels = workflow.generate_novels(params["inputs"], context.progress, context.status, pipelined=pipelined, stream_callback=stream_callback, run_id=context.job_id)
+    for content in novels:
+        chapters.append(content or "")
+        context.partial({**state, "chapters": chapters})
+    return {**state, "chapters": chapters}
+
+
+HANDLERS = {
+    "update": _run_update,
+    "outlines": _run_outlines,
+    "detailed_outlines": _run_detailed_outlines,
+    "novels": _run_novels,
+}
+
+
+class JobQueue():
+    """持久化的后台任务队列"""
+
+    def __init__(self, path=".db/jobs.db", workers=2):
+        self.path = path
+        self.workers = workers
+        self._lock = Lock()
+        self._cancelled = set()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    project TEXT,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_project ON jobs (project, created_at)")
+            # 上次进程退出时未完成的任务无法继续执行，标记为已中断
+            conn.execute(
+                "UPDATE jobs SET status = 'interrupted', finished_at = ?, message = '应用重启，任务已中断' WHERE status IN ('queued', 'running')",
+                (time.time(),),
+            )
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="novel-job")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _update(self, job_id, **fields):
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def submit(self, kind, params, project=None) -> str:
+        """提交任务，返回任务 id；params 需可 JSON 序列化"""
+        if kind not in HANDLERS:
+            raise ValueError(f"Invalid job kind: {kind}, please use one of {', '.join(HANDLERS)}")
+        job_id = uuid.uuid4().hex
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, project, kind, params, status, created_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, project, kind, json.dumps(params, ensure_ascii=False), time.time()),
+            )
+        self._executor.submit(self._execute, job_id, kind, params)
+        return job_id
+
+    def _execute(self, job_id, kind, params):
+        if self.is_cancelled(job_id):
+            with self._lock:
+                self._cancelled.discard(job_id)
+            return
+        self._update(job_id, status="running", started_at=time.time())
+        context = JobContext(self, job_id)
+        try:
+            result = HANDLERS[kind](params, context)
+        except JobCancelled:
+            self._update(job_id, status="cancelled", finished_at=time.time(), message="任务已取消")
+        except Exception as e:
+            print(f"任务 {kind}/{job_id} 执行失败: {e}")
+            self._update(job_id, status="failed", finished_at=time.time(), error=str(e))
+        else:
+            self._update(
+                job_id,
+                status="succeeded",
+                progress=1.0,
+                finished_at=time.time(),
+                result=json.dumps(result, ensure_ascii=False) if result is not None else None,
+            )
+        finally:
+            with self._lock:
+                self._cancelled.discard(job_id)
+
+    def cancel(self, job_id):
+        """取消任务：排队中的任务直接取消，运行中的任务在下一次上报进度时停止"""
+        with self._lock:
+            self._cancelled.add(job_id)
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE jobs SET status = 'cancelled', finished_at = ?, message = '任务已取消' WHERE id = ? AND status = 'queued'",
+                    (time.time(), job_id),
+                )
+
+    def is_cancelled(self, job_id) -> bool:
+        with self._lock:
+            return job_id in self._cancelled
+
+    def _row(self, row):
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["finished"] = job["status"] in FINISHED_STATUSES
+        return job
+
+    def get(self, job_id):
+        """返回任务详情，不存在时返回 None"""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def list_jobs(self, project=None, kind=None, limit=20):
+        """按提交时间倒序列出任务"""
+        conditions = []
+        values = []
+        if project is not None:
+            conditions.append("project = ?")
+            values.append(project)
+        if kind is not None:
+            conditions.append("kind = ?")
+            values.append(kind)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(f"SELECT * FROM jobs {where} ORDER BY created_at DESC LIMIT ?", (*values, limit)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def active_jobs(self, project=None):
+        """返回排队中与运行中的任务"""
+        return [job for job in self.list_jobs(project, limit=100) if not job["finished"]]
+
+    def purge(self, older_than=7 * 24 * 3600):
+        """删除早于指定秒数的已结束任务"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"DELETE FROM jobs WHERE status IN ({', '.join('?' * len(FINISHED_STATUSES))}) AND finished_at < ?",
+                (*FINISHED_STATUSES, time.time() - older_than),
+            )
+
+
+_queue = None
+_queue_lock = Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """获取进程内共享的任务队列，首次调用时清理上次运行遗留的未完成任务"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(os.getenv("JOBS_DB_PATH", ".db/jobs.db"), workers=int(os.getenv("JOB_WORKERS", 2)))
+            _queue.purge(float(os.getenv("JOB_RETENTION_DAYS", 7)) * 24 * 3600)
+        return _queue
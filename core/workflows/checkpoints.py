@@ -0,0 +1,177 @@
+"""
+章节生成检查点
+批量生成章节时每完成一章即写入项目的 SQLite 检查点：章节正文、缩写、实际使用的大纲、检索上下文与剧情记忆，
+会话中断或模型调用彻底失败后可从最后完成的章节继续生成，已完成的章节不再重复调用模型
+"""
+from threading import Lock
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+
+class CheckpointStore():
+    """项目的章节生成检查点"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    inputs TEXT NOT NULL,
+                    global_context TEXT,
+                    total_chapters INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS chapters (
+                    run_id TEXT NOT NULL,
+                    chapter INTEGER NOT NULL,
+                    outline TEXT,
+                    next_outline TEXT,
+                    content TEXT NOT NULL,
+                    summary TEXT, -- 本章的缩写
+                    context TEXT,
+                    memory TEXT,
+                    stats TEXT,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (run_id, chapter)
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def start_run(self, inputs, global_context, run_id=None) -> str:
+        """记录一次批量生成的输入与全局检索结果，返回运行 id"""
+        run_id = run_id or uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO runs (id, status, inputs, global_context, total_chapters, created_at, updated_at) VALUES (?, 'running', ?, ?, ?, ?, ?)",
+                (run_id, json.dumps(inputs, ensure_ascii=False), json.dumps(global_context, ensure_ascii=False),
+                 len(inputs.get("generated_outlines", [])), now, now),
+            )
+        return run_id
+
+    def save_chapter(self, run_id, chapter, outline, next_outline, content, context, memory, stats=None):
+        """写入一章的检查点；本章缩写在生成下一章时才得到，由 save_summary 补写"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chapters (run_id, chapter, outline, next_outline, content, context, memory, stats, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, chapter, outline, next_outline, content,
+                 json.dumps(context, ensure_ascii=False), json.dumps(memory, ensure_ascii=False),
+                 json.dumps(stats or {}, ensure_ascii=False), now),
+            )
+            conn.execute("UPDATE runs SET status = 'running', updated_at = ? WHERE id = ?", (now, run_id))
+
+    def save_summary(self, run_id, before_chapter, summary):
+        """将缩写写入第 before_chapter 章之前最后一个已完成章节的检查点"""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE chapters SET summary = ? WHERE run_id = ? AND chapter = "
+                "(SELECT MAX(chapter) FROM chapters WHERE run_id = ? AND chapter < ?)",
+                (summary, run_id, run_id, before_chapter),
+            )
+
+    def finish_run(self, run_id, status="completed"):
+        """标记运行结束：completed 或 failed（可继续）"""
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE runs SET status = ?, updated_at = ? WHERE id = ?", (status, time.time(), run_id))
+
+    def _run(self, row):
+        run = dict(row)
+        run["inputs"] = json.loads(run["inputs"])
+        run["global_context"] = json.loads(run["global_context"]) if run["global_context"] else {}
+        return run
+
+    def get_run(self, run_id):
+        """返回运行信息及已完成的章节数，不存在时返回 None"""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(
+                "SELECT runs.*, COUNT(chapters.chapter) AS completed, MAX(chapters.chapter) AS last_chapter "
+                "FROM runs LEFT JOIN chapters ON chapters.run_id = runs.id WHERE runs.id = ? GROUP BY runs.id",
+                (run_id,),
+            ).fetchone()
+        return self._run(row) if row else None
+
+    def list_runs(self, resumable=False, limit=20, order="updated_at"):
+        """按更新时间（或 order 指定的时间）倒序列出运行；resumable 为 True 时只列出未完成的运行"""
+        where = "WHERE runs.status != 'completed'" if resumable else ""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT runs.*, COUNT(chapters.chapter) AS completed, MAX(chapters.chapter) AS last_chapter "
+                f"FROM runs LEFT JOIN chapters ON chapters.run_id = runs.id {where} "
+                f"GROUP BY runs.id ORDER BY runs.{order} DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [self._run(row) for row in rows]
+
+    def latest_resumable_run(self):
+        """最近开始的一次运行未完成时返回该运行；更早的未完成运行已被之后的运行取代，不再提供继续"""
+        runs = self.list_runs(limit=1, order="created_at")
+        return runs[0] if runs and runs[0]["status"] != "completed" else None
+
+    def chapters(self, run_id):
+        """按章节顺序返回运行中已完成的全部检查点"""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT * FROM chapters WHERE run_id = ? ORDER BY chapter", (run_id,)).fetchall()
+        checkpoints = []
+        for row in rows:
+            checkpoint = dict(row)
+            for key in ("context", "memory", "stats"):
+                checkpoint[key] = json.loads(checkpoint[key]) if checkpoint[key] else None
+            checkpoints.append(checkpoint)
+        return checkpoints
+
+    def last_checkpoint(self, run_id):
+        """运行中最后完成的章节检查点，没有时返回 None"""
+        checkpoints = self.chapters(run_id)
+        return checkpoints[-1] if checkpoints else None
+
+    def delete_run(self, run_id):
+        """删除运行及其全部检查点，用于放弃不再继续的运行"""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM chapters WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM runs WHERE id = ?", (run_id,))
+
+    def purge(self, older_than=7 * 24 * 3600):
+        """删除超过指定秒数未更新的运行及其检查点"""
+        cutoff = time.time() - older_than
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM chapters WHERE run_id IN (SELECT id FROM runs WHERE updated_at < ?)", (cutoff,))
+            conn.execute("DELETE FROM runs WHERE updated_at < ?", (cutoff,))
+
+
+_stores = {}
+_stores_lock = Lock()
+
+
+def get_checkpoint_store(project) -> CheckpointStore:
+    """获取项目共享的检查点存储，首次打开时清理超过保留期的运行"""
+    with _stores_lock:
+        store = _stores.get(project)
+        if store is None:
+            store = CheckpointStore(f".db/{project}_checkpoints.db")
+            store.purge(float(os.getenv("CHECKPOINT_RETENTION_DAYS", 7)) * 24 * 3600)
+            _stores[project] = store
+        return store
+
+
+def release_checkpoint_store(project):
+    """释放项目的检查点存储，删除项目前调用"""
+    with _stores_lock:
+        _stores.pop(project, None)
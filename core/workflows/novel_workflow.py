@@ -8,20 +8,40 @@ from llm.generators.detailed_outline_generator import DetailedOutlineGenerator
 from llm.generators.queries_extractor import QueriesExtractor
 from llm.generators.content_shorter import ContentShorter
 from rag.retrievers import Retriever
+from rag.processors import release_document_processors
+from core.services.indexing_service import get_indexing_service
+from core.workflows.story_memory import StoryMemory
+from core.workflows.checkpoints import get_checkpoint_store, release_checkpoint_store
 from config.project_config import get_config
 from threading import Thread, Lock
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from langchain_core.exceptions import OutputParserException
+import asyncio
 import copy
+import json
+import time
 
 
 from llm.generators.query_rewriter import QueryRewriter
 
+
+CHAPTER_RETRIES = 3  # 每章正文生成的最多尝试次数
+
+
+class ChapterGenerationError(RuntimeError):
+    """章节重试后仍生成失败，此前完成的章节已写入检查点，可通过 resume_novels 从失败的章节继续"""
+
+    def __init__(self, run_id, chapter, message):
+        super().__init__(message)
+        self.run_id = run_id
+        self.chapter = chapter
+
+
 class NovelWorkflow:
     """小说生成工作流"""
     
     def __init__(self, config_path, model=None, model_provider=None, extractor_model=None, 
                  short_model=None, special_model_provider=None, model_kwargs={}):
+        self.project = config_path
         self.args = get_config(config_path)
         self.query_rewriter = None
         
@@ -41,16 +61,19 @@ class NovelWorkflow:
                 self.extractor = QueriesExtractor(model, model_provider, {"temperature": 0.5})
                 self.shorter = ContentShorter(model, model_provider, {"temperature": 0.5})
         
-        # 将rewriter传入retriever
-        self.project_retriever = Retriever(self.args.project_documents, query_rewriter=self.query_rewriter)
-        self.knowledge_retriever = Retriever(self.args.knowledge_documents, query_rewriter=self.query_rewriter)
-        self.context_retriever = Retriever(self.args.context_documents, query_rewriter=self.query_rewriter)
+        # 将rewriter传入retriever；向量库后端由项目配置 vector_store 指定，缺省为 chroma
+        vector_store = getattr(self.args, "vector_store", None)
+        self.project_retriever = Retriever(self.args.project_documents, query_rewriter=self.query_rewriter, vector_store=vector_store)
+        self.knowledge_retriever = Retriever(self.args.knowledge_documents, query_rewriter=self.query_rewriter, vector_store=vector_store)
+        self.context_retriever = Retriever(self.args.context_documents, query_rewriter=self.query_rewriter, vector_store=vector_store)
 
     def update(self):
         """更新所有检索器"""
         self.project_retriever.update()
         self.knowledge_retriever.update()
         self.context_retriever.update()
+        # 其他缓存的工作流可能仍持有旧的检索链，统一失效
+        invalidate_workflows(self.project)
 
     def retrieve_infos(self, inputs):
         """检索相关信息"""
@@ -61,6 +84,15 @@ class NovelWorkflow:
         print("检索完成")
         return query_results
 
+    async def aretrieve_infos(self, inputs):
+        """异步检索相关信息"""
+        print("开始提取检索关键词...")
+        queries = await self.extractor.ainvoke(inputs)
+        print("检索关键词提取完成")
+        query_results = await self.aquery_context(queries)
+        print("检索完成")
+        return query_results
+
     def query_single(self, retriever: Retriever, queries: list, results: dict, key: str):
         """单个检索任务"""
         try:
@@ -70,15 +102,30 @@ class NovelWorkflow:
             print(f"[ERROR] 检索任务 {key} 失败: {e}")
             results.update({key: []})
 
+    def query_grouped(self, retriever: Retriever, named_queries: dict, results: dict):
+        """分组检索任务，同一知识库的多类查询合并为一次检索"""
+        try:
+            results.update(retriever.invoke_grouped(named_queries))
+        except Exception as e:
+            print(f"[ERROR] 检索任务 {'/'.join(named_queries)} 失败: {e}")
+            results.update({key: [] for key in named_queries})
+
+    def _project_queries(self, inputs):
+        """项目设定知识库的三类查询"""
+        return {
+            "outline_settings": inputs.get("outline_queries", []),
+            "character_settings": inputs.get("character_queries", []),
+            "equipment_settings": inputs.get("equipment_queries", []),
+        }
+
     def query_context(self, inputs):
         """并行检索上下文信息"""
         results = {}
-        outline_thread = Thread(target=self.query_single, args=[self.project_retriever, inputs.get("outline_queries", []), results, "outline_settings"])
-        character_thread = Thread(target=self.query_single, args=[self.project_retriever, inputs.get("character_queries", []), results, "character_settings"])
+        # 大纲、角色、装备三类查询都面向项目知识库，合并为一次去重检索
+        project_thread = Thread(target=self.query_grouped, args=[self.project_retriever, self._project_queries(inputs), results])
         knowledge_thread = Thread(target=self.query_single, args=[self.knowledge_retriever, inputs.get("knowledge_queries", []), results, "knowledge_context"])
         previous_thread = Thread(target=self.query_single, args=[self.context_retriever, inputs.get("context_queries", []), results, "previous_content"])
-        equipment_thread = Thread(target=self.query_single, args=[self.project_retriever, inputs.get("equipment_queries", []), results, "equipment_settings"])
-        threads = [outline_thread, character_thread, knowledge_thread, previous_thread, equipment_thread]
+        threads = [project_thread, knowledge_thread, previous_thread]
         for thread in threads:
             thread.start()
         for thread in threads:
@@ -91,6 +138,33 @@ class NovelWorkflow:
                 
         return results
 
+    async def aquery_single(self, retriever: Retriever, queries: list, key: str):
+        """单个异步检索任务"""
+        try:
+            return {key: await retriever.ainvoke(queries)}
+        except Exception as e:
+            print(f"[ERROR] 检索任务 {key} 失败: {e}")
+            return {key: ""}
+
+    async def aquery_grouped(self, retriever: Retriever, named_queries: dict):
+        """异步分组检索任务"""
+        try:
+            return await retriever.ainvoke_grouped(named_queries)
+        except Exception as e:
+            print(f"[ERROR] 检索任务 {'/'.join(named_queries)} 失败: {e}")
+            return {key: "" for key in named_queries}
+
+    async def aquery_context(self, inputs):
+        """异步并发检索上下文信息"""
+        results = {}
+        for result in await asyncio.gather(
+            self.aquery_grouped(self.project_retriever, self._project_queries(inputs)),
+            self.aquery_single(self.knowledge_retriever, inputs.get("knowledge_queries", []), "knowledge_context"),
+            self.aquery_single(self.context_retriever, inputs.get("context_queries", []), "previous_content"),
+        ):
+            results.update(result)
+        return results
+
     def generate_outlines(self, inputs: dict, progress_callback=None):
         """生成章节大纲"""
         if progress_callback:
@@ -107,8 +181,28 @@ class NovelWorkflow:
         if progress_callback:
             progress_callback(0.9)
         
-        # 格式化输出，添加章节编号
-        outline_list = outlines["outlines"]
+        return self._format_outlines(outlines["outlines"])
+
+    async def agenerate_outlines(self, inputs: dict, progress_callback=None):
+        """异步生成章节大纲"""
+        if progress_callback:
+            progress_callback(0.1)
+        
+        print("开始检索相关信息...")
+        query_results = await self.aretrieve_infos(inputs)
+        if progress_callback:
+            progress_callback(0.5)
+        
+        print("开始生成章节大纲...")
+        inputs.update(query_results)
+        outlines = await self.outlines_generator.ainvoke(inputs)
+        if progress_callback:
+            progress_callback(0.9)
+        
+        return self._format_outlines(outlines["outlines"])
+
+    def _format_outlines(self, outline_list):
+        """格式化输出，添加章节编号"""
         formatted_outlines = []
         for i, outline in enumerate(outline_list, 1):
             # 清理可能存在的章节标题前缀
@@ -137,6 +231,18 @@ class NovelWorkflow:
             print(f"生成第{index}章细纲失败: {e}")
             return index, None
 
+    def _detailed_outline_inputs(self, inputs, chapter_outline):
+        """构建单个章节细纲的输入"""
+        return {
+            "chapter_outline": chapter_outline,
+            "outline_settings": inputs.get("outline_settings", ""),
+            "character_settings": inputs.get("character_settings", ""),
+            "previous_content": inputs.get("previous_content", ""),
+            "knowledge_context": inputs.get("knowledge_context", ""),
+            "equipment_settings": inputs.get("equipment_settings", ""),
+            "temp_settings": inputs.get("temp_settings", "")
+        }
+
     def generate_detailed_outlines(self, inputs: dict, progress_callback=None):
         """生成细纲 (并行优化版)"""
         if progress_callback:
@@ -172,15 +278,7 @@ class NovelWorkflow:
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             future_to_index = {}
             for i, chapter_outline in enumerate(chapter_outlines, 1):
-                chapter_inputs = {
-                    "chapter_outline": chapter_outline,
-                    "outline_settings": inputs.get("outline_settings", ""),
-                    "character_settings": inputs.get("character_settings", ""),
-                    "previous_content": inputs.get("previous_content", ""),
-                    "knowledge_context": inputs.get("knowledge_context", ""),
-                    "equipment_settings": inputs.get("equipment_settings", ""),
-                    "temp_settings": inputs.get("temp_settings", "")
-                }
+                chapter_inputs = self._detailed_outline_inputs(inputs, chapter_outline)
                 future = executor.submit(self._generate_single_detailed_outline, chapter_inputs, i, total_chapters)
                 future_to_index[future] = i
 
@@ -198,7 +296,64 @@ class NovelWorkflow:
         if progress_callback:
             progress_callback(0.9)
         
-        # 格式化输出
+        return self._format_detailed_outlines(all_detailed_outlines)
+
+    async def _agenerate_single_detailed_outline(self, chapter_inputs, index, total_chapters):
+        """异步生成单个详细大纲"""
+        try:
+            print(f"正在生成第{index}/{total_chapters}章细纲...")
+            detailed_outline_result = await self.detailed_outline_generator.ainvoke(chapter_inputs)
+            return index, {
+                "chapter_outline": chapter_inputs["chapter_outline"],
+                "detailed_outlines": detailed_outline_result["detailed_outlines"]
+            }
+        except Exception as e:
+            print(f"生成第{index}章细纲失败: {e}")
+            return index, None
+
+    async def agenerate_detailed_outlines(self, inputs: dict, progress_callback=None):
+        """异步生成细纲，各章节通过 asyncio.gather 并发，并发数由 LLM 层共享信号量限制"""
+        if progress_callback:
+            progress_callback(0.05)
+        
+        chapter_outlines = inputs.get("chapter_outlines", [])
+        if not chapter_outlines:
+            raise ValueError("需要先生成章节大纲")
+        
+        print(f"开始为{len(chapter_outlines)}个章节生成细纲...")
+        if len(chapter_outlines) < 2:
+            print("[WARNING] 检测到的章节大纲数量少于2，可能生成了单一大块内容而不是分章大纲。")
+        
+        query_results = await self.aretrieve_infos(inputs)
+        inputs.update(query_results)
+        
+        if progress_callback:
+            progress_callback(0.15)
+        
+        total_chapters = len(chapter_outlines)
+        progress_per_chapter = 70 / total_chapters
+        completed_count = 0
+        all_detailed_outlines: list[dict | None] = [None] * total_chapters
+        
+        tasks = [
+            self._agenerate_single_detailed_outline(self._detailed_outline_inputs(inputs, chapter_outline), i, total_chapters)
+            for i, chapter_outline in enumerate(chapter_outlines, 1)
+        ]
+        for task in asyncio.as_completed(tasks):
+            index, result = await task
+            if result:
+                all_detailed_outlines[index-1] = result
+            completed_count += 1
+            if progress_callback:
+                progress_callback((15 + completed_count * progress_per_chapter) / 100)
+        
+        if progress_callback:
+            progress_callback(0.9)
+        
+        return self._format_detailed_outlines(all_detailed_outlines)
+
+    def _format_detailed_outlines(self, all_detailed_outlines):
+        """格式化细纲输出"""
         detailed_outline_str = ""
         valid_outlines = [item for item in all_detailed_outlines if item is not None]
         
@@ -213,137 +368,413 @@ class NovelWorkflow:
         print("细纲生成完成")
         return detailed_outline_str, valid_outlines
 
-    def generate_novels(self, inputs, progress_callback=None, status_callback=None):
-        """生成小说章节 (针对每个章节动态检索)"""
+    def _chapter_retrieval_inputs(self, inputs, local_outline):
+        """构建单个章节的检索输入"""
+        return {
+            "outlines_description": local_outline, # 使用本章大纲检索
+            "temp_settings": inputs.get("temp_settings", ""),
+            "user_input": inputs.get("user_input", "")
+        }
+
+    def _chapter_gen_inputs(self, inputs, chapter_context, next_outline, previous_content):
+        """构建单个章节的生成输入"""
+        gen_inputs = inputs.copy()
+        gen_inputs.update(chapter_context) # 更新为当前章节的上下文
+        gen_inputs["local_outline"] = next_outline
+        gen_inputs["previous_content"] = previous_content
+        return gen_inputs
+
+    def _timed_retrieve(self, inputs, local_outline):
+        """执行单个章节的检索并计时"""
+        start = time.perf_counter()
+        results = self.retrieve_infos(self._chapter_retrieval_inputs(inputs, local_outline))
+        return results, time.perf_counter() - start
+
+    async def _atimed_retrieve(self, inputs, local_outline):
+        """异步执行单个章节的检索并计时"""
+        start = time.perf_counter()
+        results = await self.aretrieve_infos(self._chapter_retrieval_inputs(inputs, local_outline))
+        return results, time.perf_counter() - start
+
+    def _report_pipeline(self, stats, status_callback=None):
+        """汇报检索与生成的重叠情况"""
+        overlap = max(stats["retrieval_time"] - stats["wait_time"], 0.0)
+        stats["overlap_time"] = overlap
+        stats["overlap_ratio"] = overlap / stats["retrieval_time"] if stats["retrieval_time"] else 0.0
+        self.last_pipeline_stats = stats
+        if not stats["pipelined"]:
+            return
+        message = (f"⏱️ 流水线检索：共{stats['chapters']}章，检索耗时{stats['retrieval_time']:.1f}s，"
+                   f"其中{overlap:.1f}s与正文生成重叠 ({stats['overlap_ratio'] * 100:.0f}%)")
+        print(message)
+        if status_callback:
+            status_callback(message)
+
+    def _chapter_retrievals(self, inputs, local_outlines, pipelined=False, status_callback=None, start=1):
+        """逐章返回检索结果（从第 start 章开始）；流水线模式下返回第N章结果后立即在后台检索第N+1章"""
+        chapters = [(i, outline) for i, outline in enumerate(local_outlines, 1) if outline and i >= start]
+        total_chapters = len(local_outlines)
+        stats = {"pipelined": pipelined, "chapters": 0, "retrieval_time": 0.0, "wait_time": 0.0}
+        prefetcher = ThreadPoolExecutor(max_workers=1) if pipelined else None
+        future = None
+        try:
+            for index, (i, local_outline) in enumerate(chapters):
+                if status_callback:
+                    status_callback(f"🔍 第 {i}/{total_chapters} 章：正在检索相关信息...")
+                print(f"第{i}章：执行动态检索...")
+                wait_start = time.perf_counter()
+                if future is None:
+                    chapter_query_results, elapsed = self._timed_retrieve(inputs, local_outline)
+                else:
+                    chapter_query_results, elapsed = future.result()
+                stats["wait_time"] += time.perf_counter() - wait_start
+                stats["retrieval_time"] += elapsed
+                stats["chapters"] += 1
+                
+                future = None
+                if prefetcher and index + 1 < len(chapters):
+                    future = prefetcher.submit(self._timed_retrieve, inputs, chapters[index + 1][1])
+                yield i, local_outline, chapter_query_results
+        finally:
+            if prefetcher:
+                prefetcher.shutdown(wait=False, cancel_futures=True)
+            self._report_pipeline(stats, status_callback)
+
+    async def _achapter_retrievals(self, inputs, local_outlines, pipelined=False, status_callback=None, start=1):
+        """_chapter_retrievals 的异步版本，预取通过后台任务完成"""
+        chapters = [(i, outline) for i, outline in enumerate(local_outlines, 1) if outline and i >= start]
+        total_chapters = len(local_outlines)
+        stats = {"pipelined": pipelined, "chapters": 0, "retrieval_time": 0.0, "wait_time": 0.0}
+        task = None
+        try:
+            for index, (i, local_outline) in enumerate(chapters):
+                if status_callback:
+                    status_callback(f"🔍 第 {i}/{total_chapters} 章：正在检索相关信息...")
+                wait_start = time.perf_counter()
+                if task is None:
+                    chapter_query_results, elapsed = await self._atimed_retrieve(inputs, local_outline)
+                else:
+                    chapter_query_results, elapsed = await task
+                stats["wait_time"] += time.perf_counter() - wait_start
+                stats["retrieval_time"] += elapsed
+                stats["chapters"] += 1
+                
+                task = None
+                if pipelined and index + 1 < len(chapters):
+                    task = asyncio.create_task(self._atimed_retrieve(inputs, chapters[index + 1][1]))
+                yield i, local_outline, chapter_query_results
+        finally:
+            if task:
+                task.cancel()
+            self._report_pipeline(stats, status_callback)
+
+    def _chapter_stream_callback(self, i, stream_callback):
+        """将章节序号绑定到流式回调"""
+        if not stream_callback:
+            return None
+        return lambda text: stream_callback(i, text)
+
+    def _chapter_done_message(self, i, total_chapters, chapter_content, stats):
+        message = f"✅ 第 {i}/{total_chapters} 章完成 ({len(chapter_content)} 字"
+        if stats.get("ttft") is not None:
+            message += f"，首字 {stats['ttft']:.1f} 秒，{stats['tokens_per_second']:.1f} tokens/秒"
+        if stats.get("chars"):
+            message += f"，每字消耗输入 {stats['input_tokens_per_char']:.1f} / 输出 {stats['output_tokens_per_char']:.1f} tokens"
+        return message + ")"
+
+    def _restore_progress(self, store, run_id, inputs, global_query_results, status_callback=None):
+        """从最后完成的章节检查点恢复剧情记忆、上一章正文与起始章节；没有检查点时从第一章开始"""
+        checkpoint = store.last_checkpoint(run_id)
+        if checkpoint is None:
+            # 初始化剧情记忆：检索到的前文作为背景提要，此后逐章记录缩写，渲染结果不超过 token 预算
+            previous_content = global_query_results.get("previous_content", "")
+            if "previous_content" in inputs and inputs["previous_content"]:
+                previous_content = inputs["previous_content"] # 如果输入中已有前文，优先使用
+            return StoryMemory.from_env(previous_content), "", 1
+        start = checkpoint["chapter"] + 1
+        message = f"♻️ 已从检查点恢复至第 {checkpoint['chapter']} 章，从第 {start} 章继续生成"
+        print(message)
+        if status_callback:
+            status_callback(message)
+        return StoryMemory.from_dict(checkpoint["memory"]), checkpoint["content"], start
+
+    def _chapter_failed(self, store, run_id, i, total_chapters):
+        """章节重试后仍失败：检查点停留在上一章，运行标记为失败并抛出 ChapterGenerationError，以便稍后从本章继续"""
+        store.finish_run(run_id, "failed")
+        message = f"第 {i}/{total_chapters} 章生成失败，已保存此前章节的进度，可稍后从第 {i} 章继续生成"
+        print(f"❌ {message}")
+        raise ChapterGenerationError(run_id, i, message)
+
+    # 以下为 generate_novels 与 agenerate_novels 共用的逐章步骤，两者只在模型调用处有同步/异步之分
+
+    def _open_run(self, inputs, run_id, progress_callback=None, status_callback=None):
+        """读取检查点中已有的运行，继续生成时沿用其输入；返回 (检查点存储, 运行, 输入)"""
         if progress_callback:
             progress_callback(10 / 100)
         
-        local_outlines = inputs["generated_outlines"]
-        total_chapters = len(local_outlines)
-        print(f"开始生成{total_chapters}个章节的小说内容...")
+        store = get_checkpoint_store(self.project)
+        run = store.get_run(run_id) if run_id else None
+        if run is not None:
+            inputs = run["inputs"]
         
+        total_chapters = len(inputs["generated_outlines"])
+        print(f"开始生成{total_chapters}个章节的小说内容...")
         if status_callback:
             status_callback(f"📚 准备生成 {total_chapters} 个章节...")
-        
-        # 初始全局检索（可选，保留一些全局上下文）
-        global_context_inputs = inputs.copy()
-        # 将大纲描述作为全局检索的一个依据
-        global_query_results = self.retrieve_infos(global_context_inputs)
-        
-        # 初始化前文内容
-        previous_content = global_query_results.get("previous_content", "")
-        if "previous_content" in inputs and inputs["previous_content"]:
-             previous_content = inputs["previous_content"] # 如果输入中已有前文，优先使用
+        return store, run, inputs
 
-        
+    def _start_chapters(self, store, run_id, run, inputs, global_query_results, progress_callback=None, status_callback=None):
+        """登记新运行并从检查点恢复进度，返回 (运行 id, 剧情记忆, 上一章正文, 起始章节)"""
+        if run is None:
+            run_id = store.start_run(inputs, global_query_results, run_id)
+        memory, res_content, start = self._restore_progress(store, run_id, inputs, global_query_results, status_callback)
         if progress_callback:
             progress_callback(20 / 100)
-        
+        return run_id, memory, res_content, start
+
+    def _begin_chapter(self, i, local_outline, total_chapters, global_query_results, chapter_query_results, memory):
+        """创建一章的生成状态"""
+        print(f"\n正在处理第{i}/{total_chapters}章...")
+        # 合并全局上下文和本章特定上下文
+        # 策略：优先使用本章特定的，如果为空则回退到全局的(或者合并)
+        # 这里简单做合并或者覆盖，视具体需求。这里采用 "优先本章检索结果"
+        context = global_query_results.copy()
+        context.update(chapter_query_results)
+        # 始终保持最新的 previous_content
+        context["previous_content"] = memory.render()
         progress_per_chapter = 80 / total_chapters # 剩余80%的进度分配给章节生成
-        
-        res_content = ""
-        
-        for i, local_outline in enumerate(local_outlines, 1):
-            if not local_outline:
-                continue
-            
-            print(f"\n正在处理第{i}/{total_chapters}章...")
-            
-            # 1. 动态检索上下文
-            # 使用当前章节大纲和临时设定作为检索依据
+        return {
+            "index": i,
+            "total": total_chapters,
+            "outline": local_outline,
+            "next_outline": local_outline,
+            "query_results": chapter_query_results,
+            "context": context,
+            "base_progress": 20 + (i - 1) * progress_per_chapter,
+            "progress_per_chapter": progress_per_chapter,
+            "stats": {},
+        }
+
+    def _report_chapter_progress(self, chapter, fraction, progress_callback=None):
+        if progress_callback:
+            progress_callback((chapter["base_progress"] + chapter["progress_per_chapter"] * fraction) / 100)
+
+    def _shorter_inputs(self, chapter, res_content, memory, progress_callback=None, status_callback=None):
+        """缩写/整理前文 (第二章起) 的输入：上一章完整正文、本章大纲与当前前情提要"""
+        if status_callback:
+            status_callback(f"📝 第 {chapter['index']}/{chapter['total']} 章：正在整理剧情连贯性...")
+        self._report_chapter_progress(chapter, 0.1, progress_callback)
+        return {
+            "current_content": res_content, 
+            "next_outline": chapter["outline"], 
+            "previous_content": memory.render()
+        }
+
+    def _apply_summary(self, store, run_id, chapter, memory, shorted_res):
+        """记录上一章的缩写（较早的章节逐级压缩）并写入上一章的检查点，更新本章前文并采用可能优化过的大纲"""
+        summary = shorted_res['shorted_content']
+        memory.add_chapter(chapter["index"] - 1, summary)
+        store.save_summary(run_id, chapter["index"], summary)
+        print(f"前情提要: {memory.tokens()} tokens（预算 {memory.budget_tokens}）")
+        chapter["context"]["previous_content"] = memory.render()
+        chapter["next_outline"] = shorted_res.get("next_outline", chapter["outline"])
+
+    def _final_shorter_inputs(self, chapter, res_content, memory, status_callback=None):
+        """最后一章之后没有章节触发缩写，单独缩写最后一章以补全其检查点"""
+        if status_callback:
+            status_callback(f"📝 第 {chapter['index']}/{chapter['total']} 章：正在缩写最后一章...")
+        return {
+            "current_content": res_content,
+            "next_outline": "（已是最后一章，没有下一章节）",
+            "previous_content": memory.render()
+        }
+
+    def _apply_final_summary(self, store, run_id, chapter, memory, shorted_res):
+        summary = shorted_res['shorted_content']
+        memory.add_chapter(chapter["index"], summary)
+        store.save_summary(run_id, chapter["index"] + 1, summary)
+
+    def _generation_inputs(self, inputs, chapter, progress_callback=None, status_callback=None):
+        """准备生成本章正文所需的完整输入"""
+        if status_callback:
+            status_callback(f"🎨 第 {chapter['index']}/{chapter['total']} 章：正在创作正文...")
+        self._report_chapter_progress(chapter, 0.3, progress_callback)
+        return self._chapter_gen_inputs(inputs, chapter["context"], chapter["next_outline"], chapter["context"]["previous_content"])
+
+    def _generation_failed(self, chapter, retry, error, status_callback=None):
+        """正文生成的重试策略：模型调用失败导致本章不完整时重新生成整章，最后一次仍失败则放弃本章"""
+        i, total_chapters = chapter["index"], chapter["total"]
+        print(f"章节{i}生成失败: {error}")
+        if retry == CHAPTER_RETRIES - 1:
             if status_callback:
-                status_callback(f"🔍 第 {i}/{total_chapters} 章：正在检索相关信息...")
-                
-            chapter_retrieval_inputs = {
-                "outlines_description": local_outline, # 使用本章大纲检索
-                "temp_settings": inputs.get("temp_settings", ""),
-                "user_input": inputs.get("user_input", "")
-            }
-            
-            # 获取本章特定的上下文信息
-            print(f"第{i}章：执行动态检索...")
-            chapter_query_results = self.retrieve_infos(chapter_retrieval_inputs)
-            
-            # 合并全局上下文和本章特定上下文
-            # 策略：优先使用本章特定的，如果为空则回退到全局的(或者合并)
-            # 这里简单做合并或者覆盖，视具体需求。这里采用 "优先本章检索结果"
-            current_chapter_context = global_query_results.copy()
-            current_chapter_context.update(chapter_query_results)
-            # 始终保持最新的 previous_content
-            current_chapter_context["previous_content"] = previous_content
+                status_callback(f"❌ 第 {i}/{total_chapters} 章生成失败")
+        elif status_callback:
+            status_callback(f"⚠️ 第 {i}/{total_chapters} 章：重试中... ({retry+1}/{CHAPTER_RETRIES})")
 
+    def _complete_chapter(self, store, run_id, chapter, chapter_content, memory, progress_callback=None, status_callback=None):
+        """写入本章检查点并上报完成；本章彻底失败时结束运行并抛出 ChapterGenerationError"""
+        self._report_chapter_progress(chapter, 1.0, progress_callback)
+        i, total_chapters = chapter["index"], chapter["total"]
+        if not chapter_content:
+            self._chapter_failed(store, run_id, i, total_chapters)
+        
+        # 先写检查点再返回本章，调用方在返回后中断也不会丢失本章
+        store.save_chapter(run_id, i, chapter["outline"], chapter["next_outline"], chapter_content,
+                           chapter["query_results"], memory.to_dict(), chapter["stats"])
+        if status_callback:
+            status_callback(self._chapter_done_message(i, total_chapters, chapter_content, chapter["stats"]))
+
+    def generate_novels(self, inputs, progress_callback=None, status_callback=None, pipelined=False, stream_callback=None, run_id=None):
+        """生成小说章节 (针对每个章节动态检索)
+
+        传入 stream_callback(章节序号, 本章已生成内容) 时流式生成正文，边生成边回调。
+        每完成一章写入检查点；run_id 对应已有的运行时沿用其输入，从最后完成的章节继续生成。
+        某章重试后仍失败时抛出 ChapterGenerationError，此前的章节已逐章返回并保存。
+        """
+        store, run, inputs = self._open_run(inputs, run_id, progress_callback, status_callback)
+        if run is None:
+            # 初始全局检索（可选，保留一些全局上下文），将大纲描述作为全局检索的一个依据
+            global_query_results = self.retrieve_infos(inputs.copy())
+        else:
+            # 继续已有的运行：沿用当时的全局检索结果
+            global_query_results = run["global_context"]
+        run_id, memory, res_content, start = self._start_chapters(store, run_id, run, inputs, global_query_results, progress_callback, status_callback)
+        
+        local_outlines = inputs["generated_outlines"]
+        chapter = None
+        # 1. 动态检索上下文
+        # 使用当前章节大纲和临时设定作为检索依据，流水线模式下在生成本章时预取下一章
+        for i, local_outline, chapter_query_results in self._chapter_retrievals(inputs, local_outlines, pipelined, status_callback, start):
+            chapter = self._begin_chapter(i, local_outline, len(local_outlines), global_query_results, chapter_query_results, memory)
             
             # 2. 缩写/整理前文 (如果不是第一章)
-            base_progress = 20 + (i - 1) * progress_per_chapter
-            next_outline = local_outline
-
             if i > 1:
-                if status_callback:
-                    status_callback(f"📝 第 {i}/{total_chapters} 章：正在整理剧情连贯性...")
-                
-                # Update progress
-                if progress_callback:
-                    progress_callback((base_progress + progress_per_chapter * 0.1) / 100)
-                
+                shorter_inputs = self._shorter_inputs(chapter, res_content, memory, progress_callback, status_callback)
                 try:
-                    shorted_res = self.shorter.invoke({
-                        "current_content": res_content, 
-                        "next_outline": local_outline, 
-                        "previous_content": previous_content
-                    })
-                    # 更新前文内容: 累加新的缩写内容
-                    previous_content += f"\\n{shorted_res['shorted_content']}"
-                    # 更新当前上下文中的前文
-                    current_chapter_context["previous_content"] = previous_content
-                    # 可能会优化大纲
-                    next_outline = shorted_res.get("next_outline", local_outline)
+                    self._apply_summary(store, run_id, chapter, memory, self.shorter.invoke(shorter_inputs))
                 except Exception as e:
                     print(f"缩写前文失败: {e}，跳过缩写步骤")
-
             
-            # 3. 生成内容
-            if status_callback:
-                status_callback(f"🎨 第 {i}/{total_chapters} 章：正在创作正文...")
-            
-            if progress_callback:
-                progress_callback((base_progress + progress_per_chapter * 0.3) / 100)
-            
-            # 准备生成所需的完整输入
-            gen_inputs = inputs.copy()
-            gen_inputs.update(current_chapter_context) # 更新为当前章节的上下文
-            gen_inputs["local_outline"] = next_outline
-            gen_inputs["previous_content"] = previous_content
-            
-            # 重试机制
+            # 3. 生成内容（重试机制）
+            gen_inputs = self._generation_inputs(inputs, chapter, progress_callback, status_callback)
             chapter_content = ""
-            for retry in range(3):
+            for retry in range(CHAPTER_RETRIES):
                 try:
-                    chapter_content = self.novel_generator.invoke(gen_inputs)
+                    chapter_content = self.novel_generator.invoke(gen_inputs, self._chapter_stream_callback(i, stream_callback), chapter["stats"])
                     break
-                except OutputParserException as e:
-                    if retry == 2:
-                        print(f"章节{i}生成失败: {e}")
-                        if status_callback:
-                            status_callback(f"❌ 第 {i}/{total_chapters} 章生成失败")
-                        chapter_content = ""
-                    else:
-                        if status_callback:
-                            status_callback(f"⚠️ 第 {i}/{total_chapters} 章：重试中... ({retry+1}/3)")
-                    continue
                 except Exception as e:
-                    print(f"生成异常: {e}")
-                    if retry == 2:
-                       chapter_content = "" # Fail gracefully
+                    self._generation_failed(chapter, retry, e, status_callback)
             
-            # 更新本章生成的内容用于下一章的缩写输入（虽然shorter用的是res_content，即上一章的完整内容）
-            # 注意：res_content 在循环中被用作"current_content"给shorter，应该是"上一章生成的完整内容"
-            # 所以这里我们需要保存这一章的内容给下一轮使用
+            # res_content 是下一章缩写时的"上一章生成的完整内容"
             res_content = chapter_content
+            self._complete_chapter(store, run_id, chapter, chapter_content, memory, progress_callback, status_callback)
+            yield chapter_content
+        
+        if chapter is not None:
+            try:
+                self._apply_final_summary(store, run_id, chapter, memory, self.shorter.invoke(self._final_shorter_inputs(chapter, res_content, memory, status_callback)))
+            except Exception as e:
+                print(f"缩写最后一章失败: {e}，跳过缩写步骤")
+        store.finish_run(run_id)
+
+    async def agenerate_novels(self, inputs, progress_callback=None, status_callback=None, pipelined=False, stream_callback=None, run_id=None):
+        """异步生成小说章节，流程与 generate_novels 一致，以异步生成器逐章返回"""
+        store, run, inputs = self._open_run(inputs, run_id, progress_callback, status_callback)
+        if run is None:
+            global_query_results = await self.aretrieve_infos(inputs.copy())
+        else:
+            global_query_results = run["global_context"]
+        run_id, memory, res_content, start = self._start_chapters(store, run_id, run, inputs, global_query_results, progress_callback, status_callback)
+        
+        local_outlines = inputs["generated_outlines"]
+        chapter = None
+        async for i, local_outline, chapter_query_results in self._achapter_retrievals(inputs, local_outlines, pipelined, status_callback, start):
+            chapter = self._begin_chapter(i, local_outline, len(local_outlines), global_query_results, chapter_query_results, memory)
             
-            if progress_callback:
-                progress_callback((base_progress + progress_per_chapter) / 100)
+            if i > 1:
+                shorter_inputs = self._shorter_inputs(chapter, res_content, memory, progress_callback, status_callback)
+                try:
+                    self._apply_summary(store, run_id, chapter, memory, await self.shorter.ainvoke(shorter_inputs))
+                except Exception as e:
+                    print(f"缩写前文失败: {e}，跳过缩写步骤")
             
-            if chapter_content and status_callback:
-                status_callback(f"✅ 第 {i}/{total_chapters} 章完成 ({len(chapter_content)} 字)")
+            gen_inputs = self._generation_inputs(inputs, chapter, progress_callback, status_callback)
+            chapter_content = ""
+            for retry in range(CHAPTER_RETRIES):
+                try:
+                    chapter_content = await self.novel_generator.ainvoke(gen_inputs, self._chapter_stream_callback(i, stream_callback), chapter["stats"])
+                    break
+                except Exception as e:
+                    self._generation_failed(chapter, retry, e, status_callback)
             
+            res_content = chapter_content
+            self._complete_chapter(store, run_id, chapter, chapter_content, memory, progress_callback, status_callback)
             yield chapter_content
+        
+        if chapter is not None:
+            try:
+                self._apply_final_summary(store, run_id, chapter, memory, await self.shorter.ainvoke(self._final_shorter_inputs(chapter, res_content, memory, status_callback)))
+            except Exception as e:
+                print(f"缩写最后一章失败: {e}，跳过缩写步骤")
+        store.finish_run(run_id)
+
+    def resume_novels(self, run_id, progress_callback=None, status_callback=None, pipelined=False, stream_callback=None):
+        """从检查点继续未完成的章节生成，逐章返回此后新生成的章节"""
+        if get_checkpoint_store(self.project).get_run(run_id) is None:
+            raise ValueError(f"检查点不存在: {run_id}")
+        return self.generate_novels(None, progress_callback, status_callback, pipelined, stream_callback, run_id=run_id)
+
+    def aresume_novels(self, run_id, progress_callback=None, status_callback=None, pipelined=False, stream_callback=None):
+        """resume_novels 的异步版本，返回异步生成器"""
+        if get_checkpoint_store(self.project).get_run(run_id) is None:
+            raise ValueError(f"检查点不存在: {run_id}")
+        return self.agenerate_novels(None, progress_callback, status_callback, pipelined, stream_callback, run_id=run_id)
+
+
+_workflows = {}
+_workflows_lock = Lock()
+
+
+def get_workflow(config_path, model=None, model_provider=None, extractor_model=None,
+                 short_model=None, special_model_provider=None, model_kwargs={}) -> NovelWorkflow:
+    """获取缓存的工作流实例，按项目配置与模型选择复用，避免每次点击重建检索器与客户端"""
+    config = json.dumps(vars(get_config(config_path)), sort_keys=True, default=str)
+    key = (
+        config_path,
+        config,
+        model,
+        model_provider,
+        extractor_model,
+        short_model,
+        special_model_provider,
+        json.dumps(model_kwargs, sort_keys=True, default=str),
+    )
+    with _workflows_lock:
+        workflow = _workflows.get(key)
+    if workflow is not None:
+        return workflow
+    workflow = NovelWorkflow(config_path, model, model_provider, extractor_model, short_model, special_model_provider, model_kwargs)
+    with _workflows_lock:
+        return _workflows.setdefault(key, workflow)
+
+
+def invalidate_workflows(config_path):
+    """使指定项目的所有缓存工作流失效"""
+    with _workflows_lock:
+        for key in [key for key in _workflows if key[0] == config_path]:
+            del _workflows[key]
+
+
+def release_project(config_path):
+    """释放项目相关的全部缓存资源，删除项目前调用"""
+    service = get_indexing_service()
+    if service is not None:
+        service.unwatch_project(config_path)
+    invalidate_workflows(config_path)
+    release_checkpoint_store(config_path)
+    try:
+        args = get_config(config_path)
+    except FileNotFoundError:
+        return
+    for path in [args.project_documents, args.context_documents, args.knowledge_documents]:
+        release_document_processors(path)
@@ -0,0 +1,105 @@
+"""
+分层剧情记忆
+替代不断累加的前情提要字符串：最近几章保留完整的章节缩写，更早的章节按剧情段落（若干章）压缩为段落梗概，
+段落过多时再合并最早的段落，渲染结果始终不超过 token 预算，使每章的提示词大小与批量生成的章节数无关
+"""
+from utils.token_utils import estimate_tokens, extractive_summary
+import os
+
+
+class StoryMemory():
+    """分层剧情记忆：背景提要 + 早期剧情段落梗概 + 近期章节缩写"""
+
+    def __init__(self, budget_tokens=3000, recent_chapters=3, arc_chapters=5, background=""):
+        self.budget_tokens = budget_tokens
+        self.recent_chapters = recent_chapters  # 保留完整缩写的最近章节数
+        self.arc_chapters = arc_chapters  # 每个剧情段落包含的章节数
+        # 预算分配：背景 15%，早期剧情 35%，近期章节 50%
+        self.background_tokens = budget_tokens * 15 // 100
+        self.arcs_tokens = budget_tokens * 35 // 100
+        self.recent_tokens = budget_tokens - self.background_tokens - self.arcs_tokens
+        self.background = extractive_summary(background.strip(), self.background_tokens) if background else ""
+        self.arcs = []  # [{"start": 起始章, "end": 结束章, "summary": 段落梗概}]
+        self.recent = []  # [(章节, 缩写)]
+
+    @classmethod
+    def from_env(cls, background=""):
+        """按环境变量配置创建剧情记忆"""
+        return cls(
+            budget_tokens=int(os.getenv("STORY_MEMORY_TOKENS", 3000)),
+            recent_chapters=int(os.getenv("STORY_MEMORY_RECENT_CHAPTERS", 3)),
+            arc_chapters=int(os.getenv("STORY_MEMORY_ARC_CHAPTERS", 5)),
+            background=background,
+        )
+
+    def add_chapter(self, chapter, summary):
+        """记录一章的缩写，超出近期章节数或预算的最早章节归入剧情段落"""
+        summary = (summary or "").strip()
+        if not summary:
+            return
+        self.recent.append((chapter, extractive_summary(summary, self.recent_tokens)))
+        while len(self.recent) > self.recent_chapters or (
+            len(self.recent) > 1 and sum(estimate_tokens(text) for _, text in self.recent) > self.recent_tokens
+        ):
+            self._archive(*self.recent.pop(0))
+
+    def _archive(self, chapter, summary):
+        arc = self.arcs[-1] if self.arcs else None
+        if arc is None or arc["end"] - arc["start"] + 1 >= self.arc_chapters:
+            arc = {"start": chapter, "end": chapter, "summary": ""}
+            self.arcs.append(arc)
+        arc["end"] = chapter
+        # 单个段落最多占早期剧情预算的三分之一，每章一行，超过预算时合并最早的两个段落；
+        # 合并时按行均匀抽取，早期章节不会被最新章节挤掉
+        line = extractive_summary(summary, max(32, self.arcs_tokens // 3 // self.arc_chapters)).replace("\n", "")
+        arc["summary"] = f"{arc['summary']}\n第{chapter}章：{line}".strip()
+        while len(self.arcs) > 1 and sum(estimate_tokens(arc["summary"]) for arc in self.arcs) > self.arcs_tokens:
+            first, second = self.arcs.pop(0), self.arcs.pop(0)
+            self.arcs.insert(0, {
+                "start": first["start"],
+                "end": second["end"],
+                "summary": self._sample_lines(f"{first['summary']}\n{second['summary']}", self.arcs_tokens // 3),
+            })
+
+    @staticmethod
+    def _sample_lines(text, budget):
+        """在各章的行中均匀抽取，保留首尾，使合并后的段落仍覆盖整段剧情"""
+        lines = [line for line in text.split("\n") if line.strip()]
+        tokens = [estimate_tokens(line) for line in lines]
+        if sum(tokens) <= budget:
+            return "\n".join(lines)
+        count = max(1, min(len(lines), int(budget / (sum(tokens) / len(lines)))))
+        indexes = sorted({round(i * (len(lines) - 1) / max(count - 1, 1)) for i in range(count)})
+        return "\n".join(lines[index] for index in indexes)
+
+    def render(self) -> str:
+        """渲染为前情提要文本"""
+        parts = []
+        if self.background:
+            parts.append(self.background)
+        if self.arcs:
+            parts.append("【早期剧情】\n" + "\n".join(arc["summary"] for arc in self.arcs))
+        if self.recent:
+            parts.append("【近期章节】\n" + "\n".join(f"第{chapter}章：{summary}" for chapter, summary in self.recent))
+        return "\n\n".join(parts)
+
+    def tokens(self) -> int:
+        return estimate_tokens(self.render())
+
+    def to_dict(self) -> dict:
+        return {
+            "budget_tokens": self.budget_tokens,
+            "recent_chapters": self.recent_chapters,
+            "arc_chapters": self.arc_chapters,
+            "background": self.background,
+            "arcs": self.arcs,
+            "recent": [list(item) for item in self.recent],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        memory = cls(data["budget_tokens"], data["recent_chapters"], data["arc_chapters"])
+        memory.background = data.get("background", "")
+        memory.arcs = [dict(arc) for arc in data.get("arcs", [])]
+        memory.recent = [tuple(item) for item in data.get("recent", [])]
+        return memory
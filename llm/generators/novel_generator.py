@@ -4,6 +4,9 @@
 """
 from langchain_classic.output_parsers import ResponseSchema
 from llm.providers.base import LLM
+from utils.token_utils import estimate_tokens, extractive_summary, truncate_tokens
+import math
+import os
 
 
 # 提示词模板
@@ -68,12 +71,19 @@ USER_INPUT = """
     {character_settings}
 """
 
+# JSON 字段名、标题等格式开销的估算 token 数
+FORMAT_OVERHEAD_TOKENS = 64
+
 SCHEMAS = [
     ResponseSchema(name="title", type="string", description="章节标题."),
     ResponseSchema(name="content", type="string", description="章节正文"),
 ]
 
 
+class ChapterIncompleteError(RuntimeError):
+    """本章有模型调用失败且最终字数未达到要求，已生成的部分内容不能作为完整章节使用"""
+
+
 class NovelGenerator(LLM):
     """小说生成器"""
     
@@ -88,91 +98,236 @@ class NovelGenerator(LLM):
             SCHEMAS
         )
         self.get_chain()
+        self.last_stats = None
+        # 每次调用的输出 token 上限，0 表示不限制；续写时只发送前文梗概与最近的原文
+        self.max_tokens_per_call = int(os.getenv("NOVEL_MAX_TOKENS_PER_CALL", 4096))
+        self.context_tail_tokens = int(os.getenv("NOVEL_CONTEXT_TAIL_TOKENS", 800))
+        self.context_summary_tokens = int(os.getenv("NOVEL_CONTEXT_SUMMARY_TOKENS", 400))
+
+    def invoke(self, inputs, stream_callback=None, stats=None): # type: ignore
+        """生成小说内容，采用累积式生成确保达到目标字数
+
+        传入 stream_callback 时流式生成，每收到新文本即以本章已生成的全部内容回调。
+        输入/输出 token 消耗、首字延迟与生成速度写入 stats。
+        有调用失败且字数未达标时抛出 ChapterIncompleteError，由调用方重试整章。
+        """
+        state = self._start_chapter(inputs)
+        # 累积式生成：首次生成初稿，后续续写累积
+        while self._pending(state):
+            current_inputs, max_tokens, callback = self._prepare_round(inputs, state, stream_callback)
+            round_stats = {}
+            try:
+                if callback:
+                    new_res = super().stream(current_inputs, callback, stats=round_stats, max_tokens=max_tokens)
+                else:
+                    new_res = super().invoke(current_inputs, max_tokens=max_tokens)
+            except Exception as e:
+                self._fail_round(state, e)
+                continue
+            if self._complete_round(state, current_inputs, new_res, round_stats, stream_callback):
+                break
+        return self._finish_chapter(state, stats)
 
-    def invoke(self, inputs):
-        """生成小说内容，采用累积式生成确保达到目标字数"""
+    async def ainvoke(self, inputs, stream_callback=None, stats=None): # type: ignore
+        """异步生成小说内容，逻辑与 invoke 一致"""
+        state = self._start_chapter(inputs)
+        while self._pending(state):
+            current_inputs, max_tokens, callback = self._prepare_round(inputs, state, stream_callback)
+            round_stats = {}
+            try:
+                if callback:
+                    new_res = await super().astream(current_inputs, callback, stats=round_stats, max_tokens=max_tokens)
+                else:
+                    new_res = await super().ainvoke(current_inputs, max_tokens=max_tokens)
+            except Exception as e:
+                self._fail_round(state, e)
+                continue
+            if self._complete_round(state, current_inputs, new_res, round_stats, stream_callback):
+                break
+        return self._finish_chapter(state, stats)
+
+    # 以下为 invoke 与 ainvoke 共用的逐轮步骤，两者只在模型调用处有同步/异步之分
+
+    def _start_chapter(self, inputs):
+        """初始化一章的累积生成状态"""
         target_num = int(inputs.get("words_num"))
-        full_content = ""
-        retry_count = 0
-        max_retries = 5  # 增加重试次数以支持累积生成
+        return {
+            "target": target_num,
+            "content": "",
+            "round": 0,
+            "max_rounds": self._plan(target_num),
+            "stats": self._new_stats(),
+            "error": None, # 最近一次失败的调用
+        }
+
+    def _pending(self, state):
+        """字数未达标且仍有剩余轮数时继续生成"""
+        return len(state["content"]) < state["target"] and state["round"] < state["max_rounds"]
+
+    def _prepare_round(self, inputs, state, stream_callback=None):
+        """返回本轮的输入、输出 token 上限与流式回调"""
+        current_inputs, max_tokens = self._round_inputs(inputs, state["content"], state["round"], state["target"])
+        callback = self._round_callback(state["content"], state["round"], stream_callback) if stream_callback else None
+        return current_inputs, max_tokens, callback
+
+    def _complete_round(self, state, current_inputs, new_res, round_stats, stream_callback=None):
+        """合并本轮结果，已达到或接近目标（95%以上）时返回 True 提前结束"""
+        self._add_stats(state["stats"], current_inputs, new_res, round_stats)
+        state["content"] = self._merge_round(state["content"], str(new_res), state["round"])
+        if stream_callback:
+            # 合并时可能去除了重复开头，以合并结果为准
+            stream_callback(state["content"])
+        state["round"] += 1
+        if len(state["content"]) >= state["target"] * 0.95:
+            print(f"✓ 已达到字数要求！最终字数: {len(state['content'])}字")
+            return True
+        return False
+
+    def _fail_round(self, state, error):
+        """本轮调用失败，计入轮数后继续下一轮"""
+        print(f"✗ 生成出错: {error}")
+        state["error"] = error
+        state["round"] += 1
+
+    def _finish_chapter(self, state, stats=None):
+        """结束本章；字数不足是调用失败所致时不返回残缺内容，而是抛出 ChapterIncompleteError"""
+        if state["error"] is not None and len(state["content"]) < state["target"] * 0.95:
+            raise ChapterIncompleteError(
+                f"本章生成不完整（{len(state['content'])}/{state['target']}字），最近一次调用失败: {state['error']}"
+            ) from state["error"]
+        self._report(state["content"], state["target"])
+        self._finish_stats(state["stats"], state["content"], stats)
+        return state["content"]
+
+    def _round_chars(self):
+        """单次调用最多可生成的字数，扣除 JSON 字段等格式开销并留出余量"""
+        if not self.max_tokens_per_call:
+            return None
+        return max(200, int((self.max_tokens_per_call - FORMAT_OVERHEAD_TOKENS) / 1.1))
+
+    def _plan(self, target_num):
+        """预估本章所需 token 与轮数，返回最多尝试的轮数"""
+        needed = estimate_tokens("字" * target_num) + FORMAT_OVERHEAD_TOKENS
+        round_chars = self._round_chars()
+        rounds = math.ceil(target_num / round_chars) if round_chars else 1
+        print(f"目标字数: {target_num}字，预计输出 {needed} tokens，计划 {rounds} 轮" + (f"（每轮上限 {self.max_tokens_per_call} tokens）" if round_chars else ""))
+        # 为模型少写的情况保留续写余地
+        return max(5, rounds + 2)
+
+    def _continuation_context(self, full_content):
+        """续写上下文：前文过长时只保留梗概与最近的原文，提示词大小不随已生成字数增长"""
+        if estimate_tokens(full_content) <= self.context_tail_tokens + self.context_summary_tokens:
+            return full_content
+        tail = truncate_tokens(full_content, self.context_tail_tokens, from_end=True)
+        head = full_content[:len(full_content) - len(tail)]
+        summary = extractive_summary(head, self.context_summary_tokens)
+        return f"【前文梗概】\n{summary}\n\n【最近原文】\n{tail}"
+
+    def _round_inputs(self, inputs, full_content, retry_count, target_num):
+        """构建本轮生成的输入与输出 token 上限：首轮生成初稿，后续轮次续写"""
+        current_inputs = inputs.copy()
+        round_chars = self._round_chars() or target_num
         
-        print(f"目标字数: {target_num}字")
+        if retry_count == 0:
+            # 第一次：生成初稿
+            print("正在生成初稿...")
+            goal = min(target_num, round_chars)
+            current_inputs["generated_content"] = ""
+            current_inputs["words_num"] = goal
+            return current_inputs, self._round_max_tokens(goal)
         
-        # 累积式生成：首次生成初稿，后续续写累积
-        while len(full_content) < target_num and retry_count < max_retries:
-            current_inputs = inputs.copy()
-            
-            if retry_count == 0:
-                # 第一次：生成初稿
-                print("正在生成初稿...")
-                current_inputs["generated_content"] = ""
-                
-            else:
-                # 后续：在已有内容基础上续写
-                shortage = target_num - len(full_content)
-                print(f"\n第{retry_count + 1}次续写 (已有{len(full_content)}字，还需{shortage}字)...")
-                
-                # 构建续写提示
-                continuation_hint = f"""
+        # 后续：在已有内容基础上续写
+        shortage = target_num - len(full_content)
+        goal = min(shortage, round_chars)
+        print(f"\n第{retry_count + 1}次续写 (已有{len(full_content)}字，还需{shortage}字，本轮{goal}字)...")
+        
+        # 构建续写提示
+        continuation_hint = f"""
 【续写任务】
 当前章节已生成{len(full_content)}字内容，距离目标{target_num}字还差{shortage}字。
 
-**请在以下已生成内容的基础上继续创作**：
+**请在已生成内容的基础上继续创作**：
 - 保持叙事风格、人物性格、场景氛围的一致性
 - 自然延续情节发展，不要突兀或重复
 - 继续扩充细节、对话、心理活动等，确保内容充实
-- 目标新增{min(shortage, 1500)}字左右
-
-已生成内容：
-{full_content[-500:] if len(full_content) > 500 else full_content}
-...
+- 本次新增{goal}字左右
 
-请从上述内容自然延续，继续创作：
+「未满足字数要求的生成内容」中给出了已生成内容（较长时为前文梗概与最近的原文），请从最近原文的结尾自然延续，只返回新增的内容：
 """
-                current_inputs["user_input"] = inputs.get("user_input", "") + "\n\n" + continuation_hint
-                current_inputs["generated_content"] = full_content
-            
-            # 调用LLM生成
-            try:
-                new_res = super().invoke(current_inputs)
-                new_content = str(new_res)
-                
-                if retry_count == 0:
-                    # 初稿：直接使用
-                    full_content = new_content
-                    print(f"✓ 初稿生成完成: {len(full_content)}字")
-                else:
-                    # 续写：累积追加
-                    # 清理可能的重复开头
-                    if len(full_content) > 100 and new_content[:50] in full_content[-200:]:
-                        # 检测到重复，尝试从重复点后开始
-                        overlap_idx = full_content.rfind(new_content[:50])
-                        if overlap_idx > 0:
-                            new_content = new_content[50:]
-                    
-                    full_content += "\n\n" + new_content
-                    print(f"✓ 续写完成: 新增{len(new_content)}字，累计{len(full_content)}字")
-                
-                retry_count += 1
-                
-                # 如果已经达到或接近目标（95%以上），提前结束
-                if len(full_content) >= target_num * 0.95:
-                    print(f"✓ 已达到字数要求！最终字数: {len(full_content)}字")
-                    break
-                    
-            except Exception as e:
-                print(f"✗ 生成出错: {e}")
-                retry_count += 1
-                if retry_count >= max_retries:
-                    break
-                continue
+        current_inputs["user_input"] = inputs.get("user_input", "") + "\n\n" + continuation_hint
+        current_inputs["generated_content"] = self._continuation_context(full_content)
+        current_inputs["words_num"] = goal
+        return current_inputs, self._round_max_tokens(goal)
+
+    def _round_max_tokens(self, goal):
+        """本轮输出上限：按目标字数留 50% 余量，不超过单次调用上限"""
+        if not self.max_tokens_per_call:
+            return None
+        return min(self.max_tokens_per_call, int(estimate_tokens("字" * goal) * 1.5) + FORMAT_OVERHEAD_TOKENS)
+
+    def _round_callback(self, full_content, retry_count, stream_callback):
+        """将本轮的增量文本拼接到已有内容之后回调"""
+        prefix = full_content + "\n\n" if retry_count > 0 else ""
+        parts = []
+
+        def callback(delta):
+            parts.append(delta)
+            stream_callback(prefix + "".join(parts))
+        return callback
+
+    def _new_stats(self):
+        return {"ttft": None, "rounds": 0, "input_tokens": 0, "output_tokens": 0, "stream_seconds": 0.0}
+
+    def _add_stats(self, stats, current_inputs, new_res, round_stats):
+        """累计各轮的 token 消耗；流式生成时同时累计首字延迟（取首轮）与生成耗时"""
+        stats["rounds"] += 1
+        stats["input_tokens"] += self.estimate_input_tokens(current_inputs)
+        if round_stats:
+            stats["output_tokens"] += round_stats["tokens"]
+            if stats["ttft"] is None:
+                stats["ttft"] = round_stats["ttft"]
+            stats["stream_seconds"] += round_stats["seconds"] - round_stats["ttft"]
+        else:
+            stats["output_tokens"] += estimate_tokens(str(new_res)) + FORMAT_OVERHEAD_TOKENS
+
+    def _finish_stats(self, stats, full_content, output=None):
+        """记录本章每个成稿字消耗的输入/输出 token，以及流式生成的首字延迟与生成速度"""
+        chars = len(full_content)
+        stats["chars"] = chars
+        stats["input_tokens_per_char"] = stats["input_tokens"] / chars if chars else 0.0
+        stats["output_tokens_per_char"] = stats["output_tokens"] / chars if chars else 0.0
+        print(f"Token 消耗: {stats['rounds']} 轮，输入 {stats['input_tokens']}，输出 {stats['output_tokens']}，"
+              f"每字输入 {stats['input_tokens_per_char']:.2f}、输出 {stats['output_tokens_per_char']:.2f}")
+        if stats["ttft"] is not None:
+            stats["tokens_per_second"] = stats["output_tokens"] / stats["stream_seconds"] if stats["stream_seconds"] > 0 else 0.0
+            print(f"首字延迟: {stats['ttft']:.2f}秒，生成速度: {stats['tokens_per_second']:.1f} tokens/秒")
+        self.last_stats = stats
+        if output is not None:
+            output.update(stats)
+
+    def _merge_round(self, full_content, new_content, retry_count):
+        """合并本轮生成结果"""
+        if retry_count == 0:
+            # 初稿：直接使用
+            print(f"✓ 初稿生成完成: {len(new_content)}字")
+            return new_content
         
-        # 最终检查
+        # 续写：累积追加
+        # 清理可能的重复开头
+        if len(full_content) > 100 and new_content[:50] in full_content[-200:]:
+            # 检测到重复，尝试从重复点后开始
+            overlap_idx = full_content.rfind(new_content[:50])
+            if overlap_idx > 0:
+                new_content = new_content[50:]
+        
+        full_content += "\n\n" + new_content
+        print(f"✓ 续写完成: 新增{len(new_content)}字，累计{len(full_content)}字")
+        return full_content
+
+    def _report(self, full_content, target_num):
+        """最终字数检查"""
         if len(full_content) < target_num:
             completion_rate = (len(full_content) / target_num) * 100
             print(f"⚠ 字数未完全达标: {len(full_content)}/{target_num}字 ({completion_rate:.1f}%)，已返回所有生成内容")
         else:
             print(f"✅ 生成成功！最终字数: {len(full_content)}字")
-            
-        return full_content
-
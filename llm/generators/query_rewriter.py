@@ -3,6 +3,11 @@
 """
 from langchain_classic.output_parsers import ResponseSchema
 from llm.providers.base import LLM
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import asyncio
+import os
 
 
 # 提示词模板
@@ -39,6 +44,13 @@ SCHEMAS = [
 ]
 
 
+# 改写结果缓存：(模型服务商, 模型, 查询) -> 改写后的查询列表，进程内共享
+_rewrite_cache: OrderedDict = OrderedDict()
+_rewrite_cache_lock = Lock()
+REWRITE_CACHE_SIZE = int(os.getenv("QUERY_REWRITE_CACHE_SIZE", 4096))
+REWRITE_WORKERS = int(os.getenv("QUERY_REWRITE_WORKERS", 8))
+
+
 class QueryRewriter(LLM):
     """查询重写器"""
     
@@ -53,3 +65,60 @@ class QueryRewriter(LLM):
             SCHEMAS
         )
         self.get_chain()
+
+    def _cache_get(self, query):
+        key = (self.model_provider, self.model, query)
+        with _rewrite_cache_lock:
+            if key in _rewrite_cache:
+                _rewrite_cache.move_to_end(key)
+                return _rewrite_cache[key]
+        return None
+
+    def _cache_set(self, query, rewritten):
+        key = (self.model_provider, self.model, query)
+        with _rewrite_cache_lock:
+            _rewrite_cache[key] = rewritten
+            _rewrite_cache.move_to_end(key)
+            while len(_rewrite_cache) > REWRITE_CACHE_SIZE:
+                _rewrite_cache.popitem(last=False)
+
+    def _rewrite(self, query):
+        """改写单个查询，失败时返回空列表"""
+        try:
+            res = self.invoke({"query": query})
+            rewritten = list(res.get("rewritten_queries", [])) if res else []
+        except Exception as e:
+            print(f"[Warn] Query rewriting failed for '{query}': {e}")
+            return []
+        self._cache_set(query, rewritten)
+        return rewritten
+
+    async def _arewrite(self, query):
+        try:
+            res = await self.ainvoke({"query": query})
+            rewritten = list(res.get("rewritten_queries", [])) if res else []
+        except Exception as e:
+            print(f"[Warn] Query rewriting failed for '{query}': {e}")
+            return []
+        self._cache_set(query, rewritten)
+        return rewritten
+
+    def rewrite_many(self, queries):
+        """并发改写一组查询，已缓存的查询直接返回，返回 查询 -> 改写列表"""
+        results = {query: self._cache_get(query) for query in dict.fromkeys(queries)}
+        pending = [query for query, rewritten in results.items() if rewritten is None]
+        if pending:
+            with ThreadPoolExecutor(max_workers=min(REWRITE_WORKERS, len(pending))) as executor:
+                for query, rewritten in zip(pending, executor.map(self._rewrite, pending)):
+                    results[query] = rewritten
+        print(f"查询改写：共{len(results)}个，命中缓存{len(results) - len(pending)}个")
+        return results
+
+    async def arewrite_many(self, queries):
+        """rewrite_many 的异步版本"""
+        results = {query: self._cache_get(query) for query in dict.fromkeys(queries)}
+        pending = [query for query, rewritten in results.items() if rewritten is None]
+        for query, rewritten in zip(pending, await asyncio.gather(*[self._arewrite(query) for query in pending])):
+            results[query] = rewritten
+        print(f"查询改写：共{len(results)}个，命中缓存{len(results) - len(pending)}个")
+        return results
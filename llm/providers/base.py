@@ -1,13 +1,41 @@
 from langchain_core.exceptions import OutputParserException
-from langchain_classic.chat_models import init_chat_model
 from langchain_classic.output_parsers import StructuredOutputParser, OutputFixingParser
 from langchain_classic.prompts import ChatPromptTemplate
-from langchain_ollama.llms import OllamaLLM
+from llm.providers.registry import get_llm_client
+from llm.providers.cache import ResponseCache, get_response_cache
+from llm.providers.streaming import JSONFieldExtractor, chunk_text
+from llm.providers.json_repair import get_parse_stats, record, repair_json
+from langchain_core.runnables import RunnableLambda
+from utils.token_utils import estimate_tokens
+from weakref import WeakKeyDictionary
+import asyncio
 import os
+import time
+
+
+# 每个事件循环一个信号量，限制进程内同时在途的提供商请求数
+_semaphores: WeakKeyDictionary = WeakKeyDictionary()
+
+
+def get_semaphore() -> asyncio.Semaphore:
+    """获取当前事件循环共享的并发信号量"""
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(int(os.getenv("LLM_MAX_CONCURRENCY", 64)))
+        _semaphores[loop] = semaphore
+    return semaphore
+
 
 class LLM():
-    def __init__(self, model, model_provider, model_kwargs={}, system_prompt="", user_prompt="", user_input="{user_input}", schemas=None, stream=False):
-        self.llm = self.__get_llm(model, model_provider, stream, model_kwargs)
+    def __init__(self, model, model_provider, model_kwargs={}, system_prompt="", user_prompt="", user_input="{user_input}", schemas=None, stream=False, cache: ResponseCache | None = None):
+        self.model = model
+        self.model_provider = model_provider
+        self.model_kwargs = model_kwargs
+        self.llm = get_llm_client(model, model_provider, stream, model_kwargs)
+        # 响应缓存为可选功能，未显式传入时由环境变量 LLM_CACHE_ENABLED 控制
+        self.cache = cache if cache is not None else get_response_cache()
+        self.last_stream_stats = None
         self.system_prompt = system_prompt
         self.user_prompt = user_prompt
         self.user_input = user_input
@@ -16,76 +44,274 @@ class LLM():
             ("system", self.user_prompt),
             ("user", self.user_input)
         ])
+        # 结构化输出优先使用提供商的原生 JSON 模式，解析失败先本地修复，最后才请求模型修复
+        self.json_mode = bool(schemas) and os.getenv("LLM_JSON_MODE", "true").lower() in ("1", "true", "yes")
+        self.parse_retries = int(os.getenv("LLM_PARSE_RETRIES", 4))
         if schemas:
             self.parser = StructuredOutputParser.from_response_schemas(schemas)
-            self.fixing_parser = OutputFixingParser.from_llm(self.llm, self.parser, max_retries=3)
+            self.fixing_parser = OutputFixingParser.from_llm(self.llm, self.parser, max_retries=int(os.getenv("LLM_FIX_RETRIES", 3)))
         else:
             self.parser = None # type: ignore
             self.fixing_parser = None # type: ignore
 
     def get_chain(self):
+        self.chain = self._build_chain(self.llm)
+
+    def _build_chain(self, client, max_tokens=None):
+        client = self._json_client(self._limit_client(client, max_tokens))
         if self.parser:
-            self.chain = self.template | self.llm | self.fixing_parser
-        else:
-            self.chain = self.template | self.llm
-            
+            return self.template | client | RunnableLambda(self._parse_output, afunc=self._aparse_output)
+        return self.template | client
+
+    def _limit_client(self, client, max_tokens):
+        """为单次调用设置输出 token 上限：Ollama 使用 num_predict，OpenAI 兼容接口使用 max_tokens"""
+        if not max_tokens:
+            return client
+        if self.model_provider.lower() == "ollama":
+            return client.model_copy(update={"num_predict": int(max_tokens)})
+        return client.bind(max_tokens=int(max_tokens))
+
+    def estimate_input_tokens(self, inputs) -> int:
+        """估算渲染后提示词的 token 数"""
+        return sum(estimate_tokens(str(message.content)) for message in self.template.format_messages(**inputs))
+
+    def _json_client(self, client):
+        """绑定提供商的原生 JSON 输出模式：Ollama 使用 format=json，OpenAI 兼容接口使用 response_format"""
+        if not self.json_mode:
+            return client
+        if self.model_provider.lower() == "ollama":
+            return client.bind(format="json")
+        return client.bind(response_format={"type": "json_object"})
+
+    def _disable_json_mode(self, e) -> bool:
+        """提供商不支持 JSON 模式时（请求参数错误）关闭该模式并重建调用链，返回是否需要重试"""
+        if not self.json_mode or getattr(e, "status_code", None) not in (400, 422):
+            return False
+        print(f"{self.model_provider}/{self.model} 不支持原生 JSON 模式，改用提示词约束格式: {e}")
+        self.json_mode = False
+        self.get_chain()
+        return True
 
-    def invoke(self, inputs):
+    def _parse_local(self, text):
+        """直接解析模型输出，失败时在本地宽松修复；均失败返回 None"""
+        try:
+            res = self.parser.parse(text) # type: ignore
+            record("parsed")
+            return res
+        except OutputParserException:
+            pass
+        res = repair_json(text)
+        if res is not None and all(schema.name in res for schema in self.parser.response_schemas): # type: ignore
+            record("repaired")
+            print(f"本地修复 JSON 成功，累计节省 {get_parse_stats()['saved_calls']} 次模型修复请求")
+            return res
+        return None
+
+    def _parse_output(self, message):
+        text = chunk_text(message)
+        res = self._parse_local(text)
+        if res is not None:
+            return res
+        record("fixer_calls")
+        try:
+            return self.fixing_parser.parse(text) # type: ignore
+        except OutputParserException:
+            record("failed")
+            raise
+
+    async def _aparse_output(self, message):
+        text = chunk_text(message)
+        res = self._parse_local(text)
+        if res is not None:
+            return res
+        record("fixer_calls")
+        try:
+            return await self.fixing_parser.aparse(text) # type: ignore
+        except OutputParserException:
+            record("failed")
+            raise
+
+
+    def cache_key(self, inputs, max_tokens=None):
+        """根据完整渲染后的消息生成缓存键"""
+        messages = self.template.format_messages(**inputs)
+        rendered = [(message.type, message.content) for message in messages]
+        model_kwargs = {**self.model_kwargs, "max_tokens": max_tokens} if max_tokens else self.model_kwargs
+        return self.cache.make_key(self.model_provider, self.model, model_kwargs, rendered) # type: ignore
+
+    def invoke(self, inputs, max_tokens=None):
+        """调用模型并解析输出，max_tokens 限制本次输出的 token 数"""
         if self.parser:
             inputs.update({"return_format": self.parser.get_format_instructions()})
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache_key(inputs, max_tokens)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return self.__unwrap(cached)
         try_num = 0
         while True:
             try:
-                res = self.chain.invoke(inputs)
+                res = (self._build_chain(self.llm, max_tokens) if max_tokens else self.chain).invoke(inputs)
             except OutputParserException as e:
-                if try_num > 3:
+                if try_num >= self.parse_retries:
                     raise e
                 try_num += 1
                 continue
             except Exception as e:
+                if self._disable_json_mode(e):
+                    continue
                 raise e
             break
+        if cache_key is not None:
+            self.cache.set(cache_key, res) # type: ignore
+        return self.__unwrap(res)
+
+    async def ainvoke(self, inputs, max_tokens=None):
+        """异步调用，所有异步请求共享同一个并发信号量"""
+        if self.parser:
+            inputs.update({"return_format": self.parser.get_format_instructions()})
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache_key(inputs, max_tokens)
+            # 缓存读写为同步 SQLite I/O，放到线程中执行，避免阻塞共享事件循环
+            cached = await asyncio.to_thread(self.cache.get, cache_key)
+            if cached is not None:
+                return self.__unwrap(cached)
+        try_num = 0
+        async with get_semaphore():
+            while True:
+                try:
+                    res = await (self._build_chain(self.llm, max_tokens) if max_tokens else self.chain).ainvoke(inputs)
+                except OutputParserException as e:
+                    if try_num >= self.parse_retries:
+                        raise e
+                    try_num += 1
+                    continue
+                except Exception as e:
+                    if self._disable_json_mode(e):
+                        continue
+                    raise e
+                break
+        if cache_key is not None:
+            await asyncio.to_thread(self.cache.set, cache_key, res) # type: ignore
+        return self.__unwrap(res)
+
+    def _stream_client(self):
+        """流式调用使用的客户端；OpenAI 兼容客户端在非流式模式下会禁用流式输出，需单独创建"""
+        return get_llm_client(self.model, self.model_provider, True, self.model_kwargs)
+
+    def _build_stream_chain(self, max_tokens=None):
+        """流式调用链只到模型输出为止，解析在流结束后进行"""
+        return self.template | self._json_client(self._limit_client(self._stream_client(), max_tokens))
+
+    def _prepare_stream(self, inputs, max_tokens=None):
+        """流式调用前的准备：补充格式说明，返回缓存键（未启用缓存时为 None）"""
+        if self.parser:
+            inputs.update({"return_format": self.parser.get_format_instructions()})
+        if self.cache is None:
+            return None
+        return self.cache_key(inputs, max_tokens)
+
+    def _replay_cached(self, cached, callback):
+        """命中缓存时直接回调完整结果，不统计首字延迟与生成速度"""
+        res = self.__unwrap(cached)
+        self.last_stream_stats = None
+        if callback:
+            callback(str(res))
+        return res
+
+    def _on_stream_chunk(self, chunk, state, extractor, callback):
+        text = chunk_text(chunk)
+        if not text:
+            return
+        if state["first_token"] is None:
+            state["first_token"] = time.perf_counter()
+        state["raw"].append(text)
+        delta = extractor.feed(text) if extractor else text
+        if delta and callback:
+            callback(delta)
+
+    def _finish_stream(self, state, extractor, stats=None):
+        """统计首字延迟与生成速度并在本地解析流式输出，返回 (原始文本, 解析结果)；需要模型修复格式时结果为 None"""
+        end = time.perf_counter()
+        raw = "".join(state["raw"])
+        first_token = state["first_token"] or end
+        tokens = estimate_tokens(raw)
+        generate_seconds = end - first_token
+        self.last_stream_stats = {
+            "ttft": first_token - state["start"],
+            "seconds": end - state["start"],
+            "tokens": tokens,
+            "tokens_per_second": tokens / generate_seconds if generate_seconds > 0 else 0.0,
+        }
+        if stats is not None:
+            stats.update(self.last_stream_stats)
+        if not self.parser:
+            return raw, raw
+        res = self._parse_local(raw)
+        if res is None:
+            # 目标字段已完整解析时无需再请求模型修复格式
+            if extractor and extractor.done:
+                record("repaired")
+                return raw, {extractor.field: extractor.value}
+            record("fixer_calls")
+        return raw, res
+
+    def stream(self, inputs, callback=None, field="content", stats=None, max_tokens=None):
+        """流式调用：输出为 JSON 时逐步提取 field 字段文本并回调增量，结束后返回与 invoke 相同的结果
+
+        首字延迟与生成速度写入 stats（多线程共用实例时使用），同时记录在 last_stream_stats 中；命中缓存时不统计。
+        """
+        cache_key = self._prepare_stream(inputs, max_tokens)
+        cached = self.cache.get(cache_key) if cache_key is not None else None # type: ignore
+        if cached is not None:
+            return self._replay_cached(cached, callback)
+        extractor = JSONFieldExtractor(field) if self.parser else None
+        state = {"start": time.perf_counter(), "first_token": None, "raw": []}
+        try:
+            for chunk in self._build_stream_chain(max_tokens).stream(inputs):
+                self._on_stream_chunk(chunk, state, extractor, callback)
+        except Exception as e:
+            if state["raw"] or not self._disable_json_mode(e):
+                raise e
+            return self.stream(inputs, callback, field, stats, max_tokens)
+        raw, res = self._finish_stream(state, extractor, stats)
+        if res is None:
+            res = self.fixing_parser.parse(raw) # type: ignore
+        if cache_key is not None:
+            self.cache.set(cache_key, res) # type: ignore
+        return self.__unwrap(res)
+
+    async def astream(self, inputs, callback=None, field="content", stats=None, max_tokens=None):
+        """异步流式调用，与 stream 一致，共享并发信号量；缓存读写与格式修复不阻塞事件循环"""
+        cache_key = self._prepare_stream(inputs, max_tokens)
+        cached = await asyncio.to_thread(self.cache.get, cache_key) if cache_key is not None else None # type: ignore
+        if cached is not None:
+            return self._replay_cached(cached, callback)
+        extractor = JSONFieldExtractor(field) if self.parser else None
+        retry = False
+        async with get_semaphore():
+            state = {"start": time.perf_counter(), "first_token": None, "raw": []}
+            try:
+                async for chunk in self._build_stream_chain(max_tokens).astream(inputs):
+                    self._on_stream_chunk(chunk, state, extractor, callback)
+            except Exception as e:
+                if state["raw"] or not self._disable_json_mode(e):
+                    raise e
+                retry = True
+        if retry:
+            # 在信号量外重试，避免重复占用
+            return await self.astream(inputs, callback, field, stats, max_tokens)
+        raw, res = self._finish_stream(state, extractor, stats)
+        if res is None:
+            res = await self.fixing_parser.aparse(raw) # type: ignore
+        if cache_key is not None:
+            await asyncio.to_thread(self.cache.set, cache_key, res) # type: ignore
+        return self.__unwrap(res)
+
+    def __unwrap(self, res):
         try:
             return res["content"]
         except (KeyError, TypeError):
-            return res  
-
-    def __get_llm(self, model, model_provider:str, stream=False, model_kwargs={}):
-        """初始化LLM客户端"""
-        # 获取对应提供商的配置
-        provider_upper = model_provider.upper()
-        base_url = os.getenv(f"{provider_upper}_BASE_URL", None)
-        api_key = os.getenv(f"{provider_upper}_API_KEY", None)
-        
-        # 调试信息
-        print(f"\n==== LLM 初始化 ====")
-        print(f"提供商: {model_provider}")
-        print(f"模型: {model}")
-        print(f"Base URL: {base_url}")
-        print(f"API Key: {'已配置' if api_key and api_key != 'sk-' else '未配置或无效'}")
-        print(f"==================\n")
-        
-        # 验证配置
-        if base_url is None and api_key is None:
-            raise ValueError(f"Invalid model provider: {model_provider}, please check your model setting")
-        
-        # 根据提供商选择LLM类型
-        if model_provider.lower() == "ollama":
-            _get_llm = OllamaLLM
-            return _get_llm(
-                model=model, 
-                base_url=base_url, 
-                **model_kwargs
-            )
-        else:
-            # 其他提供商使用OpenAI兼容接口
-            _get_llm = init_chat_model
-            return _get_llm(
-                model=model, 
-                model_provider="openai",  # 使用OpenAI兼容接口
-                base_url=base_url, 
-                api_key=api_key, 
-                disable_streaming=not stream, 
-                **model_kwargs
-            ) 
-
+            return res
@@ -0,0 +1,122 @@
+"""
+LLM 响应缓存模块
+基于 SQLite 的磁盘缓存，按 提供商/模型/参数/渲染后的消息 作为键，支持 TTL 与 LRU 容量淘汰
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+
+class ResponseCache():
+    """LLM 响应磁盘缓存"""
+
+    def __init__(self, path=".db/llm_cache.db", ttl=0, max_entries=10000):
+        self.path = path
+        self.ttl = ttl  # 秒，0 表示永不过期
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_provider, model, model_kwargs, messages):
+        """根据提供商、模型、参数和渲染后的消息生成缓存键"""
+        payload = json.dumps({
+            "provider": model_provider.lower(),
+            "model": model,
+            "kwargs": model_kwargs,
+            "messages": messages,
+        }, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """读取缓存，未命中返回 None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at = row
+            if self.ttl and now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        """写入缓存，超出容量时按最近访问时间淘汰"""
+        try:
+            data = json.dumps(value, ensure_ascii=False)
+        except (TypeError, ValueError):
+            # 无法序列化的结果不缓存
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, data, now, now)
+            )
+            if self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN ("
+                    "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            self._conn.commit()
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """返回缓存命中统计"""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": size,
+        }
+
+
+_response_cache = None
+_response_cache_lock = Lock()
+
+
+def get_response_cache():
+    """获取进程内共享的响应缓存，未通过 LLM_CACHE_ENABLED 启用时返回 None"""
+    global _response_cache
+    if os.getenv("LLM_CACHE_ENABLED", "false").lower() not in ("1", "true", "yes"):
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(
+                path=os.getenv("LLM_CACHE_PATH", ".db/llm_cache.db"),
+                ttl=int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600)),
+                max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000)),
+            )
+    return _response_cache
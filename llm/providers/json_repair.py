@@ -0,0 +1,156 @@
+"""
+本地 JSON 修复模块
+模型输出的 JSON 格式有误时，先在本地做宽松修复（去除代码块与多余文字、尾随逗号、未转义的换行与引号、截断的括号等），
+修复失败才交给 OutputFixingParser 请求模型重写；并统计各解析路径的次数与节省的修复请求
+"""
+from threading import Lock
+import json
+import re
+
+
+_stats = {
+    "parsed": 0,  # 直接解析成功
+    "repaired": 0,  # 本地修复成功，节省一次模型修复请求
+    "fixer_calls": 0,  # 交给 OutputFixingParser 请求模型修复
+    "failed": 0,  # 模型修复后仍失败
+}
+_stats_lock = Lock()
+
+_FENCE_PATTERN = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_TRAILING_COMMA_PATTERN = re.compile(r",(\s*[}\]])")
+
+
+def record(event):
+    """记录一次解析结果"""
+    with _stats_lock:
+        _stats[event] += 1
+
+
+def get_parse_stats() -> dict:
+    """返回各解析路径的累计次数，saved_calls 为本地修复节省的模型请求数"""
+    with _stats_lock:
+        stats: dict = dict(_stats)
+    stats["saved_calls"] = stats["repaired"]
+    total = stats["parsed"] + stats["repaired"] + stats["fixer_calls"]
+    stats["fixer_rate"] = stats["fixer_calls"] / total if total else 0.0
+    return stats
+
+
+def _extract(text) -> str:
+    """去除代码块包裹以及 JSON 前后的说明文字"""
+    match = _FENCE_PATTERN.search(text)
+    if match and "{" in match.group(1):
+        text = match.group(1)
+    start = text.find("{")
+    if start < 0:
+        return text.strip()
+    end = text.rfind("}")
+    return text[start:end + 1] if end > start else text[start:]
+
+
+def _escape_strings(text) -> str:
+    """转义字符串内的换行与制表符；字符串内部未转义的双引号，若其后不是 , : } ] 则视为正文中的引号并转义"""
+    result = []
+    in_string = False
+    escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                rest = text[i + 1:].lstrip()
+                if rest and rest[0] not in ",:}]":
+                    result.append('\\"')
+                    continue
+                in_string = False
+            elif char == "\n":
+                result.append("\\n")
+                continue
+            elif char == "\r":
+                continue
+            elif char == "\t":
+                result.append("\\t")
+                continue
+        elif char == '"':
+            in_string = True
+        result.append(char)
+    return "".join(result)
+
+
+def _close(text) -> str:
+    """补全截断输出中未闭合的字符串与括号"""
+    stack = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = _TRAILING_COMMA_PATTERN.sub(r"\1", text.rstrip().rstrip(","))
+    return text + "".join(reversed(stack))
+
+
+def _structural_quotes(text) -> str:
+    """将 JSON 结构位置上的中文引号换成英文引号：字符串之外紧跟 { [ , : 的“，以及由“开始的字符串中后面紧跟 : , } ] 的”；
+    英文引号字符串内（如正文中的人物对话）的中文引号保持不变"""
+    result = []
+    closer = None  # 当前字符串的结束引号，None 表示在字符串之外
+    escaped = False
+    previous = ""  # 上一个非空白字符
+    for i, char in enumerate(text):
+        if closer is not None:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == closer == '"':
+                closer = None
+            elif char == closer == "”":
+                rest = text[i + 1:].lstrip()
+                if not rest or rest[0] in ":,}]":
+                    char = '"'
+                    closer = None
+        elif char == '"':
+            closer = '"'
+        elif char == "“" and previous in ("{", "[", ",", ":"):
+            char = '"'
+            closer = "”"
+        result.append(char)
+        if not char.isspace():
+            previous = char
+    return "".join(result)
+
+
+def repair_json(text):
+    """宽松解析模型输出中的 JSON 对象，失败返回 None"""
+    if not isinstance(text, str):
+        return None
+    candidate = _extract(text)
+    for repair in (
+        lambda s: s,
+        lambda s: _TRAILING_COMMA_PATTERN.sub(r"\1", s),
+        lambda s: _close(_escape_strings(s)),
+        # 中文引号包裹的键值，只替换结构位置上的引号
+        lambda s: _close(_escape_strings(_structural_quotes(s))),
+    ):
+        try:
+            value = json.loads(repair(candidate), strict=False)
+        except (json.JSONDecodeError, ValueError):
+            continue
+        if isinstance(value, dict):
+            return value
+    return None
@@ -0,0 +1,101 @@
+"""
+LLM 客户端注册表
+按 (提供商, 模型, 参数) 在进程内复用模型客户端，并按提供商共享带连接池上限的 HTTP 客户端
+"""
+from langchain_classic.chat_models import init_chat_model
+from langchain_ollama.llms import OllamaLLM
+from threading import Lock
+import hashlib
+import httpx
+import json
+import os
+
+
+_clients = {}
+_http_clients = {}
+_lock = Lock()
+
+
+def get_pool_limits() -> httpx.Limits:
+    """连接池上限，可通过环境变量调整"""
+    return httpx.Limits(
+        max_connections=int(os.getenv("LLM_POOL_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(os.getenv("LLM_POOL_MAX_KEEPALIVE", 20)),
+        keepalive_expiry=float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", 30)),
+    )
+
+
+def get_http_clients(base_url):
+    """获取指定服务地址共享的同步/异步 HTTP 客户端"""
+    with _lock:
+        clients = _http_clients.get(base_url)
+        if clients is None:
+            limits = get_pool_limits()
+            timeout = httpx.Timeout(float(os.getenv("LLM_HTTP_TIMEOUT", 600)), connect=10.0)
+            clients = (
+                httpx.Client(limits=limits, timeout=timeout),
+                httpx.AsyncClient(limits=limits, timeout=timeout),
+            )
+            _http_clients[base_url] = clients
+        return clients
+
+
+def get_llm_client(model, model_provider: str, stream=False, model_kwargs={}):
+    """获取共享的 LLM 客户端，同一配置在进程内只初始化一次"""
+    provider_upper = model_provider.upper()
+    base_url = os.getenv(f"{provider_upper}_BASE_URL", None)
+    api_key = os.getenv(f"{provider_upper}_API_KEY", None)
+    # 密钥只参与哈希，保证修改配置后会重新创建客户端
+    key = (
+        model_provider.lower(),
+        model,
+        stream,
+        json.dumps(model_kwargs, sort_keys=True, default=str),
+        base_url,
+        hashlib.sha256((api_key or "").encode("utf-8")).hexdigest(),
+    )
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    client = _create_llm(model, model_provider, base_url, api_key, stream, model_kwargs)
+    with _lock:
+        # 并发创建时以先写入者为准
+        client = _clients.setdefault(key, client)
+    return client
+
+
+def _create_llm(model, model_provider: str, base_url, api_key, stream=False, model_kwargs={}):
+    """初始化LLM客户端"""
+    # 调试信息
+    print(f"\n==== LLM 初始化 ====")
+    print(f"提供商: {model_provider}")
+    print(f"模型: {model}")
+    print(f"Base URL: {base_url}")
+    print(f"API Key: {'已配置' if api_key and api_key != 'sk-' else '未配置或无效'}")
+    print(f"==================\n")
+
+    # 验证配置
+    if base_url is None and api_key is None:
+        raise ValueError(f"Invalid model provider: {model_provider}, please check your model setting")
+
+    # 根据提供商选择LLM类型
+    if model_provider.lower() == "ollama":
+        return OllamaLLM(
+            model=model,
+            base_url=base_url,
+            client_kwargs={"limits": get_pool_limits()},
+            **model_kwargs
+        )
+    else:
+        # 其他提供商使用OpenAI兼容接口
+        http_client, http_async_client = get_http_clients(base_url)
+        return init_chat_model(
+            model=model,
+            model_provider="openai",  # 使用OpenAI兼容接口
+            base_url=base_url,
+            api_key=api_key,
+            disable_streaming=not stream,
+            http_client=http_client,
+            http_async_client=http_async_client,
+            **model_kwargs
+        )
@@ -0,0 +1,106 @@
+"""
+流式输出解析模块
+模型按 JSON 格式返回时，在输出尚未结束前增量提取指定字段的字符串值，用于边生成边展示正文
+"""
+from langchain_core.messages import BaseMessage
+
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def chunk_text(chunk) -> str:
+    """取出流式分块中的文本：LLM 返回字符串，聊天模型返回消息分块"""
+    if isinstance(chunk, str):
+        return chunk
+    content = chunk.content if isinstance(chunk, BaseMessage) else getattr(chunk, "content", "")
+    if isinstance(content, list):
+        return "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+    return content or ""
+
+
+class JSONFieldExtractor():
+    """增量提取 JSON 中指定键的字符串值
+
+    逐字符扫描，只识别字符串、冒号与转义，不校验整体结构，因此可以容忍 ```json 代码块包裹与分块边界落在转义序列中间。
+    """
+
+    def __init__(self, field="content"):
+        self.field = field
+        self.value = ""
+        self.done = False
+        self._state = "scan"
+        self._in_target = False
+        self._expect_value = False
+        self._string = []
+        self._last_string = None
+        self._unicode = ""
+        self._high_surrogate = None
+
+    def feed(self, text) -> str:
+        """输入新的输出片段，返回本次新解析出的字段文本"""
+        emitted = []
+        for char in text:
+            if self.done:
+                break
+            self._step(char, emitted)
+        delta = "".join(emitted)
+        self.value += delta
+        return delta
+
+    def _append(self, char, emitted):
+        if self._in_target:
+            emitted.append(char)
+        else:
+            self._string.append(char)
+
+    def _step(self, char, emitted):
+        state = self._state
+        if state == "scan":
+            if char == '"':
+                self._state = "string"
+                self._in_target = self._expect_value
+                self._string = []
+            elif self._expect_value and not char.isspace():
+                # 目标键的值不是字符串
+                self._expect_value = False
+        elif state == "string":
+            if char == "\\":
+                self._state = "escape"
+            elif char == '"':
+                if self._in_target:
+                    self.done = True
+                    return
+                self._last_string = "".join(self._string)
+                self._state = "after_string"
+            else:
+                self._append(char, emitted)
+        elif state == "escape":
+            if char == "u":
+                self._state = "unicode"
+                self._unicode = ""
+                return
+            self._append(_ESCAPES.get(char, char), emitted)
+            self._state = "string"
+        elif state == "unicode":
+            self._unicode += char
+            if len(self._unicode) < 4:
+                return
+            self._state = "string"
+            try:
+                code = int(self._unicode, 16)
+            except ValueError:
+                return
+            if 0xD800 <= code < 0xDC00:
+                self._high_surrogate = code
+                return
+            if 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+                code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+            self._append(chr(code), emitted)
+        elif state == "after_string":
+            if char.isspace():
+                return
+            self._expect_value = char == ":" and self._last_string == self.field
+            self._state = "scan"
+            if char != ":":
+                self._step(char, emitted)
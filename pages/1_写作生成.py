@@ -6,9 +6,10 @@ import streamlit as st
 import os
 from dotenv import load_dotenv
 from warnings import filterwarnings
-from config.project_config import get_projects
-from core.workflows.novel_workflow import NovelWorkflow
+from config.project_config import get_projects, get_config
 from app.components.input_card import create_input_card
+from app.components.index_status import display_index_status, request_knowledge_base_update
+from app.components.job_status import JOB_NAMES, attach_jobs, completed_novel_chapters, discard_novel_run, display_jobs, display_stream_preview, pop_finished_jobs, resumable_novel_run, submit_job
 from app.components.model_selector import (
     create_model_selector, 
     create_special_model_selector, 
@@ -51,9 +52,47 @@ with col1:
 with col2:
     refresh_button = st.button("更新知识库", use_container_width=True)
     if refresh_button and project:
-        wf = NovelWorkflow(project)
-        wf.update()
-        st.toast("知识库更新完成")
+        # 优先交给后台索引服务，页面不阻塞在索引上
+        if request_knowledge_base_update(project):
+            st.toast("已安排后台增量更新知识库")
+        elif submit_job("update", project, {}):
+            st.toast("已提交知识库更新任务")
+if project:
+    display_index_status(project)
+    attach_jobs(project)
+
+
+def apply_finished_job(kind, job):
+    """将结束的任务结果写回页面，需在创建输入控件之前调用"""
+    label = JOB_NAMES.get(kind, kind)
+    result = job["result"] or {}
+    if job["status"] == "succeeded" and kind == "outlines":
+        st.session_state["outlines_generated_text"] = result["text"]
+        st.session_state["outline_list"] = result["list"]
+    elif job["status"] == "succeeded" and kind == "detailed_outlines":
+        st.session_state["detailed_outlines_generated_text"] = result["text"]
+        st.session_state["detailed_outline_list"] = result["list"]
+    elif kind == "novels":
+        # 取消或失败时也保留已完成的章节；继续生成的任务在生成内容为空时一并写回检查点中此前完成的章节
+        chapters, start = result.get("chapters", []), result.get("start", 1)
+        if start > 1 and not st.session_state.get("content_generated_text"):
+            chapters, start = completed_novel_chapters(job["project"], result["run_id"], start - 1) + chapters, 1
+        for i, content in enumerate(chapters, start):
+            if content:
+                current_text = st.session_state.get("content_generated_text", "")
+                st.session_state["content_generated_text"] = current_text + f"## 章节{i}\n" + str(content) + "\n\n"
+    if job["status"] == "succeeded":
+        st.toast(f"{label}完成")
+    elif job["status"] == "failed":
+        st.error(f"{label}时发生错误: {job['error']}")
+    elif job["status"] == "cancelled":
+        st.toast(f"{label}已取消")
+    else:
+        st.warning(f"{label}已中断：{job['message']}")
+
+
+for kind, job in pop_finished_jobs().items():
+    apply_finished_job(kind, job)
 
 # 输入区域
 col4, col5, col6 = st.columns([1, 1, 1], vertical_alignment="bottom", gap="medium")
@@ -107,13 +146,14 @@ with col6:
         height=440
     )
 
-# 进度条
-bar = st.progress(0)
+# 后台任务进度
+display_jobs()
 
 # 生成内容区域
 col7, col8 = st.columns([1, 2], gap="medium")
 
 with col8:
+    display_stream_preview("novels")
     novel_generate_area = create_input_card(
         "content_generated", 
         "生成内容", 
@@ -127,29 +167,38 @@ with col7:
     model_provider_selection, model_selection = create_model_selector()
     special_model_provider_selection, extractor_model_selection, short_model_selection = create_special_model_selector()
     model_kwargs = create_model_settings()
+    pipelined = st.checkbox("流水线生成", value=True, help="在生成当前章节正文时预先检索下一章节的相关信息")
+    streaming = st.checkbox("流式生成", value=True, help="边生成边显示章节正文，并统计首字延迟与生成速度")
+
+    def check_models():
+        """检查项目与模型选择"""
+        if not project:
+            st.toast("请先选择项目")
+            return False
+        if not model_provider_selection:
+            st.toast("请先选择模型服务商")
+            return False
+        if not model_selection:
+            st.toast("请先选择模型")
+            return False
+        return True
+
+    def job_models():
+        """后台任务使用的模型配置，与 get_workflow 的参数一致"""
+        return {
+            "model": model_selection,
+            "model_provider": model_provider_selection,
+            "extractor_model": extractor_model_selection,
+            "short_model": short_model_selection,
+            "special_model_provider": special_model_provider_selection,
+            "model_kwargs": model_kwargs,
+        }
 
     def outlines_generate():
-        """生成大纲"""
+        """提交大纲生成任务"""
         try:
-            if not project:
-                st.toast("请先选择项目")
-                return
-            if not model_provider_selection:
-                st.toast("请先选择模型服务商")
+            if not check_models():
                 return
-            if not model_selection:
-                st.toast("请先选择模型")
-                return
-            
-            wf = NovelWorkflow(
-                project, 
-                model_selection, 
-                model_provider_selection, 
-                extractor_model_selection, 
-                short_model_selection, 
-                special_model_provider_selection, 
-                model_kwargs
-            )
             inputs = {
                 "user_input": st.session_state.get("user_input_text"),
                 "temp_settings": st.session_state.get("temp_settings_text"),
@@ -157,41 +206,21 @@ with col7:
                 "words_num": words_num,
                 "outlines_description": st.session_state.get("outlines_description_text")
             }
-            outline_str, outline_list = wf.generate_outlines(inputs, lambda p: bar.progress(p))
-            st.session_state["outlines_generated_text"] = outline_str
-            st.session_state["outline_list"] = outline_list
-            bar.progress(100)
-            st.toast("生成完成")
+            if submit_job("outlines", project, {"models": job_models(), "inputs": inputs}):
+                st.toast("已提交大纲生成任务")
         except Exception as e:
             st.error(f"生成大纲时发生错误: {e}")
             import traceback
             st.error(traceback.format_exc())
 
     def detailed_outlines_generate():
-        """生成细纲"""
+        """提交细纲生成任务"""
         try:
-            if not project:
-                st.toast("请先选择项目")
-                return
-            if not model_provider_selection:
-                st.toast("请先选择模型服务商")
-                return
-            if not model_selection:
-                st.toast("请先选择模型")
+            if not check_models():
                 return
             if not st.session_state.get("outline_list"):
                 st.toast("请先生成章节大纲")
                 return
-            
-            wf = NovelWorkflow(
-                project, 
-                model_selection, 
-                model_provider_selection, 
-                extractor_model_selection, 
-                short_model_selection, 
-                special_model_provider_selection, 
-                model_kwargs
-            )
             inputs = {
                 "user_input": st.session_state.get("user_input_text"),
                 "temp_settings": st.session_state.get("temp_settings_text"),
@@ -200,38 +229,18 @@ with col7:
                 "outlines_description": st.session_state.get("outlines_description_text"),
                 "chapter_outlines": st.session_state.get("outline_list")
             }
-            detailed_outline_str, detailed_outline_list = wf.generate_detailed_outlines(inputs, lambda p: bar.progress(p))
-            st.session_state["detailed_outlines_generated_text"] = detailed_outline_str
-            st.session_state["detailed_outline_list"] = detailed_outline_list
-            bar.progress(100)
-            st.toast("细纲生成完成")
+            if submit_job("detailed_outlines", project, {"models": job_models(), "inputs": inputs}):
+                st.toast("已提交细纲生成任务")
         except Exception as e:
             st.error(f"生成细纲时发生错误: {e}")
             import traceback
             st.error(traceback.format_exc())
 
     def novel_generate():
-        """生成小说"""
+        """提交章节生成任务"""
         try:
-            if not project:
-                st.toast("请先选择项目")
-                return
-            if not model_provider_selection:
-                st.toast("请先选择模型服务商")
-                return
-            if not model_selection:
-                st.toast("请先选择模型")
+            if not check_models():
                 return
-            
-            wf = NovelWorkflow(
-                project, 
-                model_selection, 
-                model_provider_selection, 
-                extractor_model_selection, 
-                short_model_selection, 
-                special_model_provider_selection, 
-                model_kwargs
-            )
             if st.session_state.get("outlines_generated_text"):
                 inputs = {
                     "user_input": st.session_state.get("user_input_text"),
@@ -241,22 +250,8 @@ with col7:
                     "generated_outlines": st.session_state.get("outline_list") if st.session_state.get("outline_list") else st.session_state.get("outlines_generated_text", "").split("\\n\\n"),
                     "outlines_description": st.session_state.get("outlines_description_text")
                 }
-                
-                # 创建状态显示区域
-                status_placeholder = st.empty()
-                
-                for i, content in enumerate(wf.generate_novels(
-                    inputs, 
-                    lambda p: bar.progress(p),
-                    lambda s: status_placeholder.info(s)
-                )):
-                    if content:
-                        current_text = st.session_state.get("content_generated_text", "")
-                        st.session_state["content_generated_text"] = current_text + f"## 章节{i+1}\n" + str(content) + "\n\n"
-                
-                status_placeholder.success("🎉 全部章节生成完成！")
-                bar.progress(100)
-                st.toast("生成完成")
+                if submit_job("novels", project, {"models": job_models(), "inputs": inputs, "pipelined": pipelined, "stream": streaming}):
+                    st.toast("已提交章节生成任务")
             else:
                 st.toast("请生成或输入大纲内容")
         except Exception as e:
@@ -264,6 +259,18 @@ with col7:
             import traceback
             st.error(traceback.format_exc())
 
+    def novel_resume(run_id):
+        """提交从检查点继续生成章节的任务"""
+        try:
+            if not check_models():
+                return
+            if submit_job("novels", project, {"models": job_models(), "resume_run_id": run_id, "pipelined": pipelined, "stream": streaming}):
+                st.toast("已提交继续生成任务")
+        except Exception as e:
+            st.error(f"继续生成时发生错误: {e}")
+            import traceback
+            st.error(traceback.format_exc())
+
     outlines_gen_button = st.button(
         "自动生成大纲", 
         use_container_width=True, 
@@ -282,6 +289,25 @@ with col7:
         type="primary", 
         on_click=novel_generate
     )
+    resumable_run = resumable_novel_run(project) if project else None
+    if resumable_run:
+        col_resume, col_discard = st.columns([4, 1], gap="small")
+        with col_resume:
+            st.button(
+                f"继续生成章节（已完成 {resumable_run['completed']}/{resumable_run['total_chapters']} 章）",
+                use_container_width=True,
+                help="上次章节生成被中断或失败，从最后完成的章节继续，已完成的章节不会重新生成",
+                on_click=novel_resume,
+                args=(resumable_run["id"],)
+            )
+        with col_discard:
+            st.button(
+                "放弃",
+                use_container_width=True,
+                help="删除上次未完成的章节生成进度",
+                on_click=discard_novel_run,
+                args=(project, resumable_run["id"])
+            )
     save_button = st.button("保存", use_container_width=True, type="primary")
 
     @st.dialog("保存内容")
@@ -301,9 +327,8 @@ with col7:
                     return
                 
                 try:
-                    # 重新初始化 workflow 以确保路径正确
-                    wf = NovelWorkflow(project)
-                    save_dir = wf.context_retriever.document_processor.documents_dir
+                    # 直接读取项目配置中的上下文目录，无需初始化工作流
+                    save_dir = get_config(project).context_documents
                     
                     if not os.path.exists(save_dir):
                         os.makedirs(save_dir, exist_ok=True)
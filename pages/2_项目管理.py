@@ -7,8 +7,10 @@ import subprocess
 import platform
 import os
 from config.project_config import get_projects, get_config, create_new_project, delete_project
-from core.workflows.novel_workflow import NovelWorkflow
+from core.workflows.novel_workflow import release_project
 from app.components.file_manager import display_file_list_with_delete
+from app.components.index_status import display_index_status, request_knowledge_base_update
+from app.components.job_status import attach_jobs, display_jobs, pop_finished_jobs, submit_job
 
 
 def open_folder(folder_path):
@@ -91,9 +93,11 @@ with col2:
     refresh_button = st.button("更新项目", use_container_width=True)
     if refresh_button and project:
         try:
-            wf = NovelWorkflow(project)
-            wf.update()
-            st.toast("项目更新完成")
+            # 优先交给后台索引服务，页面不阻塞在索引上
+            if request_knowledge_base_update(project):
+                st.toast("已安排后台增量更新项目知识库")
+            elif submit_job("update", project, {}):
+                st.toast("已提交项目更新任务")
         except Exception as e:
             st.error(f"项目更新失败: {e}")
 with col3:
@@ -109,6 +113,8 @@ with col3:
                 submit = st.button("确认")
             if submit:
                 if res == confirm_word:
+                    # 先释放缓存的向量库与记录库句柄
+                    release_project(project)
                     if delete_project(project):
                         st.toast(f"项目{project}删除完成", duration=5)
                     else:
@@ -130,6 +136,14 @@ if project not in get_projects() and project is not None:
         else:
             st.toast(f"项目{project}创建失败", duration=5)
 elif project:
+    display_index_status(project)
+    attach_jobs(project)
+    for job in pop_finished_jobs(["update"]).values():
+        if job["status"] == "succeeded":
+            st.toast("项目更新完成")
+        elif job["status"] == "failed":
+            st.error(f"项目更新失败: {job['error']}")
+    display_jobs(["update"])
     # 知识库管理
     tab1, tab2, tab3 = st.tabs(["项目知识库", "上下文知识库", "背景知识库"])
     
@@ -0,0 +1,168 @@
+"""
+嵌入向量缓存模块
+基于 SQLite 的磁盘缓存，按 嵌入模型/文本哈希 作为键，以紧凑的 float16/float32 数组存储
+索引与查询共用同一份缓存，重建向量库或重复查询时不再重复计算嵌入
+"""
+from langchain_core.embeddings import Embeddings
+from threading import Lock
+import asyncio
+import hashlib
+import numpy as np
+import os
+import sqlite3
+
+
+class EmbeddingCache():
+    """嵌入向量磁盘缓存"""
+
+    def __init__(self, path=".db/embedding_cache.db", dtype="float16"):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache ("
+            "key TEXT PRIMARY KEY, dtype TEXT NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(namespace, text):
+        """根据嵌入模型命名空间与文本内容生成缓存键"""
+        return hashlib.sha256(f"{namespace}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys) -> dict[str, list[float]]:
+        """批量读取缓存，返回命中的 键 -> 向量"""
+        found = {}
+        with self._lock:
+            # SQLite 单条语句的参数数量有限，分批查询
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, dtype, vector FROM embedding_cache WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                for key, dtype, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=dtype).astype(np.float32).tolist()
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def set_many(self, items: dict[str, list[float]]):
+        """批量写入缓存"""
+        rows = [
+            (key, self.dtype.name, np.asarray(vector, dtype=self.dtype).tobytes())
+            for key, vector in items.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (key, dtype, vector) VALUES (?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embedding_cache")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """返回缓存命中统计"""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": size,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """带磁盘缓存的嵌入模型包装，只对未命中的文本调用底层模型"""
+
+    def __init__(self, embeddings: Embeddings, namespace: str, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.namespace = namespace
+        self.cache = cache
+
+    def _keys(self, texts, kind):
+        return [self.cache.make_key(f"{self.namespace}:{kind}", text) for text in texts]
+
+    def _lookup(self, texts, kind):
+        """返回 (缓存键列表, 已命中向量, 需要计算的去重文本及其键)"""
+        keys = self._keys(texts, kind)
+        found = self.cache.get_many(keys)
+        missing: dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        return keys, found, missing
+
+    def _store(self, found, missing, vectors):
+        computed = dict(zip(missing, vectors))
+        if computed:
+            self.cache.set_many(computed)
+        found.update(computed)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, found, missing = self._lookup(texts, "document")
+        if missing:
+            self._store(found, missing, self.embeddings.embed_documents(list(missing.values())))
+        return [found[key] for key in keys]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        # 缓存读写为同步 SQLite I/O，放到线程中执行，避免阻塞共享事件循环
+        keys, found, missing = await asyncio.to_thread(self._lookup, texts, "document")
+        if missing:
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            await asyncio.to_thread(self._store, found, missing, vectors)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        # 部分模型的查询嵌入与文档嵌入不同，使用独立的命名空间
+        keys, found, missing = self._lookup([text], "query")
+        if missing:
+            self._store(found, missing, [self.embeddings.embed_query(text)])
+        return found[keys[0]]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        keys, found, missing = await asyncio.to_thread(self._lookup, [text], "query")
+        if missing:
+            vectors = [await self.embeddings.aembed_query(text)]
+            await asyncio.to_thread(self._store, found, missing, vectors)
+        return found[keys[0]]
+
+
+_embedding_cache = None
+_embedding_cache_lock = Lock()
+
+
+def get_embedding_cache():
+    """获取进程内共享的嵌入缓存，EMBEDDING_CACHE_ENABLED=false 时返回 None"""
+    global _embedding_cache
+    if os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() not in ("1", "true", "yes"):
+        return None
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(
+                path=os.getenv("EMBEDDING_CACHE_PATH", ".db/embedding_cache.db"),
+                dtype=os.getenv("EMBEDDING_CACHE_DTYPE", "float16"),
+            )
+    return _embedding_cache
+
+
+def cache_embeddings(embeddings: Embeddings, namespace: str) -> Embeddings:
+    """为嵌入模型加上磁盘缓存，未启用缓存时原样返回"""
+    cache = get_embedding_cache()
+    if cache is None:
+        return embeddings
+    return CachedEmbeddings(embeddings, namespace, cache)
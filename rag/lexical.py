@@ -0,0 +1,90 @@
+"""
+本地词法检索模块
+基于字符 n-gram 的中文 BM25 倒排索引，与向量库并存于 .vectordb/<知识库>/ 目录
+"""
+from langchain_core.documents import Document
+from collections import Counter
+import gzip
+import heapq
+import json
+import math
+import re
+
+
+_TOKEN_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[A-Za-z0-9]+")
+
+
+def tokenize(text, ngram=2):
+    """中文按字符 1~ngram 元组切分，英文与数字按整词切分"""
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(text or ""):
+        run = match.group()
+        if run.isascii():
+            tokens.append(run.lower())
+            continue
+        for n in range(1, ngram + 1):
+            tokens.extend(run[i:i + n] for i in range(len(run) - n + 1))
+    return tokens
+
+
+class BM25Index():
+    """BM25 倒排索引"""
+
+    def __init__(self, documents: list[Document], k1=1.5, b=0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, dict[int, int]] = {}
+        self.doc_lens = []
+        for doc_id, document in enumerate(documents):
+            counts = Counter(tokenize(document.page_content))
+            self.doc_lens.append(sum(counts.values()))
+            for token, tf in counts.items():
+                self.postings.setdefault(token, {})[doc_id] = tf
+        self.avgdl = (sum(self.doc_lens) / len(self.doc_lens)) if self.doc_lens else 0.0
+        total = len(documents)
+        self.idf = {
+            token: math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+            for token, posting in self.postings.items()
+        }
+
+    def __len__(self):
+        return len(self.documents)
+
+    def search(self, query, k=20) -> list[tuple[Document, float]]:
+        """返回得分最高的 k 个文档及其 BM25 得分"""
+        scores: dict[int, float] = {}
+        for token, qtf in Counter(tokenize(query)).items():
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = self.idf[token]
+            for doc_id, tf in posting.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_lens[doc_id] / self.avgdl)
+                scores[doc_id] = scores.get(doc_id, 0.0) + qtf * idf * tf * (self.k1 + 1) / norm
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.documents[doc_id], score) for doc_id, score in top]
+
+    def save(self, path):
+        """持久化文档内容，加载时重建倒排表"""
+        data = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in self.documents]
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path) -> "BM25Index":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls([Document(page_content=item["page_content"], metadata=item["metadata"] or {}) for item in data])
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """倒数排名融合，rankings 为多个按相关性排序的文档列表，返回 (文档, 融合得分) 列表"""
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            key = document.page_content
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return [(documents[key], score) for key, score in sorted(scores.items(), key=lambda item: item[1], reverse=True)]
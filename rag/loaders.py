@@ -0,0 +1,183 @@
+"""
+文档加载与切分模块
+函数均为模块级且只依赖文档加载器，可在子进程中执行；该模块不导入 streamlit 与向量库
+"""
+from langchain_community.document_loaders import PyPDFLoader, UnstructuredWordDocumentLoader, UnstructuredEPubLoader, UnstructuredMarkdownLoader
+from langchain_core.documents import Document
+from rag.splitters import build_text_splitter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Iterator
+import chardet
+import json
+import multiprocessing
+import os
+import tempfile
+
+
+SUPPORTED_FORMATS = (".txt", ".pdf", ".docx", ".doc", ".epub", ".md")
+# 纯文本按块流式读取，每块约 STREAM_BLOCK_CHARS 个字符，且只在行边界处断开
+STREAM_BLOCK_CHARS = int(os.getenv("STREAM_BLOCK_CHARS", 64 * 1024))
+
+
+def _detect_encoding(path, sample_size=256 * 1024) -> str:
+    """根据文件开头的样本检测编码，GBK 系列统一按超集 gb18030 读取"""
+    with open(path, "rb") as f:
+        sample = f.read(sample_size)
+    try:
+        sample.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as e:
+        # 样本末尾可能截断了多字节字符
+        if e.start >= len(sample) - 3:
+            return "utf-8"
+    encoding = (chardet.detect(sample).get("encoding") or "utf-8").lower()
+    if encoding in ("gb2312", "gbk", "gb18030"):
+        return "gb18030"
+    return encoding
+
+
+def _iter_text_blocks(path, block_chars=STREAM_BLOCK_CHARS) -> Iterator[Document]:
+    """流式读取纯文本，按行累积到块大小后产出，内存占用与文件大小无关"""
+    block = []
+    size = 0
+    with open(path, "r", encoding=_detect_encoding(path), errors="replace") as f:
+        for line in f:
+            block.append(line)
+            size += len(line)
+            if size >= block_chars:
+                yield Document(page_content="".join(block), metadata={"source": path})
+                block = []
+                size = 0
+    if block:
+        yield Document(page_content="".join(block), metadata={"source": path})
+
+
+def lazy_load_document(document) -> Iterator[Document]:
+    """按扩展名选择加载器，逐页/逐块产出文档"""
+    if document.endswith(".txt"):
+        return _iter_text_blocks(document)
+    elif document.endswith(".pdf"):
+        return PyPDFLoader(document).lazy_load()
+    elif document.endswith(".docx") or document.endswith(".doc"):
+        return UnstructuredWordDocumentLoader(document).lazy_load()
+    elif document.endswith(".epub"):
+        return UnstructuredEPubLoader(document).lazy_load()
+    elif document.endswith(".md"):
+        return UnstructuredMarkdownLoader(document).lazy_load()
+    raise ValueError("未支持的文件格式, 仅支持txt, pdf, docx, doc, epub, md格式的文件")
+
+
+def load_document(document) -> list[Document]:
+    """一次性读取整个文档"""
+    return list(lazy_load_document(document))
+
+
+def iter_chunks(document, splitter_spec=None) -> Iterator[Document]:
+    """边读取边切分单个文档，逐个产出知识块"""
+    text_splitter = build_text_splitter(splitter_spec)
+    pages = lazy_load_document(document)
+    if hasattr(text_splitter, "lazy_split_documents"):
+        yield from text_splitter.lazy_split_documents(pages) # type: ignore
+        return
+    for page in pages:
+        yield from text_splitter.split_documents([page])
+
+
+def spool_chunks(document, splitter_spec=None) -> tuple[str, str | None, str | None]:
+    """在子进程中切分单个文档并将知识块逐行写入临时文件，返回 (文档路径, 临时文件路径, 错误信息)"""
+    path = None
+    try:
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".jsonl", prefix="novel-chunks-", delete=False) as f:
+            path = f.name
+            for chunk in iter_chunks(document, splitter_spec):
+                f.write(json.dumps({"page_content": chunk.page_content, "metadata": chunk.metadata}, ensure_ascii=False, default=str))
+                f.write("\n")
+        return document, path, None
+    except Exception as e:
+        if path and os.path.exists(path):
+            os.remove(path)
+        return document, None, str(e)
+
+
+def read_spool(path) -> Iterator[Document]:
+    """逐行读取临时文件中的知识块，读取结束后删除临时文件"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                item = json.loads(line)
+                yield Document(page_content=item["page_content"], metadata=item["metadata"])
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_ingest_workers() -> int:
+    """并行解析的进程数，INGEST_WORKERS<=1 时在当前进程内顺序解析"""
+    return int(os.getenv("INGEST_WORKERS", str(min(os.cpu_count() or 1, 8))))
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_ingest_pool() -> ProcessPoolExecutor:
+    """获取进程内共享的解析进程池
+
+    使用 spawn 启动子进程，避免在 streamlit 的多线程进程中 fork；进程池常驻以摊薄启动开销。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=get_ingest_workers(),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def _discard_pool(pool):
+    """子进程异常退出后进程池不可再用，丢弃后下次重新创建"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_load_and_split(documents, splitter_spec=None):
+    """逐个产出 (文档路径, 知识块迭代器, 错误信息)
+
+    知识块迭代器均为惰性的：单进程模式下边读边切分，多进程模式下子进程将知识块写入临时文件，
+    主进程按文件完成顺序逐行读取，任何时刻内存中只保留当前批次的知识块。
+    """
+    documents = list(documents)
+    if get_ingest_workers() <= 1 or len(documents) <= 1:
+        for document in documents:
+            yield document, iter_chunks(document, splitter_spec), None
+        return
+    pool = get_ingest_pool()
+    futures = {pool.submit(spool_chunks, document, splitter_spec): document for document in documents}
+    try:
+        for future in as_completed(futures):
+            try:
+                document, path, error = future.result()
+            except BrokenProcessPool as e:
+                # 子进程异常退出（如解析时内存耗尽），仅影响对应文件
+                _discard_pool(pool)
+                yield futures[future], None, str(e)
+                continue
+            except Exception as e:
+                yield futures[future], None, str(e)
+                continue
+            yield document, (read_spool(path) if path else None), error
+    finally:
+        # 提前结束时取消排队中的文件，并清理尚未读取的临时文件
+        for future in futures:
+            future.cancel()
+        for future in futures:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                path = future.result()[1]
+                if path and os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,82 @@
+"""
+向量库迁移工具
+在 chroma 与 flat 后端之间复制项目知识库的向量、内容与元数据，保持知识块 id 不变，
+记录库（record manager）无需重建；迁移完成后更新项目配置中的 vector_store
+
+用法：
+    python -m rag.migrate <项目名> [--to flat] [--kb project_documents,context_documents,knowledge_documents] [--keep-config]
+"""
+from dotenv import load_dotenv
+from config.project_config import get_config
+from rag.vectorstores import VECTOR_STORES, count_documents, iter_vector_batches, open_raw_vector_store, vector_store_exists, write_vector_batch
+import argparse
+import os
+import shutil
+import time
+import yaml
+
+
+KNOWLEDGE_BASES = ("project_documents", "context_documents", "knowledge_documents")
+
+
+def migrate_knowledge_base(path, source, target, batch_size=1000) -> int:
+    """将单个知识库从 source 后端复制到 target 后端，返回迁移的知识块数量"""
+    if not vector_store_exists(source, f".vectordb/{path}/"):
+        raise FileNotFoundError(f"知识库 {path} 没有 {source} 向量库")
+    if target == "flat":
+        # 目标目录重新生成，避免与旧数据混杂
+        shutil.rmtree(os.path.join(f".vectordb/{path}/", "flat"), ignore_errors=True)
+    else:
+        open_raw_vector_store(target, path).delete_collection() # type: ignore
+    source_store = open_raw_vector_store(source, path)
+    target_store = open_raw_vector_store(target, path)
+    migrated = 0
+    for data in iter_vector_batches(source_store, batch_size):
+        write_vector_batch(target_store, data)
+        migrated += len(data["ids"])
+    if migrated != count_documents(source_store):
+        raise RuntimeError(f"知识库 {path} 迁移数量不一致：{migrated}/{count_documents(source_store)}")
+    return migrated
+
+
+def set_project_vector_store(project, kind):
+    """更新项目配置中的 vector_store"""
+    config_path = os.path.join("data/projects", f"{project}.yaml")
+    with open(config_path, "r", encoding="utf-8") as f:
+        data = yaml.load(f, Loader=yaml.FullLoader)
+    data["vector_store"] = kind
+    with open(config_path, "w", encoding="utf-8") as f:
+        yaml.dump(data, f, allow_unicode=True)
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="向量库迁移工具")
+    parser.add_argument("project", help="项目名")
+    parser.add_argument("--to", default="flat", choices=VECTOR_STORES)
+    parser.add_argument("--kb", default=",".join(KNOWLEDGE_BASES))
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--keep-config", action="store_true", help="只迁移数据，不修改项目配置")
+    args = parser.parse_args()
+
+    config = get_config(args.project)
+    source = getattr(config, "vector_store", "chroma")
+    if source == args.to:
+        print(f"项目 {args.project} 已使用 {args.to} 向量库")
+        return
+    for name in args.kb.split(","):
+        path = getattr(config, name.strip())
+        start = time.perf_counter()
+        try:
+            migrated = migrate_knowledge_base(path, source, args.to, args.batch_size)
+        except FileNotFoundError as e:
+            print(f"跳过：{e}")
+            continue
+        print(f"{name}: 迁移 {migrated} 个知识块，耗时 {time.perf_counter() - start:.2f} 秒")
+    if not args.keep_config:
+        set_project_vector_store(args.project, args.to)
+        print(f"项目 {args.project} 已切换为 {args.to} 向量库")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,87 @@
-from langchain_chroma import Chroma
-from langchain_classic.text_splitter import CharacterTextSplitter
 from langchain_openai.embeddings import OpenAIEmbeddings
 from langchain_classic.indexes import SQLRecordManager, index
 from langchain_ollama.embeddings import OllamaEmbeddings
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, UnstructuredWordDocumentLoader, UnstructuredEPubLoader, UnstructuredMarkdownLoader
+import hashlib
+import json
 import os
+from threading import Lock
 from tqdm import tqdm
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
+from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from rag.embedding_cache import cache_embeddings
+from rag.lexical import BM25Index
+from rag.loaders import iter_load_and_split
+from rag.splitters import get_splitter_spec
+from rag.vectorstores import open_vector_store, vector_store_exists
+from utils.token_utils import estimate_tokens
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import time
+
+
+# 索引时每次写入向量库的知识块数量；嵌入按 EMBEDDING_BATCH_SIZE 切分后并发请求
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", 512))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 4))
+
+
+def _notify(message):
+    """在页面请求中弹出提示，在后台线程（如索引服务）中输出日志"""
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        st.toast(message)
+    else:
+        print(message)
+
+
+class ConcurrentEmbeddings(Embeddings):
+    """将大批量文本切分为小批次，并发请求底层嵌入模型，结果按原顺序返回"""
+
+    def __init__(self, embeddings: Embeddings, batch_size=EMBEDDING_BATCH_SIZE, concurrency=EMBEDDING_CONCURRENCY):
+        self.embeddings = embeddings
+        self.batch_size = max(batch_size, 1)
+        self.concurrency = max(concurrency, 1)
+
+    def _batches(self, texts):
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        batches = self._batches(texts)
+        if len(batches) <= 1 or self.concurrency == 1:
+            return [vector for batch in batches for vector in self.embeddings.embed_documents(batch)]
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+            results = executor.map(self.embeddings.embed_documents, batches)
+            return [vector for batch_vectors in results for vector in batch_vectors]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def embed(batch):
+            async with semaphore:
+                return await self.embeddings.aembed_documents(batch)
+
+        results = await asyncio.gather(*[embed(batch) for batch in self._batches(texts)])
+        return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.embeddings.aembed_query(text)
+
+def get_embedding_signature():
+    """当前嵌入模型的标识（提供商:模型），不同模型的向量不能混用"""
+    emb_provider = os.getenv("DEFAULT_EMBEDDING_PROVIDER", "OLLAMA").upper()
+    emb_model = os.getenv("DEFAULT_EMBEDDING_MODEL", "qwen3-embedding:0.6b")
+    return f"{emb_provider}:{emb_model}"
+
 
 class DocumentProcessor():
     
-    def __init__(self, knowledge_base_path):
+    def __init__(self, knowledge_base_path, vector_store=None):
         self.embeddings: Embeddings
         # 获取默认嵌入模型配置
         emb_provider = os.getenv("DEFAULT_EMBEDDING_PROVIDER", "OLLAMA").upper()
@@ -32,6 +101,8 @@ class DocumentProcessor():
                 base_url=base_url,
                 check_embedding_ctx_length=False # 防止某些非OpenAI模型的长度检查错误
             )
+        # 缓存未命中的文本按小批次并发嵌入；索引与查询共用磁盘嵌入缓存，文本未变化时不再重复计算
+        self.embeddings = cache_embeddings(ConcurrentEmbeddings(self.embeddings), get_embedding_signature())
         self.collection_name = knowledge_base_path.split("/")[-1]
         self.project_name = knowledge_base_path.split("/")[-2]
         self.sql_url = f"sqlite:///.db/{self.project_name}_{self.collection_name}_record_manager.db"
@@ -39,86 +110,278 @@ class DocumentProcessor():
         self.documents_dir = knowledge_base_path
         self.record_manager = SQLRecordManager(self.collection_name, db_url=self.sql_url)
         self.record_manager.create_schema()
+        # 词法索引与向量库存放在同一目录，按需加载
+        self.lexical_index_path = f".vectordb/{self.knowledge_base_path}/lexical_index.json.gz"
+        self._lexical_index = None
+        self._lexical_lock = Lock()
+        self._update_lock = Lock()
+        # 文件清单与记录库存放在同一目录，用于跳过未变更文件的解析
+        self.manifest_path = f".db/{self.project_name}_{self.collection_name}_manifest.json"
+        # 向量库后端：chroma 或 flat，由项目配置的 vector_store 指定
+        self.vector_store_kind = (vector_store or os.getenv("VECTOR_STORE", "chroma")).lower()
+        self.vectordb_path = f".vectordb/{self.knowledge_base_path}/"
         
         # 尝试加载已有的向量数据库
-        vectordb_path = f".vectordb/{self.knowledge_base_path}/"
         try:
             # 检查向量数据库是否存在
-            if os.path.exists(vectordb_path) and os.listdir(vectordb_path):
-                self.chroma = Chroma(
-                    collection_name=self.collection_name, 
-                    persist_directory=vectordb_path, 
-                    embedding_function=self.embeddings
-                )
+            if vector_store_exists(self.vector_store_kind, self.vectordb_path):
+                self.vector_store = self._open_vector_store()
             else:
-                # 向量数据库不存在，需要处理文档
-                self.processing()
+                # 向量数据库不存在，需要处理全部文档
+                self.processing(force=True)
         except Exception as e:
             # 加载失败，重新处理文档
             print(f"加载向量数据库失败: {e}，将重新处理文档")
-            self.processing()
+            self.processing(force=True)
+
+    def _load_manifest(self, splitter_spec) -> dict:
+        """读取文件清单：路径 -> {size, mtime, sha256}，切分配置变化时视为空清单"""
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except Exception as e:
+            print(f"读取文件清单失败: {e}，将重新处理全部文档")
+            return {}
+        if manifest.get("splitter") != splitter_spec:
+            print(f"知识库{self.collection_name}切分配置已变更，将重新切分全部文档")
+            return {}
+        return manifest.get("files", {})
+
+    def _save_manifest(self, files: dict, splitter_spec):
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"splitter": splitter_spec, "files": files}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _file_hash(path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _diff_manifest(self, documents, manifest):
+        """对比文件清单，返回 (需要处理的文件 -> 清单条目, 未变更文件的清单, 已删除的文件)
+
+        大小与修改时间均未变化的文件直接跳过；仅修改时间变化的文件再比对内容哈希。
+        """
+        changed = {}
+        unchanged = {}
+        for document in documents:
+            stat = os.stat(document)
+            entry: dict = {"size": stat.st_size, "mtime": stat.st_mtime}
+            old = manifest.get(document)
+            if old and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+                unchanged[document] = old
+                continue
+            entry["sha256"] = self._file_hash(document)
+            if old and old.get("sha256") == entry["sha256"]:
+                unchanged[document] = entry
+            else:
+                changed[document] = entry
+        removed = [document for document in manifest if document not in documents]
+        return changed, unchanged, removed
+
+    def _delete_sources(self, sources):
+        """删除指定来源文件在向量库与记录库中的全部知识块"""
+        keys = self.record_manager.list_keys(group_ids=list(sources))
+        if keys:
+            self.vector_store.delete(keys)
+            self.record_manager.delete_keys(keys)
+        return len(keys)
+
+    def _stream_contents(self, changed, loaded, sources, splitter_spec):
+        """并行解析变更文件，逐块产出知识块，单个文件失败只提示不中断
+
+        loaded 记录成功解析的文件，sources 记录产出过知识块的文件；知识块不在内存中累积。
+        """
+        for document, chunks, error in tqdm(iter_load_and_split(changed, splitter_spec), total=len(changed)): # type: ignore
+            try:
+                if error is not None:
+                    raise RuntimeError(error)
+                for chunk in chunks: # type: ignore
+                    sources.add(chunk.metadata.get("source"))
+                    yield chunk
+                loaded[document] = changed[document]
+            except Exception as e:
+                _notify(f"Processing encounter error with file {document}\nplease check the file is valid and its format.\n[Error] {e}")
+
+    def _index(self, contents):
+        """批量写入向量库并统计吞吐量"""
+        counter = {"chunks": 0, "tokens": 0}
 
-    def processing(self):
+        def counted():
+            for content in contents:
+                counter["chunks"] += 1
+                counter["tokens"] += estimate_tokens(content.page_content)
+                yield content
+
+        start = time.perf_counter()
+        result: dict = dict(index(counted(), self.record_manager, self.vector_store, cleanup="incremental", source_id_key='source', batch_size=INDEX_BATCH_SIZE))
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        result["throughput"] = f"{counter['chunks'] / elapsed:.1f} 块/秒，{counter['tokens'] / elapsed:.0f} tokens/秒"
+        print(f"知识库{self.collection_name}索引完成：{counter['chunks']}个知识块，约{counter['tokens']}个tokens，耗时{elapsed:.2f}秒，{result['throughput']}")
+        return result
+
+    def processing(self, force=False):
+        """增量处理知识库：依据文件清单只解析新增或变更的文件，force=True 时全部重新处理"""
         documents = [os.path.join(self.documents_dir, file) for file in os.listdir(self.documents_dir) if not file.startswith('.')]
+        splitter_spec = get_splitter_spec()
+        manifest = {} if force else self._load_manifest(splitter_spec)
+        changed, files, removed = self._diff_manifest(documents, manifest)
+
+        # 确保 self.vector_store 已初始化
+        if not hasattr(self, 'vector_store'):
+            self.vector_store = self._open_vector_store()
+
+        # 已删除的文件不会出现在 index() 的输入中，增量清理无法覆盖，需按来源删除
+        num_removed = self._delete_sources(removed) if removed else 0
         
-        # 如果目录为空，创建空的 Chroma 实例
+        # 如果目录为空，保留空知识库
         if len(documents) == 0:
-            st.toast(f"目录 {self.documents_dir} 中没有文档，已创建空知识库")
-            self.chroma = Chroma(
-                collection_name=self.collection_name, 
-                persist_directory=f".vectordb/{self.knowledge_base_path}/", 
-                embedding_function=self.embeddings
-            )
+            _notify(f"目录 {self.documents_dir} 中没有文档，已创建空知识库")
+            self._save_manifest({}, splitter_spec)
+            self._refresh_lexical_index()
             return
-        
-        all_contents = []
-        for document in tqdm(documents): # type: ignore
-            raw_contents = []
-            try:
-                if document.endswith(".txt"):
-                    raw_contents = TextLoader(document, autodetect_encoding=True).load()
-                elif document.endswith(".pdf"):
-                    raw_contents = PyPDFLoader(document).load()
-                elif document.endswith(".docx") or document.endswith(".doc"):
-                    raw_contents = UnstructuredWordDocumentLoader(document).load()
-                elif document.endswith(".epub"):
-                    raw_contents = UnstructuredEPubLoader(document).load()
-                elif document.endswith(".md"):
-                    raw_contents = UnstructuredMarkdownLoader(document).load()
-                else:
-                    st.toast("未支持的文件格式, 仅支持txt, pdf, docx, doc, epub, md格式的文件")
-                text_splitter = CharacterTextSplitter(separator="\n", chunk_size=200, chunk_overlap=20)
-                contents = text_splitter.split_documents(raw_contents)
-                all_contents.extend(contents)
-            except Exception as e:
-                st.toast(f"Processing encounter error with file {document}\nplease check the file is valid and its format.\n[Error] {e}")
-        
-        # 确保 self.chroma 已初始化
-        if not hasattr(self, 'chroma'):
-            self.chroma = Chroma(
-                collection_name=self.collection_name, 
-                persist_directory=f".vectordb/{self.knowledge_base_path}/", 
-                embedding_function=self.embeddings
-            )
 
+        if not changed:
+            _notify(f"知识库无文件变更，已跳过解析\n删除知识块：{num_removed}")
+            self._save_manifest(files, splitter_spec)
+            if removed:
+                self._refresh_lexical_index()
+            return
+        
+        loaded = {}
+        sources = set()
+        # 知识块边解析边写入，index() 按 INDEX_BATCH_SIZE 分批消费生成器，峰值内存与知识库大小无关
+        contents_stream = self._stream_contents(changed, loaded, sources, splitter_spec)
         try:
-            result = index(all_contents, self.record_manager, self.chroma, cleanup="incremental", source_id_key='source')
-            st.toast(f"知识库更新成功\n新增知识块：{result['num_added']}\n删除知识块：{result['num_deleted']}\n更新知识块：{result['num_updated']}")
+            result = self._index(contents_stream)
+            num_removed += self._remove_empty_sources(loaded, sources)
+            _notify(f"知识库更新成功\n解析文件：{len(loaded)}/{len(documents)}\n新增知识块：{result['num_added']}\n删除知识块：{result['num_deleted'] + num_removed}\n更新知识块：{result['num_updated']}\n吞吐：{result['throughput']}")
+            # 解析失败的文件不写入清单，下次更新时重试
+            self._save_manifest({**files, **loaded}, splitter_spec)
+            self._refresh_lexical_index()
         except Exception as e:
             try:
-                # 尝试重新创建（如果上面的更新失败）
-                # 注意：Chroma.from_documents 会创建新的实例并持久化
-                self.chroma = Chroma.from_documents(all_contents, self.embeddings, persist_directory=f".vectordb/{self.knowledge_base_path}/", collection_name=self.collection_name )
-                result = index(all_contents, self.record_manager, self.chroma, cleanup="incremental", source_id_key='source')
-                st.toast(f"知识库重建并更新成功\n新增知识块：{result['num_added']}\n删除知识块：{result['num_deleted']}\n更新知识块：{result['num_updated']}")
-                st.toast(f"Processor has persisted all documents in path {self.knowledge_base_path}")
-                st.toast(f"知识库{self.collection_name}处理成功")
+                # 尝试重新创建（如果上面的更新失败），重新流式解析并分批写入新的实例
+                contents_stream.close()
+                self.vector_store = self._open_vector_store()
+                loaded, sources = {}, set()
+                batch = []
+                for content in self._stream_contents(changed, {}, set(), splitter_spec):
+                    batch.append(content)
+                    if len(batch) >= INDEX_BATCH_SIZE:
+                        self.vector_store.add_documents(batch)
+                        batch = []
+                if batch:
+                    self.vector_store.add_documents(batch)
+                # 嵌入已写入磁盘缓存，再次解析并登记到记录库不会重复计算嵌入
+                result = self._index(self._stream_contents(changed, loaded, sources, splitter_spec))
+                self._remove_empty_sources(loaded, sources)
+                _notify(f"知识库重建并更新成功\n新增知识块：{result['num_added']}\n删除知识块：{result['num_deleted']}\n更新知识块：{result['num_updated']}")
+                _notify(f"Processor has persisted all documents in path {self.knowledge_base_path}")
+                _notify(f"知识库{self.collection_name}处理成功")
+                self._save_manifest({**files, **loaded}, splitter_spec)
+                self._refresh_lexical_index()
             except Exception as e:
-                st.toast(f"Processing encounter error with file {document}\nplease check the file is valid and its format.\n[Error] {e}")
+                _notify(f"Processing encounter error in knowledge base {self.knowledge_base_path}\n[Error] {e}")
+
+    def _remove_empty_sources(self, loaded, sources):
+        """解析后没有任何内容的文件不会触发增量清理，需显式删除其旧知识块"""
+        empty = [document for document in loaded if document not in sources]
+        return self._delete_sources(empty) if empty else 0
+
+    def _open_vector_store(self) -> VectorStore:
+        return open_vector_store(self.vector_store_kind, self.collection_name, self.vectordb_path, self.embeddings)
 
-    def get_Chroma(self) -> Chroma:
-        return self.chroma
+    def get_vector_store(self) -> VectorStore:
+        return self.vector_store
+
+    def get_Chroma(self) -> VectorStore:
+        """兼容旧接口，返回当前后端的向量库"""
+        return self.vector_store
+
+    def build_lexical_index(self) -> BM25Index:
+        """从向量库中读取全部知识块，构建并持久化 BM25 词法索引"""
+        data = self.vector_store.get(include=["documents", "metadatas"]) # type: ignore
+        documents = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(data["documents"], data["metadatas"]) if text
+        ]
+        lexical_index = BM25Index(documents)
+        os.makedirs(os.path.dirname(self.lexical_index_path), exist_ok=True)
+        lexical_index.save(self.lexical_index_path)
+        self._lexical_index = lexical_index
+        return lexical_index
+
+    def get_lexical_index(self) -> BM25Index:
+        """获取词法索引，优先加载已持久化的索引"""
+        with self._lexical_lock:
+            if self._lexical_index is None:
+                if os.path.exists(self.lexical_index_path):
+                    self._lexical_index = BM25Index.load(self.lexical_index_path)
+                else:
+                    self.build_lexical_index()
+            return self._lexical_index # type: ignore
+
+    def _refresh_lexical_index(self):
+        """知识库变更后使词法索引失效，混合检索模式下立即重建"""
+        with self._lexical_lock:
+            self._lexical_index = None
+            if os.path.exists(self.lexical_index_path):
+                os.remove(self.lexical_index_path)
+            if os.getenv("RETRIEVAL_MODE", "vector").lower() == "hybrid":
+                self.build_lexical_index()
     
     def update(self):
-        self.processing()
-    
\ No newline at end of file
+        """增量更新知识库，界面操作与后台索引服务对同一知识库的更新串行执行"""
+        with self._update_lock:
+            self.processing()
+
+
+_processors = {}
+_processors_lock = Lock()
+_build_locks = {}  # 知识库路径 -> 创建处理器时持有的锁
+
+
+def _cached_processor(knowledge_base_path, kind):
+    processor = _processors.get(knowledge_base_path)
+    if processor is not None and processor.vector_store_kind == kind:
+        return processor
+    return None
+
+
+def get_document_processor(knowledge_base_path, vector_store=None) -> DocumentProcessor:
+    """获取进程内共享的文档处理器，避免重复打开记录库与向量库；向量库后端变化时重新创建
+
+    首次创建可能需要完整解析并嵌入知识库，只持有该路径的锁，不阻塞其他知识库的查找。
+    """
+    kind = (vector_store or os.getenv("VECTOR_STORE", "chroma")).lower()
+    with _processors_lock:
+        processor = _cached_processor(knowledge_base_path, kind)
+        if processor is not None:
+            return processor
+        build_lock = _build_locks.setdefault(knowledge_base_path, Lock())
+    with build_lock:
+        # 等待期间其他线程可能已创建完成
+        with _processors_lock:
+            processor = _cached_processor(knowledge_base_path, kind)
+        if processor is None:
+            processor = DocumentProcessor(knowledge_base_path, kind)
+            with _processors_lock:
+                _processors[knowledge_base_path] = processor
+        return processor
+
+
+def release_document_processors(prefix=""):
+    """释放路径以 prefix 开头的文档处理器缓存"""
+    with _processors_lock:
+        for path in [path for path in _processors if path.startswith(prefix)]:
+            del _processors[path]
+        for path in [path for path in _build_locks if path.startswith(prefix)]:
+            del _build_locks[path]
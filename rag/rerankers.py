@@ -0,0 +1,92 @@
+"""
+重排序模块
+所有重排序器均实现 langchain 的 BaseDocumentCompressor 接口，可直接用于 ContextualCompressionRetriever
+RERANKER=remote 使用 SiliconFlow 远程重排序，local 使用本地 CPU 打分，none 不重排序
+"""
+from langchain_cohere import CohereRerank
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import BaseDocumentCompressor, Document
+from rag.lexical import tokenize
+from collections import Counter
+from threading import Lock
+from typing import Optional, Sequence
+import numpy as np
+import os
+
+
+class LocalReranker(BaseDocumentCompressor):
+    """本地重排序器：基于字符 n-gram 的 TF-IDF 余弦相似度，对候选集合做向量化批量打分"""
+
+    top_n: Optional[int] = None
+    ngram: int = 2
+
+    def score(self, query: str, texts: list[str]) -> np.ndarray:
+        """返回每个候选文本与查询的相关性得分"""
+        if not texts:
+            return np.zeros(0, dtype=np.float32)
+        query_counts = Counter(tokenize(query, self.ngram))
+        if not query_counts:
+            return np.zeros(len(texts), dtype=np.float32)
+        vocab = {token: i for i, token in enumerate(query_counts)}
+        counts = np.zeros((len(texts), len(vocab)), dtype=np.float32)
+        doc_norms = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            doc_counts = Counter(tokenize(text, self.ngram))
+            doc_norms[row] = np.sqrt(sum(tf * tf for tf in doc_counts.values()))
+            for token, tf in doc_counts.items():
+                col = vocab.get(token)
+                if col is not None:
+                    counts[row, col] = tf
+        # 在候选集合内计算 idf，长 n-gram 权重更高
+        df = (counts > 0).sum(axis=0)
+        idf = np.log((1 + len(texts)) / (1 + df)) + 1.0
+        lengths = np.array([len(token) for token in vocab], dtype=np.float32)
+        query_vec = np.array(list(query_counts.values()), dtype=np.float32) * idf * lengths
+        doc_vecs = counts * idf * lengths
+        denominator = np.linalg.norm(query_vec) * np.maximum(doc_norms, 1.0)
+        return (doc_vecs @ query_vec) / denominator
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Callbacks | None = None,
+    ) -> Sequence[Document]:
+        scores = self.score(query, [document.page_content for document in documents])
+        order = np.argsort(-scores, kind="stable")
+        if self.top_n is not None:
+            order = order[:self.top_n]
+        results = []
+        for i in order:
+            document = documents[int(i)]
+            results.append(Document(
+                page_content=document.page_content,
+                metadata={**document.metadata, "relevance_score": float(scores[i])}
+            ))
+        return results
+
+
+_rerankers = {}
+_rerankers_lock = Lock()
+
+
+def get_reranker(kind=None) -> BaseDocumentCompressor | None:
+    """获取进程内共享的重排序器，kind 缺省时读取环境变量 RERANKER"""
+    kind = (kind or os.getenv("RERANKER", "remote")).lower()
+    if kind == "none":
+        return None
+    with _rerankers_lock:
+        reranker = _rerankers.get(kind)
+        if reranker is None:
+            if kind == "local":
+                reranker = LocalReranker()
+            elif kind == "remote":
+                reranker = CohereRerank(
+                    cohere_api_key=os.getenv("SILICONFLOW_API_KEY"),
+                    base_url=os.getenv("SILICONFLOW_BASE_URL"),
+                    model=os.getenv("DEFAULT_RERANKER_MODEL", "BAAI/bge-reranker-v2-m3")
+                )
+            else:
+                raise ValueError(f"Invalid reranker: {kind}, please use remote, local or none")
+            _rerankers[kind] = reranker
+        return reranker
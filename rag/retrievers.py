@@ -1,57 +1,205 @@
-from rag.processors import DocumentProcessor
+from rag.processors import get_document_processor
+from rag.vectorstores import count_documents, query_vectors
+from rag.lexical import reciprocal_rank_fusion
+from rag.rerankers import get_reranker
 from langchain_classic.retrievers.contextual_compression import ContextualCompressionRetriever
-from langchain_cohere import CohereRerank
+from langchain_chroma.vectorstores import maximal_marginal_relevance
+import numpy as np
+import asyncio
 import os
 
 
+# 与 as_retriever(search_type="mmr") 的默认参数保持一致
+SEARCH_K = 4
+FETCH_K = 20
+LAMBDA_MULT = 0.5
+RRF_K = 60
 
 
 class Retriever():
-    def __init__(self, documents, k=1, query_rewriter=None):
-        self.document_processor = DocumentProcessor(documents)
-        self.base_retriever = self.document_processor.get_Chroma().as_retriever(search_type="mmr",kwargs={"k": 5})
-        base_url = os.getenv("SILICONFLOW_BASE_URL")
-        self.reranker = CohereRerank(
-            cohere_api_key=os.getenv("SILICONFLOW_API_KEY"), 
-            base_url=base_url, 
-            model=os.getenv("DEFAULT_RERANKER_MODEL", "BAAI/bge-reranker-v2-m3")
-        )
-        self.chain = ContextualCompressionRetriever(base_compressor=self.reranker, base_retriever=self.base_retriever) # type: ignore
+    def __init__(self, documents, k=1, query_rewriter=None, batched=None, mode=None, reranker=None, vector_store=None):
+        self.document_processor = get_document_processor(documents, vector_store)
+        # 重排序器：remote / local / none，缺省读取环境变量 RERANKER
+        self.reranker = get_reranker(reranker)
         self.k = k
         self.query_rewriter = query_rewriter
-    
-    def invoke(self, queries):
-        """执行检索查询，返回合并后的结果"""
-        if not queries:
-            return ""
-        
-        # 如果配置了重写器，对查询进行扩充
-        expanded_queries = set(queries) # 使用set去重
+        # 批量模式：一次嵌入全部查询、一次向量检索、每个原始意图只重排一次
+        if batched is None:
+            batched = os.getenv("RETRIEVER_BATCHED", "true").lower() in ("1", "true", "yes")
+        self.batched = batched
+        # 检索模式：vector 仅向量检索；hybrid 融合 BM25 词法检索与向量检索（总是走批量路径）
+        self.mode = (mode or os.getenv("RETRIEVAL_MODE", "vector")).lower()
+        self._build_chain()
+
+    def _build_chain(self):
+        """基于当前向量库构建检索链，向量库重建后需要重新调用"""
+        self._vector_store = self.document_processor.get_vector_store()
+        self.base_retriever = self._vector_store.as_retriever(search_type="mmr",kwargs={"k": 5})
+        if self.reranker is None:
+            self.chain = self.base_retriever
+        else:
+            self.chain = ContextualCompressionRetriever(base_compressor=self.reranker, base_retriever=self.base_retriever) # type: ignore
+
+    def _ensure_chain(self):
+        """后台索引服务可能已重建向量库，检索前确认检索链指向当前向量库"""
+        if self.document_processor.get_vector_store() is not self._vector_store:
+            self._build_chain()
+
+    def _expand_queries(self, queries):
+        """对查询进行改写扩充，返回 原始查询 -> [原始查询, 改写查询...] 的映射"""
+        groups = {query: [query] for query in dict.fromkeys(queries)}
         if self.query_rewriter:
-            for query in queries:
-                try:
-                    rewritten_res = self.query_rewriter.invoke({"query": query})
-                    if rewritten_res and "rewritten_queries" in rewritten_res:
-                         for q in rewritten_res["rewritten_queries"]:
-                             expanded_queries.add(q)
-                except Exception as e:
-                    print(f"[Warn] Query rewriting failed for '{query}': {e}")
-        
-        final_queries = list(expanded_queries)
-        print(f"检索优化：原始查询{len(queries)}个 -> 扩充后{len(final_queries)}个")
-        
+            for query, rewritten in self.query_rewriter.rewrite_many(list(groups)).items():
+                groups[query].extend(rewritten)
+        return groups
+
+    async def _aexpand_queries(self, queries):
+        """异步并发改写查询"""
+        groups = {query: [query] for query in dict.fromkeys(queries)}
+        if self.query_rewriter:
+            for query, rewritten in (await self.query_rewriter.arewrite_many(list(groups))).items():
+                groups[query].extend(rewritten)
+        return groups
+
+    def _log_expansion(self, groups):
+        final_queries = {q for variants in groups.values() for q in variants}
+        print(f"检索优化：原始查询{len(groups)}个 -> 扩充后{len(final_queries)}个")
+        return list(final_queries)
+
+    def _search_candidates(self, queries, vectors):
+        """对全部查询向量执行一次批量向量检索，返回 查询 -> [(文档, 得分)]
+
+        vector 模式在本地按 MMR 选取候选；hybrid 模式将向量排序与 BM25 排序做倒数排名融合。
+        """
+        vector_store = self.document_processor.get_vector_store()
+        if not queries or count_documents(vector_store) == 0:
+            return {query: [] for query in queries}
+        results = query_vectors(vector_store, vectors, FETCH_K)
+        lexical_index = self.document_processor.get_lexical_index() if self.mode == "hybrid" else None
+        candidates = {}
+        for query, vector, (ranking, embeddings) in zip(queries, vectors, results):
+            if lexical_index is not None:
+                lexical_ranking = [document for document, _ in lexical_index.search(query, FETCH_K)]
+                candidates[query] = reciprocal_rank_fusion([ranking, lexical_ranking], RRF_K)[:SEARCH_K]
+                continue
+            if not ranking:
+                candidates[query] = []
+                continue
+            selected = maximal_marginal_relevance(
+                np.array(vector, dtype=np.float32),
+                embeddings,
+                k=SEARCH_K,
+                lambda_mult=LAMBDA_MULT
+            )
+            candidates[query] = [(ranking[j], 1.0 / (RRF_K + rank + 1)) for rank, j in enumerate(selected)]
+        return candidates
+
+    def _union_candidates(self, variants, candidates):
+        """合并同一意图下各查询的候选并去重，按累计得分排序"""
+        union = {}
+        scores = {}
+        for query in variants:
+            for document, score in candidates.get(query, []):
+                union.setdefault(document.page_content, document)
+                scores[document.page_content] = scores.get(document.page_content, 0.0) + score
+        return [union[key] for key in sorted(union, key=lambda key: scores[key], reverse=True)]
+
+    def _rerank(self, union, original):
+        if self.reranker is None:
+            return union
+        return list(self.reranker.compress_documents(union, original))
+
+    async def _arerank(self, union, original):
+        if self.reranker is None:
+            return union
+        return list(await self.reranker.acompress_documents(union, original))
+
+    def _batched_search(self, groups):
+        """批量检索：一次嵌入、一次检索，每个原始意图只调用一次重排序，返回 原始查询 -> 文档列表"""
+        queries = self._log_expansion(groups)
+        vectors = self.document_processor.embeddings.embed_documents(queries)
+        candidates = self._search_candidates(queries, vectors)
+        results = {}
+        for original, variants in groups.items():
+            union = self._union_candidates(variants, candidates)
+            if union:
+                results[original] = self._rerank(union, original)[:self.k * len(variants)]
+        return results
+
+    async def _abatched_search(self, groups):
+        """批量检索的异步版本"""
+        queries = self._log_expansion(groups)
+        vectors = await self.document_processor.embeddings.aembed_documents(queries)
+        candidates = await asyncio.to_thread(self._search_candidates, queries, vectors)
+        intents = [(original, variants, self._union_candidates(variants, candidates)) for original, variants in groups.items()]
+        intents = [intent for intent in intents if intent[2]]
+        reranked = await asyncio.gather(*[self._arerank(union, original) for original, _, union in intents])
+        return {original: documents[:self.k * len(variants)] for (original, variants, _), documents in zip(intents, reranked)}
+
+    def _chain_search(self, groups):
+        """逐个查询调用检索链，每个查询只检索一次，返回 原始查询 -> 文档列表"""
+        final_queries = self._log_expansion(groups)
+        searched = {query: self.chain.invoke(query)[:self.k] for query in final_queries}
+        return {original: [doc for query in variants for doc in searched[query]] for original, variants in groups.items()}
+
+    async def _achain_search(self, groups):
+        final_queries = self._log_expansion(groups)
+        all_results = await asyncio.gather(*[self.chain.ainvoke(query) for query in final_queries])
+        searched = {query: results[:self.k] for query, results in zip(final_queries, all_results)}
+        return {original: [doc for query in variants for doc in searched[query]] for original, variants in groups.items()}
+
+    def _join_results(self, all_results):
+        """按出现顺序对检索内容去重并拼接"""
         query_results = []
         seen_content = set() # 用于内容去重
-        
-        for query in final_queries:
-            results = self.chain.invoke(query)[:self.k]
+        for results in all_results:
             for result in results:
                 content = result.page_content.strip()
                 if content and content not in seen_content:
                     query_results.append(content)
                     seen_content.add(content)
-        
         return "\n\n".join(query_results) if query_results else ""
+    
+    def invoke(self, queries):
+        """执行检索查询，返回合并后的结果"""
+        return self.invoke_grouped({"results": queries})["results"]
+
+    async def ainvoke(self, queries):
+        """异步执行检索查询，查询改写与各查询检索并发进行"""
+        return (await self.ainvoke_grouped({"results": queries}))["results"]
+
+    def invoke_grouped(self, named_queries: dict):
+        """分组检索：多组查询合并为一次 改写/嵌入/检索/重排序，再按组名拆分结果"""
+        all_queries = [query for queries in named_queries.values() for query in (queries or [])]
+        if not all_queries:
+            return {name: "" for name in named_queries}
+        
+        self._ensure_chain()
+        # 如果配置了重写器，对查询进行扩充；跨组重复的查询只处理一次
+        groups = self._expand_queries(all_queries)
+        batched = self.batched or self.mode == "hybrid"
+        intent_results = self._batched_search(groups) if batched else self._chain_search(groups)
+        return self._split_results(named_queries, intent_results)
+
+    async def ainvoke_grouped(self, named_queries: dict):
+        """invoke_grouped 的异步版本"""
+        all_queries = [query for queries in named_queries.values() for query in (queries or [])]
+        if not all_queries:
+            return {name: "" for name in named_queries}
+        
+        self._ensure_chain()
+        groups = await self._aexpand_queries(all_queries)
+        batched = self.batched or self.mode == "hybrid"
+        intent_results = await (self._abatched_search(groups) if batched else self._achain_search(groups))
+        return self._split_results(named_queries, intent_results)
+
+    def _split_results(self, named_queries, intent_results):
+        """按组拆分各原始查询的检索结果"""
+        return {
+            name: self._join_results([intent_results.get(query, []) for query in dict.fromkeys(queries or [])])
+            for name, queries in named_queries.items()
+        }
 
     def update(self):
-        self.document_processor.update()
\ No newline at end of file
+        self.document_processor.update()
+        self._build_chain()
@@ -0,0 +1,261 @@
+"""
+知识库快照工具
+将项目知识库的知识块、向量、记录库与文件清单打包为一个压缩包，在其他环境中直接恢复而无需重新嵌入；
+导入时将原路径改写为目标项目的知识库路径
+
+用法：
+    python -m rag.snapshot export <项目名> [-o 快照.tar.gz] [--with-documents] [--dtype float16]
+    python -m rag.snapshot import <快照.tar.gz> [项目名] [--vector-store flat] [--force]
+"""
+from dotenv import load_dotenv
+from config.project_config import get_config, get_projects, create_new_project
+from langchain_classic.indexes import SQLRecordManager
+from langchain_core.documents import Document
+from langchain_core.indexing.api import _get_document_with_hash
+from rag.migrate import set_project_vector_store
+from rag.processors import get_embedding_signature, release_document_processors
+from rag.splitters import get_splitter_spec
+from rag.vectorstores import count_documents, iter_vector_batches, open_raw_vector_store, vector_store_exists, write_vector_batch
+import argparse
+import json
+import numpy as np
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import time
+
+
+SNAPSHOT_VERSION = 1
+KNOWLEDGE_BASES = ("project_documents", "context_documents", "knowledge_documents")
+
+
+def _paths(knowledge_base_path):
+    """知识库相关文件路径：记录库、文件清单"""
+    collection = knowledge_base_path.split("/")[-1]
+    project = knowledge_base_path.split("/")[-2]
+    return f".db/{project}_{collection}_record_manager.db", f".db/{project}_{collection}_manifest.json"
+
+
+def _rewrite(value, old_prefix, new_prefix):
+    """将以原知识库路径开头的路径改写为新路径"""
+    if isinstance(value, str) and (value == old_prefix or value.startswith(old_prefix.rstrip("/") + "/")):
+        return new_prefix.rstrip("/") + value[len(old_prefix.rstrip("/")):]
+    return value
+
+
+def _export_knowledge_base(kind, path, workdir, dtype, with_documents, batch_size=1000):
+    """导出单个知识库到 workdir，返回其描述信息"""
+    os.makedirs(workdir, exist_ok=True)
+    info: dict = {"path": path, "count": 0, "dim": None}
+    if vector_store_exists(kind, f".vectordb/{path}/"):
+        store = open_raw_vector_store(kind, path)
+        total = count_documents(store)
+        embeddings = None
+        with open(os.path.join(workdir, "chunks.jsonl"), "w", encoding="utf-8") as f:
+            for data in iter_vector_batches(store, batch_size):
+                vectors = np.asarray(data["embeddings"], dtype=np.float32)
+                if embeddings is None:
+                    info["dim"] = int(vectors.shape[1])
+                    embeddings = np.lib.format.open_memmap(os.path.join(workdir, "embeddings.npy"), mode="w+", dtype=dtype, shape=(total, vectors.shape[1]))
+                embeddings[info["count"]:info["count"] + len(vectors)] = vectors.astype(dtype)
+                for i, text, metadata in zip(data["ids"], data["documents"], data["metadatas"]):
+                    f.write(json.dumps({"id": i, "page_content": text, "metadata": metadata or {}}, ensure_ascii=False) + "\n")
+                info["count"] += len(vectors)
+        if embeddings is not None:
+            embeddings.flush()
+            del embeddings
+    record_manager_path, manifest_path = _paths(path)
+    if os.path.exists(record_manager_path):
+        conn = sqlite3.connect(record_manager_path)
+        with open(os.path.join(workdir, "records.jsonl"), "w", encoding="utf-8") as f:
+            for key, group_id, updated_at in conn.execute("SELECT key, group_id, updated_at FROM upsertion_record"):
+                f.write(json.dumps({"key": key, "group_id": group_id, "updated_at": updated_at}, ensure_ascii=False) + "\n")
+        conn.close()
+    if os.path.exists(manifest_path):
+        shutil.copy(manifest_path, os.path.join(workdir, "manifest.json"))
+    if with_documents and os.path.isdir(path):
+        shutil.copytree(path, os.path.join(workdir, "documents"), ignore=shutil.ignore_patterns(".*"))
+    return info
+
+
+def export_snapshot(project, output=None, with_documents=False, dtype="float16"):
+    """导出项目全部知识库为快照压缩包，返回压缩包路径"""
+    config = get_config(project)
+    kind = getattr(config, "vector_store", "chroma")
+    output = output or f"{project}-{time.strftime('%Y%m%d-%H%M%S')}.snapshot.tar.gz"
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "project": project,
+        "created_at": time.time(),
+        "embedding": get_embedding_signature(),
+        "splitter": get_splitter_spec(),
+        "dtype": dtype,
+        "with_documents": with_documents,
+        "knowledge_bases": {},
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in KNOWLEDGE_BASES:
+            meta["knowledge_bases"][name] = _export_knowledge_base(kind, getattr(config, name), os.path.join(tmpdir, name), dtype, with_documents)
+            print(f"{name}: 导出 {meta['knowledge_bases'][name]['count']} 个知识块")
+        with open(os.path.join(tmpdir, "snapshot.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        with tarfile.open(output, "w:gz") as tar:
+            for name in sorted(os.listdir(tmpdir)):
+                tar.add(os.path.join(tmpdir, name), arcname=name)
+    return output
+
+
+def _import_knowledge_base(kind, info, path, workdir, batch_size=1000):
+    """将单个知识库从快照目录恢复到 path，改写全部来源路径
+
+    记录键与向量 id 是知识块内容与元数据的哈希，来源路径改写后按新元数据重新计算，
+    使下次更新知识库时 index() 能识别已导入的知识块而不再重新嵌入。
+    """
+    old_path = info["path"]
+    os.makedirs(path, exist_ok=True)
+    documents_dir = os.path.join(workdir, "documents")
+    if os.path.isdir(documents_dir):
+        shutil.copytree(documents_dir, path, dirs_exist_ok=True)
+
+    keys = {} # 原记录键 -> 改写来源后的记录键
+    if info["count"]:
+        store = open_raw_vector_store(kind, path)
+        embeddings = np.load(os.path.join(workdir, "embeddings.npy"), mmap_mode="r")
+        batch: dict = {"ids": [], "documents": [], "metadatas": []}
+        written = 0
+
+        def flush():
+            nonlocal written
+            batch["embeddings"] = np.asarray(embeddings[written:written + len(batch["ids"])], dtype=np.float32)
+            write_vector_batch(store, batch)
+            written += len(batch["ids"])
+            batch.update({"ids": [], "documents": [], "metadatas": []})
+
+        with open(os.path.join(workdir, "chunks.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                item = json.loads(line)
+                metadata = {key: _rewrite(value, old_path, path) for key, value in item["metadata"].items()}
+                if metadata != item["metadata"]:
+                    # 与 index() 使用相同的哈希方式（sha1）
+                    keys[item["id"]] = _get_document_with_hash(Document(page_content=item["page_content"], metadata=metadata), key_encoder="sha1").id
+                batch["ids"].append(keys.get(item["id"], item["id"]))
+                batch["documents"].append(item["page_content"])
+                batch["metadatas"].append(metadata)
+                if len(batch["ids"]) >= batch_size:
+                    flush()
+        if batch["ids"]:
+            flush()
+
+    record_manager_path, manifest_path = _paths(path)
+    records_file = os.path.join(workdir, "records.jsonl")
+    if os.path.exists(records_file):
+        namespace = path.split("/")[-1]
+        SQLRecordManager(namespace, db_url=f"sqlite:///{record_manager_path}").create_schema()
+        conn = sqlite3.connect(record_manager_path)
+        with open(records_file, "r", encoding="utf-8") as f:
+            rows = []
+            for line in f:
+                item = json.loads(line)
+                key = keys.get(item["key"], item["key"])
+                rows.append((key, key, namespace, _rewrite(item["group_id"], old_path, path), item["updated_at"]))
+        # 记录的 uuid 只需唯一，沿用知识块 id
+        conn.executemany("INSERT OR REPLACE INTO upsertion_record (uuid, key, namespace, group_id, updated_at) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    manifest_file = os.path.join(workdir, "manifest.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        # 只恢复目标路径下存在的文档，否则首次更新会把缺失的文档视为已删除并删除其全部知识块
+        files = {}
+        missing = 0
+        for source, entry in manifest.get("files", {}).items():
+            source = _rewrite(source, old_path, path)
+            if os.path.exists(source):
+                files[source] = entry
+            else:
+                missing += 1
+        if missing:
+            print(f"提示：{path} 中缺少快照记录的 {missing} 个文档，未写入文件清单；放入文档后更新知识库只会重新解析，不会重新嵌入已导入的知识块")
+        manifest["files"] = files
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def _has_data(kind, path):
+    record_manager_path, manifest_path = _paths(path)
+    return vector_store_exists(kind, f".vectordb/{path}/") or os.path.exists(record_manager_path) or os.path.exists(manifest_path)
+
+
+def _clear_knowledge_base(path):
+    """删除知识库的向量库、记录库与文件清单（不删除文档）"""
+    record_manager_path, manifest_path = _paths(path)
+    shutil.rmtree(f".vectordb/{path}/", ignore_errors=True)
+    for file in (record_manager_path, manifest_path):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def import_snapshot(archive, project=None, vector_store=None, force=False):
+    """从快照恢复项目知识库，项目不存在时按默认路径创建"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with tarfile.open(archive, "r:gz") as tar:
+            tar.extractall(tmpdir, filter="data")
+        with open(os.path.join(tmpdir, "snapshot.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["version"] > SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {meta['version']}")
+        if meta["embedding"] != get_embedding_signature() and not force:
+            raise ValueError(f"快照使用的嵌入模型 {meta['embedding']} 与当前配置 {get_embedding_signature()} 不一致，查询向量将无法匹配；如确需导入请使用 --force")
+        project = project or meta["project"]
+        if project not in get_projects():
+            if not create_new_project(project):
+                raise RuntimeError(f"项目 {project} 创建失败")
+        if vector_store:
+            set_project_vector_store(project, vector_store)
+        config = get_config(project)
+        kind = getattr(config, "vector_store", "chroma")
+        for name, info in meta["knowledge_bases"].items():
+            path = getattr(config, name)
+            if _has_data(kind, path):
+                if not force:
+                    raise FileExistsError(f"知识库 {path} 已有数据，如需覆盖请使用 --force")
+                _clear_knowledge_base(path)
+            release_document_processors(path)
+            _import_knowledge_base(kind, info, path, os.path.join(tmpdir, name))
+            print(f"{name}: 导入 {info['count']} 个知识块 -> {path}")
+        if meta["splitter"] != get_splitter_spec():
+            print("提示：快照的切分配置与当前配置不同，下次更新知识库时将重新切分全部文档")
+    return project
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="知识库快照工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="导出项目知识库快照")
+    export_parser.add_argument("project", help="项目名")
+    export_parser.add_argument("-o", "--output", default=None)
+    export_parser.add_argument("--with-documents", action="store_true", help="同时打包知识库原始文档")
+    export_parser.add_argument("--dtype", default="float16", choices=["float16", "float32"])
+    import_parser = subparsers.add_parser("import", help="从快照恢复项目知识库")
+    import_parser.add_argument("archive", help="快照文件")
+    import_parser.add_argument("project", nargs="?", default=None, help="目标项目名，缺省为快照中的项目名")
+    import_parser.add_argument("--vector-store", default=None, choices=["chroma", "flat"])
+    import_parser.add_argument("--force", action="store_true", help="覆盖已有数据，忽略嵌入模型不一致")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "export":
+        output = export_snapshot(args.project, args.output, args.with_documents, args.dtype)
+        print(f"快照已导出：{output}（{os.path.getsize(output) / 1024 / 1024:.1f} MB），耗时 {time.perf_counter() - start:.2f} 秒")
+    else:
+        project = import_snapshot(args.archive, args.project, args.vector_store, args.force)
+        print(f"快照已导入项目 {project}，耗时 {time.perf_counter() - start:.2f} 秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+文本切分模块
+ChineseTextSplitter 按中文句末标点与章节标题切分，按 token 预算装箱，并在知识块上保留章节元数据
+CHUNKER=chinese 使用中文切分器，character 使用原有的按行定长切分
+"""
+from langchain_classic.text_splitter import CharacterTextSplitter, TextSplitter
+from langchain_core.documents import Document
+from utils.token_utils import estimate_tokens
+from typing import Iterable, Iterator
+import copy
+import os
+import re
+
+
+# 章节标题：第X章/回/卷/部/集/篇 视为章，第X节 视为节；Markdown 一二级标题视为章，其余视为节
+_CHAPTER_PATTERN = re.compile(r"^\s*(第[0-9０-９零〇一二三四五六七八九十百千万两]+[章回卷部集篇])(?:[\s:：、.．]*)(.{0,40})$")
+_SECTION_PATTERN = re.compile(r"^\s*(第[0-9０-９零〇一二三四五六七八九十百千万两]+节)(?:[\s:：、.．]*)(.{0,40})$")
+_MARKDOWN_PATTERN = re.compile(r"^\s*(#{1,6})\s+(.{1,60})$")
+# 句末标点（含省略号、分号）及其后紧跟的右引号、右括号
+_SENTENCE_PATTERN = re.compile(r"[^。！？!?；;…]*(?:[。！？!?；;]+|…+)[”’」』）)\"']*|[^。！？!?；;…]+$")
+
+
+def _heading(line):
+    """识别章节标题，返回 ("chapter" | "section", 标题) 或 None"""
+    match = _CHAPTER_PATTERN.match(line)
+    if match:
+        return "chapter", " ".join(part for part in match.groups() if part).strip()
+    match = _SECTION_PATTERN.match(line)
+    if match:
+        return "section", " ".join(part for part in match.groups() if part).strip()
+    match = _MARKDOWN_PATTERN.match(line)
+    if match:
+        return ("chapter" if len(match.group(1)) <= 2 else "section"), match.group(2).strip()
+    return None
+
+
+class ChineseTextSplitter(TextSplitter):
+    """中文切分器：句子为最小单位，不跨越章节边界，按 token 预算装箱"""
+
+    def __init__(self, chunk_tokens=256, chunk_overlap_tokens=32, **kwargs):
+        super().__init__(chunk_size=chunk_tokens, chunk_overlap=chunk_overlap_tokens, length_function=estimate_tokens, **kwargs)
+
+    def _sentences(self, paragraph) -> list[str]:
+        """将段落切分为句子，超出预算的长句按字符硬切"""
+        sentences = []
+        for sentence in _SENTENCE_PATTERN.findall(paragraph):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            while self._length_function(sentence) > self._chunk_size:
+                # 按中文约 1 字/token 估计切点，再向前收缩到预算以内
+                cut = self._chunk_size
+                while cut > 1 and self._length_function(sentence[:cut]) > self._chunk_size:
+                    cut = cut * 3 // 4
+                sentences.append(sentence[:cut])
+                sentence = sentence[cut:]
+            if sentence:
+                sentences.append(sentence)
+        return sentences
+
+    def _pack(self, sentences) -> list[str]:
+        """将句子装箱为不超过预算的知识块，相邻知识块之间保留若干句重叠"""
+        chunks = []
+        current = []
+        current_tokens = 0
+        for sentence in sentences:
+            tokens = self._length_function(sentence)
+            if current and current_tokens + tokens > self._chunk_size:
+                chunks.append("".join(current))
+                # 从末尾回溯保留不超过重叠预算的句子
+                overlap = []
+                overlap_tokens = 0
+                for previous in reversed(current):
+                    previous_tokens = self._length_function(previous)
+                    if overlap_tokens + previous_tokens > self._chunk_overlap or overlap_tokens + previous_tokens + tokens > self._chunk_size:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_tokens += previous_tokens
+                current = overlap
+                current_tokens = overlap_tokens
+            current.append(sentence)
+            current_tokens += tokens
+        if current:
+            chunks.append("".join(current))
+        return chunks
+
+    def _split_sections(self, text, state) -> Iterator[tuple[str, dict]]:
+        """按章节标题分段切分，state 记录当前所在的章与节，可跨多个文档（如 PDF 分页）延续"""
+        sentences = []
+
+        def flush():
+            metadata = {key: value for key, value in state.items() if value}
+            for chunk in self._pack(sentences):
+                yield chunk, metadata
+            sentences.clear()
+
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            heading = _heading(line)
+            if heading is not None:
+                yield from flush()
+                level, title = heading
+                if level == "chapter":
+                    state["chapter"] = title
+                    state["section"] = None
+                else:
+                    state["section"] = title
+                # 标题本身作为该段第一句，便于按章节名检索
+                sentences.append(line + "\n")
+                continue
+            paragraph = self._sentences(line)
+            if paragraph:
+                paragraph[-1] += "\n"
+                sentences.extend(paragraph)
+        yield from flush()
+
+    def split_text(self, text: str) -> list[str]:
+        return [chunk.strip() for chunk, _ in self._split_sections(text, {}) if chunk.strip()]
+
+    def create_documents(self, texts: list[str], metadatas: list[dict] | None = None) -> list[Document]:
+        metadatas_ = metadatas or [{}] * len(texts)
+        return list(self.lazy_split_documents(
+            Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas_)
+        ))
+
+    def split_documents(self, documents: Iterable[Document]) -> list[Document]:
+        return list(self.lazy_split_documents(documents))
+
+    def lazy_split_documents(self, documents: Iterable[Document]) -> Iterator[Document]:
+        """逐个切分文档并产出知识块，同一来源的相邻文档共享章节状态"""
+        state = {}
+        source = None
+        for document in documents:
+            if document.metadata.get("source") != source:
+                source = document.metadata.get("source")
+                state = {}
+            for chunk, heading in self._split_sections(document.page_content, state):
+                chunk = chunk.strip()
+                if chunk:
+                    metadata = copy.deepcopy(document.metadata)
+                    metadata.update(heading)
+                    yield Document(page_content=chunk, metadata=metadata)
+
+
+def get_splitter_spec() -> dict:
+    """读取切分器配置，该配置同时写入文件清单，配置变化时全部文件重新切分"""
+    kind = os.getenv("CHUNKER", "chinese").lower()
+    if kind == "character":
+        return {"kind": "character", "chunk_size": 200, "chunk_overlap": 20}
+    if kind == "chinese":
+        return {
+            "kind": "chinese",
+            "chunk_tokens": int(os.getenv("CHUNK_TOKENS", 256)),
+            "chunk_overlap_tokens": int(os.getenv("CHUNK_OVERLAP_TOKENS", 32)),
+        }
+    raise ValueError(f"Invalid chunker: {kind}, please use chinese or character")
+
+
+def build_text_splitter(spec=None) -> TextSplitter:
+    """根据配置创建切分器"""
+    spec = spec or get_splitter_spec()
+    if spec["kind"] == "character":
+        return CharacterTextSplitter(separator="\n", chunk_size=spec["chunk_size"], chunk_overlap=spec["chunk_overlap"])
+    return ChineseTextSplitter(chunk_tokens=spec["chunk_tokens"], chunk_overlap_tokens=spec["chunk_overlap_tokens"])
@@ -0,0 +1,354 @@
+"""
+向量库模块
+FlatVectorStore 将归一化后的向量以 float16 矩阵追加写入磁盘，检索时内存映射读取并用 NumPy 精确计算 top-k，
+打开无需加载索引；项目配置中 vector_store: chroma | flat 选择后端
+"""
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_core.vectorstores.utils import maximal_marginal_relevance
+from threading import RLock
+from typing import Any, Iterable, Sequence
+import json
+import numpy as np
+import os
+import uuid
+
+
+VECTOR_STORES = ("chroma", "flat")
+# 向量矩阵小于该大小时常驻内存（float32），否则按块从内存映射中读取
+FLAT_CACHE_MB = int(os.getenv("FLAT_VECTOR_CACHE_MB", 512))
+
+
+class FlatVectorStore(VectorStore):
+    """本地平铺向量库
+
+    目录结构：meta.json 记录维度；vectors.f16 为按行追加的归一化 float16 向量；
+    docs.jsonl 与向量逐行对应，记录 id、内容与元数据；tombstones.txt 记录已删除的行号。
+    写入只追加，删除只记录行号，删除行过半时自动压缩。
+    """
+
+    def __init__(self, persist_directory, embedding_function: Embeddings, block_rows=8192):
+        self.persist_directory = persist_directory
+        self._embedding = embedding_function
+        self.block_rows = block_rows
+        self._lock = RLock()
+        self._meta_path = os.path.join(persist_directory, "meta.json")
+        self._vectors_path = os.path.join(persist_directory, "vectors.f16")
+        self._docs_path = os.path.join(persist_directory, "docs.jsonl")
+        self._tombstones_path = os.path.join(persist_directory, "tombstones.txt")
+        os.makedirs(persist_directory, exist_ok=True)
+        self._load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    @staticmethod
+    def exists(persist_directory) -> bool:
+        return os.path.exists(os.path.join(persist_directory, "meta.json"))
+
+    def _load(self):
+        """读取磁盘数据，写入中断导致向量与文档行数不一致时截断到较短者"""
+        self.dim = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+        records = []
+        if os.path.exists(self._docs_path):
+            with open(self._docs_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        count = min(len(records), size // (self.dim * 2)) if self.dim else 0
+        if count < len(records) or (self.dim and size != count * self.dim * 2):
+            self._truncate(records[:count], count)
+        self._records = records[:count]
+        self._alive = np.ones(count, dtype=bool)
+        if os.path.exists(self._tombstones_path):
+            with open(self._tombstones_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip().isdigit() and int(line) < count:
+                        self._alive[int(line)] = False
+        # 同一 id 多次写入时以最后一行为准
+        self._id_to_row = {}
+        for row, record in enumerate(self._records):
+            if not self._alive[row]:
+                continue
+            previous = self._id_to_row.get(record["id"])
+            if previous is not None:
+                self._alive[previous] = False
+            self._id_to_row[record["id"]] = row
+        self._matrix_cache = None
+
+    def _truncate(self, records, count):
+        with open(self._docs_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        if self.dim and os.path.exists(self._vectors_path):
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(count * self.dim * 2)
+
+    def _matrix(self) -> np.ndarray:
+        """返回全部向量（含已删除行），较小时缓存为 float32，否则返回内存映射"""
+        if self._matrix_cache is not None and len(self._matrix_cache) == len(self._records):
+            return self._matrix_cache
+        count = len(self._records)
+        if count == 0 or not self.dim:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        matrix = np.memmap(self._vectors_path, dtype=np.float16, mode="r", shape=(count, self.dim))
+        if count * self.dim * 4 <= FLAT_CACHE_MB * 1024 * 1024:
+            matrix = np.asarray(matrix, dtype=np.float32)
+        self._matrix_cache = matrix
+        return matrix
+
+    def __len__(self):
+        return len(self._id_to_row)
+
+    def add_embeddings(self, texts: Sequence[str], embeddings, metadatas: Sequence[dict] | None = None, ids: Sequence[str] | None = None) -> list[str]:
+        """写入已计算好的向量，已存在的 id 会被覆盖"""
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = [str(i) for i in ids] if ids else [uuid.uuid4().hex for _ in texts]
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self._meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim, "dtype": "float16", "metric": "cosine"}, f)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the store dimension {self.dim}")
+            start = len(self._records)
+            replaced = [self._id_to_row[i] for i in ids if i in self._id_to_row]
+            # 先写向量再写文档，中断时加载会截断到一致的行数
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.astype(np.float16).tobytes())
+            with open(self._docs_path, "a", encoding="utf-8") as f:
+                for i, text, metadata in zip(ids, texts, metadatas):
+                    f.write(json.dumps({"id": i, "page_content": text, "metadata": metadata or {}}, ensure_ascii=False, default=str) + "\n")
+            self._records.extend({"id": i, "page_content": text, "metadata": metadata or {}} for i, text, metadata in zip(ids, texts, metadatas))
+            self._alive = np.concatenate([self._alive, np.ones(len(texts), dtype=bool)])
+            for offset, i in enumerate(ids):
+                previous = self._id_to_row.get(i)
+                if previous is not None and previous >= start:
+                    replaced.append(previous)
+                self._id_to_row[i] = start + offset
+            self._tombstone(replaced)
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: list[dict] | None = None, *, ids: list[str] | None = None, **kwargs: Any) -> list[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        return self.add_embeddings(texts, self._embedding.embed_documents(texts), metadatas, ids)
+
+    async def aadd_texts(self, texts: Iterable[str], metadatas: list[dict] | None = None, *, ids: list[str] | None = None, **kwargs: Any) -> list[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        return self.add_embeddings(texts, await self._embedding.aembed_documents(texts), metadatas, ids)
+
+    def _tombstone(self, rows):
+        if not rows:
+            return
+        self._alive[rows] = False
+        with open(self._tombstones_path, "a", encoding="utf-8") as f:
+            f.writelines(f"{row}\n" for row in rows)
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> bool | None:
+        with self._lock:
+            if ids is None:
+                rows = list(self._id_to_row.values())
+                self._id_to_row.clear()
+            else:
+                rows = [self._id_to_row.pop(i) for i in ids if i in self._id_to_row]
+            self._tombstone(rows)
+            if len(self._records) > 1000 and (~self._alive).sum() * 2 > len(self._records):
+                self.compact()
+        return True
+
+    def compact(self):
+        """重写数据文件，丢弃已删除的行"""
+        with self._lock:
+            rows = np.flatnonzero(self._alive)
+            matrix = self._matrix()
+            self._matrix_cache = None
+            with open(f"{self._vectors_path}.tmp", "wb") as f:
+                for start in range(0, len(rows), self.block_rows):
+                    f.write(np.asarray(matrix[rows[start:start + self.block_rows]], dtype=np.float16).tobytes())
+            with open(f"{self._docs_path}.tmp", "w", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(self._records[row], ensure_ascii=False, default=str) + "\n")
+            del matrix
+            os.replace(f"{self._vectors_path}.tmp", self._vectors_path)
+            os.replace(f"{self._docs_path}.tmp", self._docs_path)
+            if os.path.exists(self._tombstones_path):
+                os.remove(self._tombstones_path)
+            self._load()
+
+    def _document(self, row) -> Document:
+        record = self._records[row]
+        return Document(id=record["id"], page_content=record["page_content"], metadata=record["metadata"])
+
+    def get_by_ids(self, ids: Sequence[str], /) -> list[Document]:
+        with self._lock:
+            return [self._document(self._id_to_row[i]) for i in ids if i in self._id_to_row]
+
+    def get(self, ids=None, include=None, limit=None, offset=None, **kwargs) -> dict:
+        """与 Chroma.get 相同格式的读取接口"""
+        include = include or ["documents", "metadatas"]
+        with self._lock:
+            rows = [self._id_to_row[i] for i in ids if i in self._id_to_row] if ids is not None else sorted(self._id_to_row.values())
+            rows = rows[offset or 0:(offset or 0) + limit if limit else None]
+            result: dict = {"ids": [self._records[row]["id"] for row in rows]}
+            if "documents" in include:
+                result["documents"] = [self._records[row]["page_content"] for row in rows]
+            if "metadatas" in include:
+                result["metadatas"] = [self._records[row]["metadata"] for row in rows]
+            if "embeddings" in include:
+                result["embeddings"] = np.asarray(self._matrix()[rows], dtype=np.float32) if rows else np.zeros((0, self.dim or 0), dtype=np.float32)
+            return result
+
+    def _top_k(self, vectors, k) -> list[tuple[np.ndarray, np.ndarray]]:
+        """对一批查询向量计算余弦相似度，返回每个查询的 (行号, 得分)，按得分降序"""
+        with self._lock:
+            matrix = self._matrix()
+            alive = self._alive.copy()
+        if len(matrix) == 0 or not alive.any():
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in vectors]
+        queries = np.asarray(vectors, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = np.empty((len(matrix), len(queries)), dtype=np.float32)
+        for start in range(0, len(matrix), self.block_rows):
+            block = np.asarray(matrix[start:start + self.block_rows], dtype=np.float32)
+            scores[start:start + len(block)] = block @ queries.T
+        scores[~alive] = -np.inf
+        k = min(k, int(alive.sum()))
+        results = []
+        for column in scores.T:
+            top = np.argpartition(-column, k - 1)[:k]
+            top = top[np.argsort(-column[top], kind="stable")]
+            results.append((top, column[top]))
+        return results
+
+    def query_vectors(self, vectors, n_results) -> list[tuple[list[Document], np.ndarray]]:
+        """批量检索：返回每个查询的 (文档列表, 文档向量矩阵)"""
+        results = []
+        for rows, _ in self._top_k(vectors, n_results):
+            with self._lock:
+                documents = [self._document(row) for row in rows]
+                embeddings = np.asarray(self._matrix()[rows], dtype=np.float32)
+            results.append((documents, embeddings))
+        return results
+
+    def similarity_search_with_score_by_vector(self, embedding: list[float], k: int = 4) -> list[tuple[Document, float]]:
+        rows, scores = self._top_k([embedding], k)[0]
+        with self._lock:
+            return [(self._document(row), float(score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> list[tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: Any) -> list[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k)
+
+    def _select_relevance_score_fn(self):
+        # 余弦相似度映射到 [0, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    def max_marginal_relevance_search_by_vector(self, embedding: list[float], k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs: Any) -> list[Document]:
+        documents, embeddings = self.query_vectors([embedding], fetch_k)[0]
+        if not documents:
+            return []
+        selected = maximal_marginal_relevance(np.array(embedding, dtype=np.float32), embeddings, k=k, lambda_mult=lambda_mult) # type: ignore
+        return [documents[i] for i in selected]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs: Any) -> list[Document]:
+        return self.max_marginal_relevance_search_by_vector(self._embedding.embed_query(query), k, fetch_k, lambda_mult)
+
+    @classmethod
+    def from_texts(cls, texts: list[str], embedding: Embeddings, metadatas: list[dict] | None = None, *, ids: list[str] | None = None, persist_directory=None, **kwargs: Any) -> "FlatVectorStore":
+        if persist_directory is None:
+            raise ValueError("persist_directory is required for FlatVectorStore")
+        store = cls(persist_directory, embedding)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+
+def open_vector_store(kind, collection_name, persist_directory, embeddings) -> VectorStore:
+    """按后端类型打开（或创建）知识库的向量库"""
+    if kind == "chroma":
+        return Chroma(collection_name=collection_name, persist_directory=persist_directory, embedding_function=embeddings)
+    if kind == "flat":
+        return FlatVectorStore(os.path.join(persist_directory, "flat"), embeddings)
+    raise ValueError(f"Invalid vector store: {kind}, please use {' or '.join(VECTOR_STORES)}")
+
+
+def vector_store_exists(kind, persist_directory) -> bool:
+    """判断知识库的向量库是否已经建立"""
+    if kind == "flat":
+        return FlatVectorStore.exists(os.path.join(persist_directory, "flat"))
+    return os.path.exists(os.path.join(persist_directory, "chroma.sqlite3"))
+
+
+def count_documents(store: VectorStore) -> int:
+    if isinstance(store, FlatVectorStore):
+        return len(store)
+    return store._collection.count() # type: ignore
+
+
+def query_vectors(store: VectorStore, vectors, n_results) -> list[tuple[list[Document], Any]]:
+    """对一批查询向量执行一次检索，返回每个查询的 (文档列表, 文档向量)"""
+    if isinstance(store, FlatVectorStore):
+        return store.query_vectors(vectors, n_results)
+    results = store._collection.query( # type: ignore
+        query_embeddings=vectors,
+        n_results=n_results,
+        include=["documents", "metadatas", "embeddings"]
+    )
+    return [
+        ([Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(documents, metadatas)], embeddings)
+        for documents, metadatas, embeddings in zip(results["documents"], results["metadatas"], results["embeddings"]) # type: ignore
+    ]
+
+
+def open_raw_vector_store(kind, knowledge_base_path) -> VectorStore:
+    """打开知识库向量库用于直接读写向量（迁移、快照），不需要嵌入模型"""
+    persist_directory = f".vectordb/{knowledge_base_path}/"
+    if kind == "flat":
+        return FlatVectorStore(os.path.join(persist_directory, "flat"), None) # type: ignore
+    return Chroma(collection_name=knowledge_base_path.split("/")[-1], persist_directory=persist_directory)
+
+
+def iter_vector_batches(store: VectorStore, batch_size=1000):
+    """分批读取向量库中的 id、内容、元数据与向量"""
+    offset = 0
+    while True:
+        data = store.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset) # type: ignore
+        if not len(data["ids"]):
+            return
+        yield data
+        offset += len(data["ids"])
+
+
+def write_vector_batch(store: VectorStore, data):
+    """按原 id 写入一批已计算好的向量"""
+    if isinstance(store, FlatVectorStore):
+        store.add_embeddings(data["documents"], data["embeddings"], data["metadatas"], data["ids"])
+    else:
+        store._collection.upsert( # type: ignore
+            ids=list(data["ids"]),
+            embeddings=[list(map(float, vector)) for vector in data["embeddings"]],
+            documents=list(data["documents"]),
+            metadatas=[metadata or None for metadata in data["metadatas"]],
+        )
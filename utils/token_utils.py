@@ -0,0 +1,68 @@
+"""
+Token 估算工具模块
+不依赖具体模型的分词器，按字符类别近似估算 token 数，用于吞吐统计与上下文预算
+"""
+import re
+
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text) -> int:
+    """估算 token 数：中日韩字符与全角标点约 1 个/token，其余非空白字符约 4 个/token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    others = len(text) - cjk - text.count(" ") - text.count("\n")
+    return cjk + max(others, 0) // 4 + (1 if others % 4 else 0)
+
+
+_SENTENCE_END_PATTERN = re.compile(r"(?<=[。！？!?…；;\n])")
+
+
+def truncate_tokens(text, budget, from_end=False) -> str:
+    """截取不超过 token 预算的文本，from_end 为 True 时保留结尾；尽量在句子边界处截断"""
+    if not text or estimate_tokens(text) <= budget:
+        return text or ""
+    # 按估算比例确定初始长度，再逐步收缩到预算以内
+    length = max(1, int(len(text) * budget / estimate_tokens(text)))
+    while length > 1:
+        part = text[-length:] if from_end else text[:length]
+        if estimate_tokens(part) <= budget:
+            break
+        length = length * 9 // 10
+    part = text[-length:] if from_end else text[:length]
+    sentences = [sentence for sentence in _SENTENCE_END_PATTERN.split(part) if sentence]
+    if len(sentences) > 1:
+        # 丢弃被截断的半句
+        part = "".join(sentences[1:]) if from_end else "".join(sentences[:-1])
+    return part
+
+
+def extractive_summary(text, budget) -> str:
+    """抽取式摘要：保留各段首句（段落过少时改用全部句子），超出 token 预算时在全文范围内均匀抽取，不调用模型"""
+    if not text or estimate_tokens(text) <= budget:
+        return text or ""
+    leads = []
+    for paragraph in text.split("\n"):
+        paragraph = paragraph.strip()
+        if paragraph:
+            leads.append(next((sentence for sentence in _SENTENCE_END_PATTERN.split(paragraph) if sentence.strip()), paragraph))
+    tokens = [estimate_tokens(lead) for lead in leads]
+    if sum(tokens) < budget // 2:
+        # 段落很少（如整段文字）时各段首句过于稀疏，改为在全部句子中均匀抽取
+        leads = [sentence for sentence in _SENTENCE_END_PATTERN.split(text.replace("\n", "")) if sentence.strip()]
+        tokens = [estimate_tokens(lead) for lead in leads]
+    if sum(tokens) > budget:
+        # 均匀抽取，保证开头与结尾附近的情节都有覆盖
+        count = max(1, min(len(leads), int(budget / (sum(tokens) / len(leads)))))
+        indexes = sorted({round(i * (len(leads) - 1) / max(count - 1, 1)) for i in range(count)})
+        picked = []
+        picked_tokens = 0
+        for index in indexes:
+            if picked_tokens + tokens[index] > budget:
+                continue
+            picked.append(leads[index])
+            picked_tokens += tokens[index]
+        leads = picked or [truncate_tokens(leads[0], budget)]
+    return "……".join(lead.strip() for lead in leads)